@@ -0,0 +1,96 @@
+"""
+Weighted Aalen-Johansen estimator of the cumulative incidence function.
+
+Computed over the sorted distinct event times with the risk sets of
+risteys_pipeline.cox: subjects are weighted (case-cohort weights), enter
+the risk sets after their entry time (left truncation), and any event
+other than the event of interest is a competing event.
+
+`AalenJohansen` mirrors the parts of lifelines `AalenJohansenFitter` used
+in the pipeline (`fit`, `predict`, `cumulative_density_`), so it can be
+used in its place. Unlike lifelines, tied event times are handled exactly
+instead of being randomly jittered, so the estimates are deterministic.
+Without ties the results agree with lifelines.
+"""
+
+import numpy as np
+import pandas as pd
+from risteys_pipeline.cox import RiskSets
+
+
+class AalenJohansen:
+    """
+    Aalen-Johansen estimator for one event of interest, see the module docstring.
+
+    CIF(t) = sum over event times t_j <= t of S(t_j-) * d_j / n_j, where
+    d_j is the weighted number of events of interest at t_j, n_j the
+    weighted number of subjects at risk, and S the Kaplan-Meier estimate
+    of surviving all the events.
+
+    Attributes after `fit()`:
+        timeline (ndarray): distinct event times, of any event
+        cumulative_incidence (ndarray): CIF at each time of the timeline
+        cumulative_density_ (DataFrame): CIF indexed by the timeline, as in lifelines
+    """
+
+    def fit(self, durations, event_observed, event_of_interest, entry=None, weights=None):
+        """
+        Fit the estimator.
+
+        Args:
+            durations (array-like): times of the events or censoring
+            event_observed (array-like): event type, 0 for censoring
+            event_of_interest (int): event type of the cumulative incidence
+            entry (array-like, optional): entry times, for left truncation
+            weights (array-like, optional): observation weights
+
+        Returns:
+            self (AalenJohansen): fitted estimator
+        """
+        durations = np.asarray(durations, dtype=float)
+        event_observed = np.asarray(event_observed)
+        weights = np.ones(durations.shape[0]) if weights is None else np.asarray(weights, dtype=float)
+        entries = np.full(durations.shape[0], -np.inf) if entry is None else np.asarray(entry, dtype=float)
+
+        any_event = event_observed != 0
+        risk_sets = RiskSets(durations, any_event, weights, entries)
+        at_risk = risk_sets.sum(weights[:, np.newaxis])[:, 0]
+
+        of_interest = event_observed == event_of_interest
+        n_times = risk_sets.times.shape[0]
+        counts_of_interest = np.bincount(
+            risk_sets.stop[of_interest] - 1, weights=weights[of_interest], minlength=n_times
+        )
+
+        # Overall survival just before each event time
+        survival = np.cumprod(1 - risk_sets.counts / at_risk)
+        lagged_survival = np.concatenate([[1.0], survival[:-1]])
+
+        self.event_of_interest = event_of_interest
+        self.timeline = risk_sets.times
+        self.cumulative_incidence = np.cumsum(lagged_survival * counts_of_interest / at_risk)
+
+        return self
+
+    @property
+    def cumulative_density_(self):
+        return pd.DataFrame(
+            {f"CIF_{self.event_of_interest}": self.cumulative_incidence},
+            index=pd.Index(self.timeline, name="event_at"),
+        )
+
+    def predict(self, times):
+        """
+        Evaluate the CIF at the given times.
+
+        Args:
+            times (array-like): times, e.g. the integer ages of the output
+
+        Returns:
+            CIF (Series): CIF at each time, indexed by the times
+        """
+        times = np.asarray(times, dtype=float)
+        cif = np.concatenate([[0.0], self.cumulative_incidence])
+        values = cif[np.searchsorted(self.timeline, times, side="right")]
+
+        return pd.Series(values, index=times, name=f"CIF_{self.event_of_interest}")
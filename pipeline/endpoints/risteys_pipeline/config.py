@@ -11,6 +11,9 @@ FINREGISTRY_ENDPOINT_DEFINITIONS_DATA_PATH = ROOT_DIR / "endpoint_metadata" / "e
 # Output directory
 FINREGISTRY_OUTPUT_DIR = Path("/data") / "projects" / "risteys"
 
+# Cache directory for the loaded datasets, set to None to disable caching
+FINREGISTRY_CACHE_DIR = FINREGISTRY_OUTPUT_DIR / "cache"
+
 
 # --- FinnGen
 # Input data
@@ -24,6 +27,9 @@ FINNGEN_DETAILED_LONGITUDINAL  = FINNGEN_DATA_DIR / Path()
 # Output directory
 FINNGEN_OUTPUT_DIRECTORY = Path()
 
+# Cache directory for the loaded datasets, set to None to disable caching
+FINNGEN_CACHE_DIRECTORY = FINNGEN_OUTPUT_DIRECTORY / "cache"
+
 # --- Common
 # Constants
 
@@ -0,0 +1,221 @@
+"""Count cube of the first events by endpoint, sex, index person, age and year"""
+
+import json
+import numpy as np
+import pandas as pd
+from risteys_pipeline.utils.log import logger
+from risteys_pipeline.utils.persons import take_demographics
+from risteys_pipeline.run_key_figures import SEXES, get_sex_codes
+
+# Order of the cube axes
+AXES = ["endpoint", "sex", "index_person", "age", "year"]
+
+# Minimum range of the 1-year bins of the age and year axes, extended to
+# the range of the data so that any integer bracket edge is a bin edge
+AGE_RANGE = (0, 120)
+YEAR_RANGE = (1900, 2030)
+
+
+class CubeBins:
+    """
+    1-year bins of a cube axis between `lower` and `upper`.
+
+    Bin codes:
+    - 0: values below `lower`
+    - 1..n: [lower + code - 1, lower + code)
+    - n + 1: values above or equal to `upper`
+    - n + 2: missing values
+
+    Attributes:
+        lower (int): lower bound of the first 1-year bin
+        upper (int): upper bound of the last 1-year bin
+    """
+
+    def __init__(self, lower, upper):
+        self.lower = int(lower)
+        self.upper = int(upper)
+        self.n_bins = self.upper - self.lower + 3
+        self.missing = self.n_bins - 1
+
+    @classmethod
+    def covering(cls, values, default_range):
+        """Bins covering both `default_range` and all the values"""
+        lower, upper = default_range
+        if np.isfinite(values).any():
+            lower = min(lower, np.floor(np.nanmin(values)))
+            upper = max(upper, np.floor(np.nanmax(values)) + 1)
+        return cls(lower, upper)
+
+    def encode(self, values):
+        """Get the bin code of each value"""
+        values = np.asarray(values, dtype=float)
+        with np.errstate(invalid="ignore"):
+            codes = np.floor(values) - self.lower + 1
+            codes = np.clip(codes, 0, self.upper - self.lower + 1)
+        return np.where(np.isnan(values), self.missing, codes).astype(np.int64)
+
+    def aggregate(self, counts, brackets):
+        """
+        Sum the counts of the bins for each bracket [left, right).
+
+        Args:
+            counts (ndarray): counts with the bins on the last axis
+            brackets (list): bracket edges, integers or -inf/inf
+
+        Returns:
+            res (ndarray): counts with the brackets on the last axis
+        """
+        def edge_code(edge):
+            if edge == -np.inf:
+                return 0
+            if edge == np.inf:
+                return self.missing
+            if edge != int(edge):
+                raise ValueError(f"Bracket edge {edge} is not a bin edge")
+            # Bins below `lower` and above `upper` are empty when the range covers the data
+            return int(np.clip(edge, self.lower, self.upper)) - self.lower + 1
+
+        cum_counts = np.concatenate([np.zeros(counts.shape[:-1] + (1,), dtype=counts.dtype), np.cumsum(counts, axis=-1)], axis=-1)
+        edges = np.array([edge_code(edge) for edge in brackets])
+        return cum_counts[..., edges[1:]] - cum_counts[..., edges[:-1]]
+
+
+class CountCube:
+    """
+    Number of first events by endpoint, sex, index person status, 1-year age
+    bin and 1-year calendar-year bin.
+
+    Only the non-empty cells are stored, as sorted flat cell indices and counts.
+    Counts by any subset of axes are sums over the other axes, so the
+    distributions are computed without the first events.
+
+    Attributes:
+        endpoints (Index): endpoint names
+        age_bins (CubeBins): bins of the age axis
+        year_bins (CubeBins): bins of the year axis
+        max_year (float): latest event year
+        cells (ndarray): flat indices of the non-empty cells
+        counts (ndarray): number of events of each cell
+    """
+
+    def __init__(self, endpoints, age_bins, year_bins, max_year, cells, counts):
+        self.endpoints = pd.Index(endpoints)
+        self.age_bins = age_bins
+        self.year_bins = year_bins
+        self.max_year = max_year
+        self.cells = cells
+        self.counts = counts
+
+    @property
+    def shape(self):
+        return (len(self.endpoints), len(SEXES), 2, self.age_bins.n_bins, self.year_bins.n_bins)
+
+    @classmethod
+    def from_first_events(cls, first_events, minimal_phenotype):
+        """
+        Build the count cube in a single pass over the first events.
+
+        Args:
+            first_events (DataFrame): first events dataset
+            minimal_phenotype (DataFrame): code-indexed minimal phenotype dataset
+
+        Returns:
+            cube (CountCube): count cube of the first events
+        """
+        logger.info("Building the first events count cube")
+
+        endpoint = first_events["endpoint"]
+        if isinstance(endpoint.dtype, pd.CategoricalDtype):
+            endpoint_codes = endpoint.cat.codes.values
+            endpoints = endpoint.cat.categories
+        else:
+            endpoint_codes, endpoints = pd.factorize(endpoint, sort=True)
+
+        demographics = take_demographics(minimal_phenotype, first_events["personid"], ["female", "index_person"])
+        sex = get_sex_codes(demographics["female"].values).astype(np.int64)
+        index_person = (demographics["index_person"] == True).values.astype(np.int64)
+
+        age_bins = CubeBins.covering(first_events["age"].values, AGE_RANGE)
+        year_bins = CubeBins.covering(first_events["year"].values, YEAR_RANGE)
+        cube = cls(endpoints, age_bins, year_bins, float(first_events["year"].max()), None, None)
+
+        cells = np.ravel_multi_index(
+            (
+                endpoint_codes,
+                sex,
+                index_person,
+                age_bins.encode(first_events["age"].values),
+                year_bins.encode(first_events["year"].values),
+            ),
+            cube.shape,
+        )
+        cube.cells, cube.counts = np.unique(cells, return_counts=True)
+
+        return cube
+
+    def marginal(self, axes, index_persons=False, sexes=None):
+        """
+        Count the events by some axes of the cube.
+
+        Args:
+            axes (list): axes to keep, in AXES order
+            index_persons (bool): count only the events of index persons
+            sexes (list, optional): count only the events of these sexes, all by default
+
+        Returns:
+            res (ndarray): dense counts with one dimension per axis in `axes`
+        """
+        coords = np.unravel_index(self.cells, self.shape)
+        keep = np.ones(self.cells.shape[0], dtype=bool)
+        if index_persons:
+            keep &= coords[AXES.index("index_person")] == 1
+        if sexes is not None:
+            keep &= np.isin(coords[AXES.index("sex")], [SEXES.index(sex) for sex in sexes])
+
+        axes_idx = [AXES.index(axis) for axis in axes]
+        shape = tuple(self.shape[idx] for idx in axes_idx)
+        flat = np.ravel_multi_index(tuple(coords[idx][keep] for idx in axes_idx), shape)
+        res = np.bincount(flat, weights=self.counts[keep], minlength=int(np.prod(shape)))
+
+        return res.astype(np.int64).reshape(shape)
+
+    def save(self, path):
+        """
+        Save the cube to a NumPy .npz file.
+
+        Args:
+            path (str): output file path
+
+        Returns:
+            None
+        """
+        logger.info(f"Writing count cube to {path}")
+        metadata = {
+            "endpoints": list(self.endpoints),
+            "age_range": [self.age_bins.lower, self.age_bins.upper],
+            "year_range": [self.year_bins.lower, self.year_bins.upper],
+            "max_year": self.max_year,
+        }
+        np.savez(path, cells=self.cells, counts=self.counts, metadata=json.dumps(metadata))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a cube saved with `CountCube.save()`.
+
+        Args:
+            path (str): file path of the cube
+
+        Returns:
+            cube (CountCube): count cube of the first events
+        """
+        with np.load(path) as data:
+            metadata = json.loads(str(data["metadata"]))
+            return cls(
+                metadata["endpoints"],
+                CubeBins(*metadata["age_range"]),
+                CubeBins(*metadata["year_range"]),
+                metadata["max_year"],
+                data["cells"],
+                data["counts"],
+            )
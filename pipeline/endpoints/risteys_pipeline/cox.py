@@ -0,0 +1,352 @@
+"""
+Weighted Cox proportional hazards model for the case-cohort designs.
+
+A Newton-Raphson fitter with Breslow ties, observation weights, left
+truncation (entry times) and a robust sandwich variance, computed with
+NumPy cumulative sums over the event times instead of per-row loops.
+
+`WeightedCoxPH` mirrors the parts of lifelines `CoxPHFitter` used in the
+pipeline (`fit`, `params_`, `standard_errors_`, `summary`, `_norm_mean`,
+`baseline_cumulative_hazard_`, `predict_survival_function`), so it can be
+used in its place. Without entry times the results agree with lifelines
+for data without tied event times, see scripts/benchmark_cox.py.
+With entry times, the robust variance and the baseline hazard only count
+the subjects at risk, while lifelines ignores the entry times in both.
+"""
+
+import warnings
+import numpy as np
+import pandas as pd
+from scipy import linalg, stats
+from lifelines.exceptions import ConvergenceError, ConvergenceWarning
+
+
+class RiskSets:
+    """
+    Risk sets of the subjects at the distinct event times.
+
+    Subject i is at risk at event time t if entry_i < t <= duration_i.
+    Sums over the risk sets are computed with a difference array over the
+    event times, in O(n) per summed quantity.
+
+    Attributes:
+        times (ndarray): distinct event times
+        start (ndarray): first event time index at which each subject is at risk
+        stop (ndarray): event time index after the last one at which each subject is at risk
+        event (ndarray): event time index of the subjects with an event
+        counts (ndarray): weighted number of events at each event time
+    """
+
+    def __init__(self, durations, events, weights, entries):
+        self.times = np.unique(durations[events])
+        self.start = np.searchsorted(self.times, entries, side="right")
+        self.stop = np.searchsorted(self.times, durations, side="right")
+        # Subjects leaving before entering any risk set are never at risk
+        self.stop = np.maximum(self.stop, self.start)
+        self.event = self.stop[events] - 1
+        self.counts = np.bincount(self.event, weights=weights[events], minlength=self.times.shape[0])
+
+    def sum(self, values):
+        """
+        Sum values over the risk set of each event time.
+
+        Args:
+            values (ndarray): (n_subjects, m) values
+
+        Returns:
+            sums (ndarray): (n_times, m) sums
+        """
+        n_times = self.times.shape[0]
+        res = np.empty((n_times, values.shape[1]))
+        for j in range(values.shape[1]):
+            diff = np.bincount(self.start, weights=values[:, j], minlength=n_times + 1)
+            diff -= np.bincount(self.stop, weights=values[:, j], minlength=n_times + 1)
+            res[:, j] = np.cumsum(diff[:n_times])
+        return res
+
+    def cumulative(self, values):
+        """
+        Sum values over the event times at which each subject is at risk.
+
+        Args:
+            values (ndarray): (n_times, m) values
+
+        Returns:
+            sums (ndarray): (n_subjects, m) sums
+        """
+        cum_values = np.concatenate([np.zeros((1, values.shape[1])), np.cumsum(values, axis=0)])
+        return cum_values[self.stop] - cum_values[self.start]
+
+
+def breslow_derivatives(Z, weights, events, risk_sets, beta):
+    """
+    Breslow partial log-likelihood and its derivatives.
+
+    Args:
+        Z (ndarray): (n, d) normalized covariates
+        weights (ndarray): observation weights
+        events (ndarray): boolean event indicators
+        risk_sets (RiskSets): risk sets of the event times
+        beta (ndarray): coefficients of the normalized covariates
+
+    Returns:
+        (ll, gradient, information, S0, xbar) (tuple): log-likelihood, its
+            gradient, the observed information matrix, and the weighted
+            relative risk sum and covariate mean of each risk set
+    """
+    n, d = Z.shape
+    eta = Z @ beta
+    # Shifting the linear predictor cancels out in the partial likelihood
+    shift = eta.max() if n > 0 else 0.0
+    wphi = weights * np.exp(eta - shift)
+
+    S0 = risk_sets.sum(wphi[:, np.newaxis])[:, 0]
+    S1 = risk_sets.sum(wphi[:, np.newaxis] * Z)
+    S2 = risk_sets.sum((wphi[:, np.newaxis, np.newaxis] * Z[:, :, np.newaxis] * Z[:, np.newaxis, :]).reshape(n, d * d))
+    S2 = S2.reshape(-1, d, d)
+
+    counts = risk_sets.counts
+    xbar = S1 / S0[:, np.newaxis]
+    ll = np.sum(weights[events] * eta[events]) - np.sum(counts * (np.log(S0) + shift))
+    gradient = np.sum(weights[events, np.newaxis] * Z[events], axis=0) - counts @ xbar
+    information = np.einsum("k,kij->ij", counts / S0, S2) - np.einsum("k,ki,kj->ij", counts, xbar, xbar)
+
+    return ll, gradient, information, S0, xbar
+
+
+class WeightedCoxPH:
+    """
+    Weighted Cox PH model with Breslow ties, see the module docstring.
+
+    Attributes after `fit()`:
+        params_ (Series): coefficients
+        standard_errors_ (Series): standard errors, robust if fitted with `robust=True`
+        variance_matrix_ (DataFrame): variance matrix of the coefficients
+        log_likelihood_ (float): partial log-likelihood at the estimate
+        n_iterations_ (int): number of Newton-Raphson iterations
+        baseline_hazard_ (DataFrame): baseline hazard at each duration
+        baseline_cumulative_hazard_ (DataFrame): baseline cumulative hazard at each duration
+        summary (DataFrame): coef, exp(coef), se(coef), confidence intervals, z and p
+    """
+
+    def __init__(self, alpha=0.05):
+        self.alpha = alpha
+
+    def fit(
+        self,
+        df,
+        duration_col,
+        event_col,
+        weights_col=None,
+        entry_col=None,
+        robust=False,
+        step_size=1.0,
+        initial_point=None,
+        precision=1e-7,
+        r_precision=1e-9,
+        max_steps=500,
+    ):
+        """
+        Fit the model with Newton-Raphson iterations.
+
+        Covariates are all the columns other than the duration, event,
+        weights and entry columns. They are normalized by their mean and
+        standard deviation during the fit, as lifelines does.
+
+        Args:
+            df (DataFrame): survival dataset
+            duration_col (str): column of the durations
+            event_col (str): column of the event indicators
+            weights_col (str, optional): column of the observation weights
+            entry_col (str, optional): column of the entry times, for left truncation
+            robust (bool): use the robust sandwich variance
+            step_size (float): maximum step size of the Newton-Raphson iterations
+            initial_point (ndarray, optional): initial coefficients of the normalized covariates, as in lifelines, zero by default
+            precision (float): convergence threshold of the step norm and Newton decrement
+            r_precision (float): convergence threshold of the relative log-likelihood change
+            max_steps (int): maximum number of iterations
+
+        Returns:
+            self (WeightedCoxPH): fitted model
+
+        Raises:
+            ValueError: an entry time is after the duration
+            ConvergenceError: the derivatives are not finite or the information matrix is singular
+
+        Warns:
+            ConvergenceWarning: the iterations stalled or reached `max_steps` before converging
+        """
+        special_cols = [col for col in [duration_col, event_col, weights_col, entry_col] if col is not None]
+        covariates = pd.Index([col for col in df.columns if col not in special_cols], name="covariate")
+
+        X = df[covariates].to_numpy(dtype=float)
+        durations = df[duration_col].to_numpy(dtype=float)
+        events = df[event_col].to_numpy().astype(bool)
+        weights = df[weights_col].to_numpy(dtype=float) if weights_col is not None else np.ones(X.shape[0])
+        entries = df[entry_col].to_numpy(dtype=float) if entry_col is not None else np.full(X.shape[0], -np.inf)
+
+        if (entries > durations).any():
+            raise ValueError("Entry times must not be after the durations")
+
+        self._norm_mean = pd.Series(X.mean(axis=0), index=covariates)
+        self._norm_std = pd.Series(X.std(axis=0, ddof=1), index=covariates)
+        Z = (X - self._norm_mean.values) / self._norm_std.values
+
+        risk_sets = RiskSets(durations, events, weights, entries)
+        if initial_point is not None:
+            beta = np.array(initial_point, dtype=float)
+        else:
+            beta = np.zeros(X.shape[1])
+
+        ll, gradient, information, S0, xbar = self._derivatives(Z, weights, events, risk_sets, beta)
+        converged = False
+        for i in range(max_steps):
+            try:
+                delta = linalg.solve(information, gradient, assume_a="pos", check_finite=False)
+            except (ValueError, linalg.LinAlgError) as e:
+                raise ConvergenceError("Information matrix is singular, suspicion is high collinearity", e)
+
+            newton_decrement = gradient @ delta / 2
+            if np.linalg.norm(delta) < precision or newton_decrement < precision:
+                converged = True
+                break
+
+            # Halve the step until the log-likelihood does not decrease
+            step = step_size
+            while step >= 1e-5:
+                beta_new = beta + step * delta
+                ll_new, gradient_new, information_new, S0_new, xbar_new = self._derivatives(
+                    Z, weights, events, risk_sets, beta_new
+                )
+                if ll_new >= ll - abs(ll) * r_precision:
+                    break
+                step /= 2
+            else:
+                # Stalled: no step improves the log-likelihood, keep the current
+                # coefficients and report the fit as not converged
+                break
+
+            beta = beta_new
+            converged = abs(ll_new - ll) / max(abs(ll), 1e-300) < r_precision
+            ll, gradient, information, S0, xbar = ll_new, gradient_new, information_new, S0_new, xbar_new
+            if converged:
+                break
+
+        if not converged:
+            warnings.warn("Newton-Raphson failed to converge sufficiently", ConvergenceWarning)
+
+        self.n_iterations_ = i + 1
+        self.log_likelihood_ = ll
+        self.params_ = pd.Series(beta / self._norm_std.values, index=covariates, name="coef")
+
+        # Variance matrices of the normalized coefficients
+        variance = linalg.inv(information)
+        if robust:
+            score = self._score_residuals(Z, weights, events, risk_sets, beta, S0, xbar)
+            delta_betas = score @ variance
+            variance = delta_betas.T @ delta_betas
+        scale = np.outer(self._norm_std.values, self._norm_std.values)
+        self.variance_matrix_ = pd.DataFrame(variance / scale, index=covariates, columns=covariates)
+        self.standard_errors_ = pd.Series(np.sqrt(np.diag(self.variance_matrix_.values)), index=covariates, name="se")
+
+        self.baseline_hazard_ = self._baseline_hazard(Z @ beta, durations, events, weights, entries)
+        self.baseline_cumulative_hazard_ = self.baseline_hazard_.cumsum().rename(
+            columns={"baseline hazard": "baseline cumulative hazard"}
+        )
+
+        return self
+
+    @staticmethod
+    def _derivatives(Z, weights, events, risk_sets, beta):
+        res = breslow_derivatives(Z, weights, events, risk_sets, beta)
+        if not (np.isfinite(res[0]) and np.isfinite(res[1]).all() and np.isfinite(res[2]).all()):
+            raise ConvergenceError("Log-likelihood or its derivatives contain nan or inf value(s)")
+        return res
+
+    @staticmethod
+    def _score_residuals(Z, weights, events, risk_sets, beta, S0, xbar):
+        """Weighted score residuals of the normalized coefficients, one row per subject"""
+        phi = np.exp(Z @ beta - (Z @ beta).max())
+        # Same shift as in breslow_derivatives(), so phi / S0 is unaffected
+        hazard = risk_sets.counts / S0
+        A = risk_sets.cumulative(hazard[:, np.newaxis])
+        B = risk_sets.cumulative(hazard[:, np.newaxis] * xbar)
+
+        score = -phi[:, np.newaxis] * (Z * A - B)
+        score[events] += Z[events] - xbar[risk_sets.event]
+
+        return score * weights[:, np.newaxis]
+
+    @staticmethod
+    def _baseline_hazard(log_partial_hazard, durations, events, weights, entries):
+        """Breslow baseline hazard at each distinct duration"""
+        timeline = np.unique(durations)
+        start = np.searchsorted(timeline, entries, side="right")
+        stop = np.maximum(np.searchsorted(timeline, durations, side="right"), start)
+        n_times = timeline.shape[0]
+
+        wphi = weights * np.exp(log_partial_hazard)
+        at_risk = np.cumsum(
+            np.bincount(start, weights=wphi, minlength=n_times + 1)
+            - np.bincount(stop, weights=wphi, minlength=n_times + 1)
+        )[:n_times]
+        n_events = np.bincount(stop[events] - 1, weights=weights[events], minlength=n_times)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            hazard = np.where(n_events > 0, n_events / at_risk, 0.0)
+
+        return pd.DataFrame({"baseline hazard": hazard}, index=timeline)
+
+    @property
+    def hazard_ratios_(self):
+        return pd.Series(np.exp(self.params_), index=self.params_.index, name="exp(coef)")
+
+    @property
+    def summary(self):
+        ci = 100 * (1 - self.alpha)
+        z = stats.norm.ppf(1 - self.alpha / 2)
+        se = self.standard_errors_
+
+        df = pd.DataFrame(index=self.params_.index)
+        df["coef"] = self.params_
+        df["exp(coef)"] = self.hazard_ratios_
+        df["se(coef)"] = se
+        df["coef lower %g%%" % ci] = self.params_ - z * se
+        df["coef upper %g%%" % ci] = self.params_ + z * se
+        df["exp(coef) lower %g%%" % ci] = self.hazard_ratios_ * np.exp(-z * se)
+        df["exp(coef) upper %g%%" % ci] = self.hazard_ratios_ * np.exp(z * se)
+        df["cmp to"] = 0.0
+        df["z"] = self.params_ / se
+        df["p"] = stats.chi2.sf(df["z"] ** 2, 1)
+        df["-log2(p)"] = -np.log2(df["p"])
+
+        return df
+
+    def predict_partial_hazard(self, df):
+        """Partial hazard exp((x - mean) . params) of each row of `df`"""
+        X = df[self.params_.index].to_numpy(dtype=float)
+        return pd.Series(np.exp((X - self._norm_mean.values) @ self.params_.values), index=df.index)
+
+    def predict_cumulative_hazard(self, df, times=None):
+        """
+        Cumulative hazard of each row of `df`, linearly interpolated at `times`.
+
+        Args:
+            df (DataFrame): covariates
+            times (iterable, optional): times, the durations of the training data by default
+
+        Returns:
+            res (DataFrame): cumulative hazard with the times as index and the rows of `df` as columns
+        """
+        bch = self.baseline_cumulative_hazard_
+        times = bch.index.values if times is None else np.atleast_1d(times).astype(float)
+        baseline = np.interp(times, bch.index.values, bch.iloc[:, 0].values)
+        return pd.DataFrame(
+            np.outer(baseline, self.predict_partial_hazard(df).values),
+            index=times,
+            columns=df.index,
+        )
+
+    def predict_survival_function(self, df, times=None):
+        """Survival function of each row of `df`, see predict_cumulative_hazard()"""
+        return np.exp(-self.predict_cumulative_hazard(df, times))
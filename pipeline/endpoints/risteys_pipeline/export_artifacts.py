@@ -0,0 +1,198 @@
+"""
+Export the pipeline results as one precompressed JSON artifact per endpoint.
+
+Each artifact bundles the results of an endpoint, e.g. key figures,
+distributions, cumulative incidence and mortality, so that the web app can
+serve or import the data of an endpoint with a single file read.
+Artifacts are written gzip and zstd compressed next to an index file
+listing the endpoints and the size of their artifacts.
+
+Usage:
+    python -m risteys_pipeline.export_artifacts \\
+        --key-figures <key_figures.csv> \\
+        --distribution-age <distribution_age.csv> \\
+        --distribution-year <distribution_year.csv> \\
+        --cumulative-incidence <cumulative_incidence.csv> \\
+        --mortality-params <mortality_params.csv> \\
+        --mortality-baseline-cumulative-hazard <mortality_baseline_cumulative_hazard.csv> \\
+        --mortality-counts <mortality_counts.csv> \\
+        <output_dir>
+
+All the results are optional, artifacts contain the given results only.
+"""
+
+import gzip
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pathlib import Path
+from risteys_pipeline.utils.log import logger
+from risteys_pipeline.utils.write_data import distribution_to_dict, to_json_values
+
+# Format of each result in the artifacts:
+# - record: one row per endpoint, as an object
+# - records: any number of rows per endpoint, as a list of objects
+# - distribution: distributions by sex, see distribution_to_dict()
+ARTIFACT_RESULTS = {
+    "stats": "record",
+    "distrib_age": "distribution",
+    "distrib_year": "distribution",
+    "cumulative_incidence": "records",
+    "mortality_params": "records",
+    "mortality_baseline_cumulative_hazard": "records",
+    "mortality_counts": "records",
+}
+
+# File extension of each artifact compression
+ARTIFACT_COMPRESSIONS = {"gzip": ".json.gz", "zstd": ".json.zst"}
+
+INDEX_FILENAME = "index.json"
+
+GZIP_LEVEL = 9
+ZSTD_LEVEL = 19
+
+
+def endpoint_rows(table):
+    """
+    Get the rows of each endpoint, sorting the table once.
+
+    Args:
+        table (DataFrame): results with an `endpoint` column
+
+    Returns:
+        rows (dict): endpoint -> array of row positions, in table order
+    """
+    endpoint_codes, endpoints = pd.factorize(table["endpoint"])
+    order = np.argsort(endpoint_codes, kind="stable")
+    starts = np.flatnonzero(np.diff(endpoint_codes[order], prepend=-1))
+    stops = np.append(starts[1:], order.shape[0])
+
+    return {
+        endpoints[endpoint_codes[order[start]]]: order[start:stop]
+        for start, stop in zip(starts, stops)
+    }
+
+
+def table_records(table, rows):
+    """
+    Convert rows of a table to JSON records, without the endpoint column.
+
+    Args:
+        table (DataFrame): results with an `endpoint` column
+        rows (ndarray): row positions
+
+    Returns:
+        records (list): one dict per row
+    """
+    columns = [column for column in table.columns if column != "endpoint"]
+    values = [to_json_values(table[column].to_numpy()[rows]) for column in columns]
+    return [dict(zip(columns, row)) for row in zip(*values)]
+
+
+def compress_artifact(data):
+    """
+    Compress an artifact with all the compressions in ARTIFACT_COMPRESSIONS.
+
+    gzip output has no timestamp, so identical artifacts give identical files.
+
+    Args:
+        data (bytes): uncompressed artifact
+
+    Returns:
+        res (dict): compression -> compressed data
+    """
+    return {
+        "gzip": gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0),
+        "zstd": pa.Codec("zstd", compression_level=ZSTD_LEVEL).compress(data, asbytes=True),
+    }
+
+
+def write_endpoint_artifacts(results, output_dir):
+    """
+    Write one compressed JSON artifact per endpoint and the index file.
+
+    The artifact of an endpoint is an object with the endpoint name and
+    its result for each result name in `results`.
+    Results without data for the endpoint are null for a record and empty
+    otherwise.
+
+    Args:
+        results (dict): result name in ARTIFACT_RESULTS -> DataFrame with an `endpoint` column
+        output_dir (Path): output directory, created if needed
+
+    Returns:
+        index (dict): content of the index file
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    results_rows = {}
+    for name, table in results.items():
+        if name not in ARTIFACT_RESULTS:
+            raise ValueError(f"Unknown result {name}, must be one of {list(ARTIFACT_RESULTS)}")
+        if ARTIFACT_RESULTS[name] == "distribution":
+            results_rows[name] = distribution_to_dict(table)
+        else:
+            results_rows[name] = endpoint_rows(table)
+
+    endpoints = sorted(set().union(*[rows.keys() for rows in results_rows.values()]))
+    logger.info(f"Writing artifacts of {len(endpoints)} endpoints to {output_dir}")
+
+    index = {
+        "results": list(results),
+        "compressions": ARTIFACT_COMPRESSIONS,
+        "endpoints": {},
+    }
+    for endpoint in endpoints:
+        artifact = {"endpoint": endpoint}
+        for name, rows in results_rows.items():
+            result_format = ARTIFACT_RESULTS[name]
+            if result_format == "distribution":
+                artifact[name] = rows.get(endpoint, {"all": [], "female": [], "male": []})
+            elif endpoint not in rows:
+                artifact[name] = None if result_format == "record" else []
+            else:
+                records = table_records(results[name], rows[endpoint])
+                artifact[name] = records[0] if result_format == "record" else records
+
+        data = json.dumps(artifact).encode("utf-8")
+        sizes = {"json": len(data)}
+        for compression, compressed in compress_artifact(data).items():
+            (output_dir / (endpoint + ARTIFACT_COMPRESSIONS[compression])).write_bytes(compressed)
+            sizes[compression] = len(compressed)
+        index["endpoints"][endpoint] = sizes
+
+    with open(output_dir / INDEX_FILENAME, "w") as f:
+        json.dump(index, f)
+
+    return index
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export per-endpoint compressed JSON artifacts")
+    parser.add_argument("output_dir", type=Path, help="output directory of the artifacts")
+    arguments = {
+        "stats": "--key-figures",
+        "distrib_age": "--distribution-age",
+        "distrib_year": "--distribution-year",
+        "cumulative_incidence": "--cumulative-incidence",
+        "mortality_params": "--mortality-params",
+        "mortality_baseline_cumulative_hazard": "--mortality-baseline-cumulative-hazard",
+        "mortality_counts": "--mortality-counts",
+    }
+    for name, argument in arguments.items():
+        parser.add_argument(argument, dest=name, type=Path, help=f"CSV file of the {name} result")
+    args = parser.parse_args()
+
+    results = {
+        name: pd.read_csv(getattr(args, name))
+        for name in arguments
+        if getattr(args, name) is not None
+    }
+    if not results:
+        parser.error("at least one result file is required")
+
+    write_endpoint_artifacts(results, args.output_dir)
@@ -3,36 +3,72 @@ from pathlib import Path
 
 import numpy as np
 import pandas as pd
+import pyarrow.parquet as parquet
 
+from risteys_pipeline.utils.cache import load_with_cache
 from risteys_pipeline.utils.log import logger
+from risteys_pipeline.utils.persons import (
+    UNKNOWN_PERSON,
+    build_person_dictionary,
+    encode_personid,
+    take_demographics,
+)
 from risteys_pipeline.utils.utils import log_if_diff
 
 
+DEATH_ENDPOINT = "DEATH"
+
+
 def load_data(
         definitions_path,
         minimal_phenotype_path,
         covariates_path,
         long_format_first_events_path,
-        detailed_longitudinal_path
+        detailed_longitudinal_path,
+        cache_dir=None
 ):
     """Load input data from original files to pandas DataFrames.
 
     The resulting DataFrames are compliant with the format used for
     the next pipeline steps.
+
+    If `cache_dir` is given, the DataFrames are cached there as Arrow
+    files and reused by later runs with the same input files and config.
     """
+    input_paths = [
+        definitions_path,
+        minimal_phenotype_path,
+        covariates_path,
+        long_format_first_events_path,
+        detailed_longitudinal_path
+    ]
+    return load_with_cache(load_data_from_source, input_paths, cache_dir, *input_paths)
+
+
+def load_data_from_source(
+        definitions_path,
+        minimal_phenotype_path,
+        covariates_path,
+        long_format_first_events_path,
+        detailed_longitudinal_path
+):
+    """Load input data from the original files, see load_data()"""
     df_definitions = load_endpoint_definitions(definitions_path)
     df_fgid_covariates = load_fgid_covariates(covariates_path)
+    df_fevents, df_death = scan_first_events(
+        long_format_first_events_path,
+        df_definitions,
+        df_fgid_covariates
+    )
     df_minimal_phenotype = load_minimal_phenotype_data(
         minimal_phenotype_path,
-        long_format_first_events_path,
+        df_death,
         detailed_longitudinal_path,
         df_fgid_covariates
     )
     df_first_events = load_first_events_data(
-        long_format_first_events_path,
-        df_definitions,
-        df_minimal_phenotype,
-        df_fgid_covariates
+        df_fevents,
+        df_minimal_phenotype
     )
 
     logger.info("Done loading data")
@@ -104,9 +140,38 @@ def load_fgid_covariates(covariates_path):
     return df_cov
 
 
+def scan_first_events(long_format_fevents_path, df_definitions, df_fgid_covariates):
+    """Read the long-format first-events file in a single scan.
+
+    The filtering on individuals of the covariates file and on studied
+    endpoints, and the column selection, are pushed down to the Parquet
+    reader, which reads the row groups using multiple threads.
+    The DEATH rows are split off from the same scan.
+    """
+    logger.info("Scanning long-format first-events data")
+    endpoints = set(df_definitions.endpoint) | {DEATH_ENDPOINT}
+    table = parquet.read_table(
+        long_format_fevents_path,
+        columns=["FINNGENID", "ENDPOINT", "AGE"],
+        filters=[
+            ("FINNGENID", "in", set(df_fgid_covariates.FINNGENID)),
+            ("ENDPOINT", "in", endpoints),
+        ],
+        use_threads=True,
+    )
+    df = table.to_pandas()
+    logger.debug(f"{df.shape[0]:,} rows read from first-events data")
+
+    is_death = df.ENDPOINT == DEATH_ENDPOINT
+    df_death = df.loc[is_death, ["FINNGENID", "AGE"]]
+    df_fevents = df.loc[df.ENDPOINT.isin(df_definitions.endpoint), :]
+
+    return df_fevents, df_death
+
+
 def load_minimal_phenotype_data(
         minimal_phenotype_path,
-        long_format_fevents_path,
+        df_death,
         detailed_longit_path,
         df_fgid_covariates
 ):
@@ -116,7 +181,10 @@ def load_minimal_phenotype_data(
     the FinnGen minimal phenotype file. In particular the following
     information is taken elsewhere:
     - birth year: from the detailed longitudinal data
-    - death age: from the endpoint first-event data
+    - death age: from the DEATH rows of the endpoint first-event data
+
+    FINNGENIDs are encoded as dense integer codes in `personid`, the
+    original IDs are kept in `person`.
     """
     logger.info("Loading minimal phenotype data")
 
@@ -138,7 +206,7 @@ def load_minimal_phenotype_data(
 
     # Get birth and death info
     df_birth_year = get_birth_year(df_minim)
-    df_death_age = get_death_age(long_format_fevents_path, df_fgid_covariates)
+    df_death_age = get_death_age(df_death)
 
     # Combine minim & birth year info
     df_out = df_minim.merge(df_birth_year, on="FINNGENID", how="outer")
@@ -153,7 +221,7 @@ def load_minimal_phenotype_data(
         df_out = df_out.loc[~df_out.birth_year.isna(), :]
 
     # Combine with death info
-    df_out = df_out.merge(df_death_age, on="FINNGENID", how="outer")
+    df_out = df_out.merge(df_death_age, on="FINNGENID", how="left")
 
     # Derive output columns
     df_out["death_year"] = df_out.birth_year + df_out.death_age
@@ -165,6 +233,7 @@ def load_minimal_phenotype_data(
     # Reshape output to be compliant with the pipeline
     df_out = df_out.rename(columns={"FINNGENID": "personid"})
     df_out = df_out.drop(columns=["death_age", "SEX"])
+    df_out = build_person_dictionary(df_out)
 
     return df_out
 
@@ -179,74 +248,45 @@ def get_birth_year(df_minimal_phenotype):
     return df
 
 
-def get_death_age(long_format_fevents_path, df_fgid_covariates):
-    """Get the death age of individuals from the DEATH endpoint"""
-    logger.debug("Getting death age for all individuals using long-format first-events data")
-    df = pd.read_parquet(long_format_fevents_path)
-
-    df["death_age"] = np.nan
-    df.loc[df.ENDPOINT == "DEATH", "death_age"] = df.loc[df.ENDPOINT == "DEATH", "AGE"]
-
-    # Only keep individuals that are in the covariates file
-    with log_if_diff("persons to get death age (fgid cov. filtering)", lambda: df.FINNGENID.unique().shape[0]):
-        df = df.loc[df.FINNGENID.isin(df_fgid_covariates.FINNGENID), :]
-
+def get_death_age(df_death):
+    """Get the death age of individuals from the DEATH endpoint rows"""
+    logger.debug("Getting death age from the DEATH rows of the first-events data")
     out = (
-        df
-        .groupby("FINNGENID")
-        .first("death_age")
-        .death_age
-        .reset_index()
+        df_death
+        .rename(columns={"AGE": "death_age"})
+        .drop_duplicates(subset=["FINNGENID"])
+        .reset_index(drop=True)
     )
     return out
 
 
-def load_first_events_data(
-        long_format_fevents_path,
-        df_definitions,
-        df_minimal_phenotype,
-        df_fgid_covariates
-):
-    """Load and validate the long-format endpoint first-events file"""
-    logger.info("Loading first-events data")
-    df_fevents = pd.read_parquet(long_format_fevents_path)
+def load_first_events_data(df_fevents, df_minimal_phenotype):
+    """Validate and reshape the first events from scan_first_events().
 
-    # Only keep individuals that are in the covariates file
-    with log_if_diff(
-            "persons in first-events (fgid cov. filtering)",
-            lambda: df_fevents.FINNGENID.unique().shape[0]
-    ):
-        df_fevents = df_fevents.loc[df_fevents.FINNGENID.isin(df_fgid_covariates.FINNGENID), :]
+    Person IDs are encoded with the codes of the minimal phenotype.
+    Demographics are not merged onto the events, they can be looked up
+    with take_demographics().
+    """
+    logger.info("Loading first-events data")
 
     # Reshape dataframe to be compliant with the pipeline
-    df_fevents = df_fevents.drop(columns=[
-        "CONTROL_CASE_EXCL",
-        "NEVT",
-        "APPROX_EVENT_DAY"
-    ])
     df_fevents = df_fevents.rename(columns={
         "FINNGENID": "personid",
         "ENDPOINT": "endpoint",
         "AGE": "age",
     })
+    df_fevents = df_fevents.reset_index(drop=True)
+    logger.info(f"{df_fevents.endpoint.unique().shape[0]:,} endpoints in first-events data")
 
-    # In FinnGen there is no concept of index person, so we mark all as being index persons
-    df_fevents["index_person"] = True
-
-    # Remove endpoints that we will not study
-    with log_if_diff("endpoints (subsetting)", lambda: df_fevents.endpoint.unique().shape[0]):
-        df_fevents = df_fevents.loc[df_fevents.endpoint.isin(df_definitions.endpoint), :]
-
-    # Add birth, death, and sex info
-    with log_if_diff("events (merging w/ min.pheno)", lambda: df_fevents.shape[0]), log_if_diff("persons (merging w/ min.pheno)", lambda: df_fevents.personid.unique().shape[0]):
-        df_fevents = df_fevents.merge(
-            df_minimal_phenotype.loc[:, ["personid", "birth_year", "death_year", "female"]],
-            on="personid",
-            how="left"
-        )
+    # Encode persons with the minimal phenotype codes
+    df_fevents["personid"] = encode_personid(df_fevents.personid, df_minimal_phenotype)
+    n_unknown = df_fevents.loc[df_fevents.personid == UNKNOWN_PERSON, :].shape[0]
+    if n_unknown != 0:
+        logger.warning(f"Keeping {n_unknown} events of persons not in the minimal phenotype")
 
     # Compute more accurate year of endpoint onset
-    df_fevents["year"] = df_fevents.birth_year + df_fevents.age
+    birth_year = take_demographics(df_minimal_phenotype, df_fevents.personid, ["birth_year"])
+    df_fevents["year"] = birth_year.birth_year.values + df_fevents.age.values
 
     return df_fevents
 
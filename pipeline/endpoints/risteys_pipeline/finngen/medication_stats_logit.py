@@ -5,7 +5,7 @@ Compute drug scores related to a given endpoint.
 Usage:
     python3 medication_stats_logit.py \
         <ENDPOINT> \                  # FinnGen endpoint for which to compute associated drug scores
-        <PATH_FIRST_EVENTS> \         # Path to the first events file from FinnGen
+        <PATH_FIRST_EVENTS> \         # Path to the first events file from FinnGen, or to its Parquet mirror
         <PATH_DETAILED_LONGIT> \      # Path to the detailed longitudinal file from FinnGen
         <PATH_ENDPOINT_DEFINITIONS \  # Path to the endpoint definitions file from FinnGen
         <PATH_MINIMUM_INFO> \         # Path to the minimum file from FinnGen
@@ -15,6 +15,10 @@ Outputs:
 - <ENDPOINT>_scores.csv: CSV file with score and standard error for each drug
 - <ENDPOINT>_counts.csv: CSV file which breakdowns drugs into their full ATC and counts how the
   number of individuals.
+
+The Parquet mirror of the first events file is made once with
+`wide_to_long_endpoint_first_events.py --parquet-mirror`. Reading it instead
+of the CSV avoids parsing the whole file for each endpoint.
 """
 
 import csv
@@ -120,15 +124,17 @@ def load_data(fg_endpoint, first_events, detailed_longit, endpoint_defs, minimum
 
     # FIRST-EVENT DATA (for logit model)
     logger.info("Loading endpoint data")
-    df_endpoint = pd.read_csv(
-        first_events,
-        usecols=[
-            "FINNGENID",
-            fg_endpoint,
-            fg_endpoint_age,
-            fg_endpoint_year
-        ]
-    )
+    endpoint_cols = [
+        "FINNGENID",
+        fg_endpoint,
+        fg_endpoint_age,
+        fg_endpoint_year
+    ]
+    if first_events.suffix == ".parquet":
+        # Parquet mirror of the first-event file: only the endpoint columns are read
+        df_endpoint = pd.read_parquet(first_events, columns=endpoint_cols)
+    else:
+        df_endpoint = pd.read_csv(first_events, usecols=endpoint_cols)
     # Rename endpoint columns to genereic names for either reference down the line
     df_endpoint = df_endpoint.rename(columns={
         fg_endpoint: "fg_endpoint",
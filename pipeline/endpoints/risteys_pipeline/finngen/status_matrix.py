@@ -0,0 +1,177 @@
+"""
+Packed control/case/excluded status matrix of the FinnGen endpoints.
+
+The status of every individual for every endpoint is stored at 2 bits per
+cell, so the full FinnGen matrix (~500k individuals x ~5000 endpoints) takes
+~600 MB on disk and is memory-mapped instead of being loaded.
+
+Directory layout
+----------------
+- status.npy: uint8 array of shape (n_endpoints, ceil(n_persons / 4)),
+  each byte holds the status of 4 consecutive individuals for one endpoint,
+  individual i being in the bits 2*(i % 4) and 2*(i % 4) + 1.
+- persons.txt: FinnGen IDs, one per line, in matrix order
+- endpoints.txt: endpoint names, one per line, in matrix order
+
+The matrix is endpoint-major: reading one endpoint is a contiguous read,
+reading one individual touches one byte per endpoint.
+"""
+
+from pathlib import Path
+
+import numpy as np
+
+# Status codes, same as the CONTROL_CASE_EXCL column of the long-format file
+STATUS_CONTROL = 0
+STATUS_CASE = 1
+STATUS_EXCL_CONTROL = 2
+
+PERSONS_PER_BYTE = 4
+STATUS_FILE = "status.npy"
+PERSONS_FILE = "persons.txt"
+ENDPOINTS_FILE = "endpoints.txt"
+
+
+def pack_status(status):
+    """
+    Pack a status matrix at 2 bits per cell.
+
+    Args:
+        status (ndarray): (n_persons, n_endpoints) matrix of status codes,
+            n_persons must be a multiple of PERSONS_PER_BYTE
+
+    Returns:
+        packed (ndarray): (n_endpoints, n_persons / 4) uint8 matrix
+    """
+    n_persons, n_endpoints = status.shape
+    status = status.T.astype(np.uint8).reshape(n_endpoints, n_persons // PERSONS_PER_BYTE, PERSONS_PER_BYTE)
+    packed = np.zeros(status.shape[:2], dtype=np.uint8)
+    for shift in range(PERSONS_PER_BYTE):
+        packed |= status[:, :, shift] << (2 * shift)
+    return packed
+
+
+def unpack_status(packed, n_persons):
+    """
+    Unpack rows of a packed status matrix.
+
+    Args:
+        packed (ndarray): (n_endpoints, n_bytes) uint8 matrix
+        n_persons (int): number of individuals to unpack
+
+    Returns:
+        status (ndarray): (n_endpoints, n_persons) int8 matrix of status codes
+    """
+    shifts = np.arange(PERSONS_PER_BYTE, dtype=np.uint8) * 2
+    status = (packed[:, :, np.newaxis] >> shifts) & 0b11
+    status = status.reshape(packed.shape[0], -1)[:, :n_persons]
+    return status.astype(np.int8)
+
+
+class StatusMatrixWriter:
+    """
+    Write a status matrix block by block of individuals.
+
+    The number of individuals must be known in advance, as the
+    endpoint-major matrix is allocated on disk before writing.
+    """
+
+    def __init__(self, output_dir, endpoints, n_persons):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.endpoints = list(endpoints)
+        self.n_persons = n_persons
+        self.persons = []
+        self._matrix = np.lib.format.open_memmap(
+            self.output_dir / STATUS_FILE,
+            mode="w+",
+            dtype=np.uint8,
+            shape=(len(self.endpoints), -(-n_persons // PERSONS_PER_BYTE))
+        )
+        self._byte_pos = 0
+        # Individuals not yet written as they don't fill a byte
+        self._pending = np.empty((0, len(self.endpoints)), dtype=np.int8)
+
+    def write(self, persons, status):
+        """
+        Append a block of individuals.
+
+        Args:
+            persons (list): FinnGen IDs of the block
+            status (ndarray): (len(persons), n_endpoints) matrix of status codes
+        """
+        self.persons.extend(persons)
+        status = np.concatenate([self._pending, status])
+        n_full = status.shape[0] - status.shape[0] % PERSONS_PER_BYTE
+        self._write_packed(status[:n_full])
+        self._pending = status[n_full:]
+
+    def close(self):
+        """Write the remaining individuals and the person and endpoint dictionaries"""
+        if len(self.persons) != self.n_persons:
+            raise ValueError(f"Expected {self.n_persons} individuals, got {len(self.persons)}.")
+
+        if self._pending.shape[0] > 0:
+            padding = np.zeros(
+                (PERSONS_PER_BYTE - self._pending.shape[0], len(self.endpoints)),
+                dtype=np.int8
+            )
+            self._write_packed(np.concatenate([self._pending, padding]))
+        self._matrix.flush()
+        del self._matrix
+
+        (self.output_dir / PERSONS_FILE).write_text("".join(f"{person}\n" for person in self.persons))
+        (self.output_dir / ENDPOINTS_FILE).write_text("".join(f"{endp}\n" for endp in self.endpoints))
+
+    def _write_packed(self, status):
+        packed = pack_status(status)
+        self._matrix[:, self._byte_pos:self._byte_pos + packed.shape[1]] = packed
+        self._byte_pos += packed.shape[1]
+
+
+class StatusMatrix:
+    """
+    Memory-mapped status matrix written by StatusMatrixWriter.
+
+    Attributes:
+        persons (list): FinnGen IDs in matrix order
+        endpoints (list): endpoint names in matrix order
+    """
+
+    def __init__(self, input_dir):
+        input_dir = Path(input_dir)
+        self.persons = (input_dir / PERSONS_FILE).read_text().splitlines()
+        self.endpoints = (input_dir / ENDPOINTS_FILE).read_text().splitlines()
+        self._matrix = np.load(input_dir / STATUS_FILE, mmap_mode="r")
+        self._person_index = None
+        self._endpoint_index = {endp: idx for idx, endp in enumerate(self.endpoints)}
+
+    def endpoint(self, endpoint):
+        """
+        Get the status of all the individuals for `endpoint`.
+
+        Args:
+            endpoint (str): endpoint name
+
+        Returns:
+            status (ndarray): int8 status codes, in the order of `persons`
+        """
+        idx = self._endpoint_index[endpoint]
+        return unpack_status(self._matrix[idx:idx + 1], len(self.persons))[0]
+
+    def person(self, personid):
+        """
+        Get the status of an individual for all the endpoints.
+
+        Args:
+            personid (str): FinnGen ID
+
+        Returns:
+            status (ndarray): int8 status codes, in the order of `endpoints`
+        """
+        if self._person_index is None:
+            self._person_index = {person: idx for idx, person in enumerate(self.persons)}
+        idx = self._person_index[personid]
+        byte, shift = divmod(idx, PERSONS_PER_BYTE)
+        status = (self._matrix[:, byte] >> (2 * shift)) & 0b11
+        return status.astype(np.int8)
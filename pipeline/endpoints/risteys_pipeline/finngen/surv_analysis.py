@@ -16,7 +16,8 @@ environment. One needs to set the following environment variables (see
 - INPUT_INFO
 - OUTPUT
 - TIMINGS
-and run:
+and optionally COX_FITTER, "lifelines" (default) or "native" to use
+risteys_pipeline.cox.WeightedCoxPH, and run:
   python surv_analysis.py
 
 Input files
@@ -62,18 +63,31 @@ References
     https://plana-ripoll.github.io/NB-COMO/
 """
 import logging
+import warnings
 from csv import writer as csv_writer
 from os import getenv
 from pathlib import Path
-from queue import LifoQueue
 from time import time as now
 
 import numpy as np
 import pandas as pd
-from lifelines import CoxPHFitter
+from lifelines.exceptions import ConvergenceWarning
 from lifelines.utils import ConvergenceError
 from lifelines.utils import interpolate_at_times
 
+# Cox PH fitter, chosen explicitly so that the outputs do not depend on
+# which packages are installed:
+# - "lifelines": lifelines CoxPHFitter, Efron ties, runs in the dsub image
+# - "native": risteys_pipeline.cox.WeightedCoxPH, Breslow ties, requires
+#   the risteys_pipeline package
+COX_FITTER = getenv("COX_FITTER", "lifelines")
+if COX_FITTER == "native":
+    from risteys_pipeline.cox import WeightedCoxPH as CoxPHFitter
+elif COX_FITTER == "lifelines":
+    from lifelines import CoxPHFitter
+else:
+    raise ValueError(f"Unknown COX_FITTER {COX_FITTER!r}, expected 'lifelines' or 'native'")
+
 # TODO #
 # Copy-pasted the logging configuration here instead of importing it
 # from log.py.
@@ -106,24 +120,37 @@ class NotEnoughIndividuals(Exception):
     pass
 
 
-# Step size for the fitting algorithm of CoxPHFitter
+# Step size for the fitting algorithm of CoxPHFitter.
+# It is halved after each failed fit, down to MIN_STEP_SIZE.
 DEFAULT_STEP_SIZE = 1.0
-LOWER_STEP_SIZE   = 0.1
+MIN_STEP_SIZE     = 0.0625
+# Start of the warning message of CoxPHFitter when the iterations stop
+# before converging, the only warning leading to a refit
+NOT_CONVERGED_WARNING = "Newton-Raphson failed to converge"
 
 
-# Lag durations (in years)
-# Order (low-to-high) is important for performance later on, since if
+# Lag durations (in years) and their column names for lagged HR.
+# Order (high-to-low) is important for performance later on, since if
 # an endpoint pair doesn't have enough individuals for a duration then
 # lower durations can be discarded directly.
-# Since jobs are kept in a Last-In-First-Out (LIFO) queue, then we
-# need to order them low-to-high in order for the jobs to run the
-# longer durations first.
-LAGS = [
-    [0, 1],
-    [1, 5],
-    [5, 15],
-    None
-]
+LAG_COLS = {
+    None: {
+        "duration": "duration",
+        "outcome": "outcome"
+    },
+    (5, 15): {
+        "duration": "duration_15y",
+        "outcome": "outcome_15y"
+    },
+    (1, 5): {
+        "duration": "duration_5y",
+        "outcome": "outcome_5y"
+    },
+    (0, 1): {
+        "duration": "duration_1y",
+        "outcome": "outcome_1y"
+    }
+}
 
 
 # Used for computing the absolute risk
@@ -143,7 +170,9 @@ def main(path_pairs, path_definitions, path_long_format_fevents, path_info, outp
     # File that keep tracks of how much time was spent on each endpoint
     timings_file = open(timings_path, "x", buffering=line_buffering)
     timings_writer = csv_writer(timings_file)
-    timings_writer.writerow(["prior", "outcome", "lag", "step_size", "time_seconds"])
+    timings_writer.writerow(["prior", "outcome", "lag", "step_size", "attempts", "iterations", "status", "time_seconds"])
+
+    logger.info(f"Fitting the Cox models with the {COX_FITTER} fitter")
 
     # Load all data
     pairs, endpoints, df_events, df_info = load_data(
@@ -153,31 +182,11 @@ def main(path_pairs, path_definitions, path_long_format_fevents, path_info, outp
         path_info
     )
 
-    # Initialize the job queue
-    jobs = LifoQueue()
-    for pair in pairs:
-        for lag in LAGS:
-            jobs.put({"pair": pair, "lag": lag, "step_size": DEFAULT_STEP_SIZE})
-
-    # Keep track if the current endpoint pair needs to be skipped
-    skip = None
-
-    # Run the regression for each job
-    while not jobs.empty():
-        time_start = now()
-
-        # Get job info
-        job = jobs.get()
-        pair = job["pair"]
-        lag = job["lag"]
-        step_size = job["step_size"]
-
-        # Go to next endpoint pair if this one is to be skipped
-        if pair == skip:
-            continue
-
-        logger.info(f"Jobs remaining: ~ {jobs.qsize()}")
-        logger.info(f"[JOB] pair: {pair} | lag: {lag} | step size: {step_size}")
+    # Run the regressions for each endpoint pair.
+    # The data is prepared once per pair, then each lag only selects
+    # its duration and outcome columns.
+    for ith, pair in enumerate(pairs):
+        logger.info(f"Pairs remaining: {len(pairs) - ith}")
         prior, outcome = pair
         is_sex_specific = pd.notna(endpoints.loc[endpoints.NAME == outcome, "SEX"].iloc[0])
 
@@ -188,39 +197,61 @@ def main(path_pairs, path_definitions, path_long_format_fevents, path_info, outp
              df_unexp_exp_p1,
              df_unexp_exp_p2,
              df_tri_p1,
-             df_tri_p2) = prep_coxhr(pair, lag, df_events, df_info)
-
-            nindivs, df_lifelines = prep_lifelines(
-                df_unexp,
-                df_unexp_death,
-                df_unexp_exp_p1,
-                df_unexp_exp_p2,
-                df_tri_p1,
-                df_tri_p2
-            )
-            compute_coxhr(
-                pair,
-                df_lifelines,
-                lag,
-                step_size,
-                is_sex_specific,
-                nindivs,
-                res_writer
-            )
+             df_tri_p2) = prep_coxhr(pair, df_events, df_info)
         except NotEnoughIndividuals as exc:
-            skip = pair  # skip remaining jobs (different lags) for this endpoint pair
             logger.warning(exc)
-        except (ConvergenceError, Warning) as exc:
-            # Retry with a lower step_size
-            if step_size == DEFAULT_STEP_SIZE:
-                step_size = LOWER_STEP_SIZE
-                jobs.put({"pair": pair, "lag": lag, "step_size": step_size})
-            # We already tried with the lower step size, we have to skip this job
-            else:
-                logger.warning(f"Failed to run Cox.fit() for {pair}, lag: {lag}, step size: {step_size}:\n{exc}")
+            continue
         finally:
-            job_time = now() - time_start
-            timings_writer.writerow([prior, outcome, lag, step_size, job_time])
+            timings_writer.writerow([prior, outcome, "prep", None, None, None, None, now() - time_start])
+
+        # Coefficients of the converged no-lag fit, used as a warm start for the lagged fits
+        params_no_lag = None
+        for lag, cols in LAG_COLS.items():
+            logger.info(f"[JOB] pair: {pair} | lag: {lag}")
+            time_start = now()
+            fit_info = {"step_size": None, "attempts": 0, "iterations": None, "status": "skipped"}
+            try:
+                nindivs, df_lifelines = prep_lifelines(
+                    cols,
+                    df_unexp,
+                    df_unexp_death,
+                    df_unexp_exp_p1,
+                    df_unexp_exp_p2,
+                    df_tri_p1,
+                    df_tri_p2
+                )
+                params, fit_info = compute_coxhr(
+                    pair,
+                    df_lifelines,
+                    lag,
+                    is_sex_specific,
+                    nindivs,
+                    res_writer,
+                    initial_params=params_no_lag
+                )
+                # Coefficients of a fit that did not converge, e.g. diverging on
+                # separated data, would be a bad start: the lagged fits then start from zero
+                if lag is None and fit_info["status"] == "converged":
+                    params_no_lag = params
+            except NotEnoughIndividuals as exc:
+                # Skip the remaining, lower, lags for this endpoint pair
+                logger.warning(exc)
+                break
+            except ConvergenceError as exc:
+                fit_info = exc.fit_info
+                logger.warning(f"Failed to run Cox.fit() for {pair}, lag: {lag}, attempts: {fit_info['attempts']}:\n{exc}")
+            finally:
+                lag_value = None if lag is None else list(lag)
+                timings_writer.writerow([
+                    prior,
+                    outcome,
+                    lag_value,
+                    fit_info["step_size"],
+                    fit_info["attempts"],
+                    fit_info["iterations"],
+                    fit_info["status"],
+                    now() - time_start
+                ])
 
     timings_file.close()
     res_file.close()
@@ -245,6 +276,10 @@ def load_data(path_pairs, path_definitions, path_long_format_fevents, path_info)
     df_info["BIRTH_TYEAR"] = df_info.BL_YEAR - df_info.BL_AGE
     df_info = df_info.drop(columns=["SEX", "BL_YEAR", "BL_AGE"])
 
+    # Encode FINNGENIDs as dense integer codes, so the set operations
+    # and merges on FINNGENID work on integers instead of strings.
+    df_info, df_events = encode_finngenid(df_info, df_events)
+
     # Set age at start of study for each indiv.
     df_info["START_AGE"] = df_info.apply(
         lambda r: max(STUDY_STARTS - r.BIRTH_TYEAR, 0.0),
@@ -267,13 +302,25 @@ def load_data(path_pairs, path_definitions, path_long_format_fevents, path_info)
     df_events = df_events.loc[~ df_events.FINNGENID.isin(died_before_study), :]
     df_info = df_info.loc[~ df_info.FINNGENID.isin(died_before_study), :]
 
-    born_after_study = set((df_info.BIRTH_TYEAR > STUDY_ENDS).index)
+    born_after_study = set(df_info.loc[df_info.BIRTH_TYEAR > STUDY_ENDS, "FINNGENID"])
     df_events = df_events.loc[~ df_events.FINNGENID.isin(born_after_study), :]
     df_info = df_info.loc[~ df_info.FINNGENID.isin(born_after_study), :]
 
     return pairs, endpoints, df_events, df_info
 
 
+def encode_finngenid(df_info, df_events):
+    """Replace FINNGENID by an integer code shared by df_info and df_events"""
+    persons = pd.Index(pd.unique(np.concatenate([
+        df_info.FINNGENID.values,
+        df_events.FINNGENID.values
+    ])))
+    df_info = df_info.assign(FINNGENID=persons.get_indexer(df_info.FINNGENID).astype(np.int32))
+    df_events = df_events.assign(FINNGENID=persons.get_indexer(df_events.FINNGENID).astype(np.int32))
+
+    return df_info, df_events
+
+
 def init_csv(res_file):
     res_writer = csv_writer(res_file)
     res_writer.writerow([
@@ -324,7 +371,7 @@ def init_csv(res_file):
     return res_writer
 
 
-def prep_coxhr(pair, lag, df_events, df_info):
+def prep_coxhr(pair, df_events, df_info):
     """Prepare the data to be used in the Cox model.
 
     Example timeline for an individual:
@@ -333,6 +380,9 @@ def prep_coxhr(pair, lag, df_events, df_info):
     |              |      |           |
     |--------------=======XXXXXXXXXXXX|
     [  unexposed  ][     exposed      ]
+
+    The exposed phase has duration and outcome columns for each lag in
+    LAG_COLS, so the lags share one case-cohort sample.
     """
     logger.info(f"Preparing data before Cox fitting for {pair}")
     prior, outcome = pair
@@ -442,21 +492,20 @@ def prep_coxhr(pair, lag, df_events, df_info):
     # Phase 2: exposed
     df_unexp_exp_p2 = df_unexp_exp.copy()
     df_unexp_exp_p2["prior"] = True
-    if lag is None:  # no lag HR
-        duration = df_unexp_exp_p2.END_AGE - df_unexp_exp_p2.PRIOR_AGE
-    else:
-        # Duration of exposure is time from exposure to "end" (death, study stop).
-        # This current cohort (unexposed->exposed) has no one with an
-        # outcome endpoint, so we don't need to do look ahead for an
-        # outcome in a given lag time-window.
-        # The lag is still used to cut the exposure time.
-        _min_lag, max_lag = lag
-        duration = df_unexp_exp_p2.apply(
-            lambda r: min(r.END_AGE - r.PRIOR_AGE, max_lag),
-            axis="columns"
-        )
-    df_unexp_exp_p2["duration"] = duration
-    df_unexp_exp_p2["outcome"] = False
+    exposed_time = df_unexp_exp_p2.END_AGE - df_unexp_exp_p2.PRIOR_AGE
+    for lag, cols in LAG_COLS.items():
+        if lag is None:  # no lag HR
+            duration = exposed_time
+        else:
+            # Duration of exposure is time from exposure to "end" (death, study stop).
+            # This current cohort (unexposed->exposed) has no one with an
+            # outcome endpoint, so we don't need to do look ahead for an
+            # outcome in a given lag time-window.
+            # The lag is still used to cut the exposure time.
+            _min_lag, max_lag = lag
+            duration = np.minimum(exposed_time, max_lag)
+        df_unexp_exp_p2[cols["duration"]] = duration
+        df_unexp_exp_p2[cols["outcome"]] = False
 
     # Unexposed -> Exposed -> Outcome: need time-window splitting
     df_tri = df_sample.loc[df_sample.FINNGENID.isin(unexp_exp_outcome), :].copy()
@@ -468,21 +517,20 @@ def prep_coxhr(pair, lag, df_events, df_info):
     # Phase 2: exposed
     df_tri_p2 = df_tri.copy()
     df_tri_p2["prior"] = True
-    if lag is None:
-        duration = df_tri_p2.END_AGE - df_tri.PRIOR_AGE
-        outcome = True
-    else:
-        min_lag, max_lag = lag
-        # Duration is time from exposure endpoint to end event, no
-        # matter of the lag time-window.
-        duration = df_tri_p2.apply(
-            lambda r: min(r.END_AGE - r.PRIOR_AGE, max_lag),
-            axis="columns"
-        )
-        outcome_time = df_tri_p2.OUTCOME_AGE - df_tri_p2.PRIOR_AGE
-        outcome = (outcome_time >= min_lag) & (outcome_time <= max_lag)
-    df_tri_p2["duration"] = duration
-    df_tri_p2["outcome"] = outcome
+    exposed_time = df_tri_p2.END_AGE - df_tri_p2.PRIOR_AGE
+    outcome_time = df_tri_p2.OUTCOME_AGE - df_tri_p2.PRIOR_AGE
+    for lag, cols in LAG_COLS.items():
+        if lag is None:
+            duration = exposed_time
+            outcome = True
+        else:
+            min_lag, max_lag = lag
+            # Duration is time from exposure endpoint to end event, no
+            # matter of the lag time-window.
+            duration = np.minimum(exposed_time, max_lag)
+            outcome = (outcome_time >= min_lag) & (outcome_time <= max_lag)
+        df_tri_p2[cols["duration"]] = duration
+        df_tri_p2[cols["outcome"]] = outcome
 
     return (
         df_unexp,
@@ -494,9 +542,22 @@ def prep_coxhr(pair, lag, df_events, df_info):
     )
 
 
-def prep_lifelines(df_unexp, df_unexp_death, df_unexp_exp_p1, df_unexp_exp_p2, df_tri_p1, df_tri_p2):
+def prep_lifelines(cols, df_unexp, df_unexp_death, df_unexp_exp_p1, df_unexp_exp_p2, df_tri_p1, df_tri_p2):
     logger.info("Preparing lifelines dataframes")
 
+    # Rename lagged HR columns
+    col_duration = cols["duration"]
+    col_outcome = cols["outcome"]
+    keep_cols_p2 = [col_duration, "prior", "BIRTH_TYEAR", "female", col_outcome, "weight"]
+    df_unexp_exp_p2 = (
+        df_unexp_exp_p2.loc[:, keep_cols_p2]
+        .rename(columns={col_duration: "duration", col_outcome: "outcome"})
+    )
+    df_tri_p2 = (
+        df_tri_p2.loc[:, keep_cols_p2]
+        .rename(columns={col_duration: "duration", col_outcome: "outcome"})
+    )
+
     # Re-check that there are enough individuals to do the study,
     # since after setting the lag some individuals might not have the
     # death outcome anymore.
@@ -510,15 +571,98 @@ def prep_lifelines(df_unexp, df_unexp_death, df_unexp_exp_p1, df_unexp_exp_p2, d
         df_unexp.loc[:, keep_cols],
         df_unexp_death.loc[:, keep_cols],
         df_unexp_exp_p1.loc[:, keep_cols],
-        df_unexp_exp_p2.loc[:, keep_cols],
+        df_unexp_exp_p2,
         df_tri_p1.loc[:, keep_cols],
-        df_tri_p2.loc[:, keep_cols]],
+        df_tri_p2],
         ignore_index=True)
 
     return nindivs, df_lifelines
 
 
-def compute_coxhr(pair, df, lag, step_size, is_sex_specific, nindivs, res_writer):
+def fit_coxhr(df, initial_params=None):
+    """Fit the Cox model, retrying the optimization until it converges.
+
+    An attempt fails when it raises ConvergenceError or when the
+    Newton-Raphson iterations stop before converging. After a failed
+    attempt the step size is halved, down to MIN_STEP_SIZE, and the next
+    attempt starts from the coefficients of the failed attempt when the
+    fit completed without converging.
+    The first attempt starts from `initial_params` when given, e.g. the
+    coefficients of the no-lag fit.
+    Other convergence warnings, e.g. low variance covariates or a
+    converged fit with a large step norm as with separated data, are not
+    improved by a refit: the fit is kept with status "converged with warnings".
+
+    Returns the fitted model and a dict with the step size, the number
+    of attempts, and the iterations and status of the returned fit.
+    If no attempt converged, the last completed fit is returned with
+    status "not converged". Raises ConvergenceError if no attempt
+    completed, with the same dict as its `fit_info` attribute.
+    """
+    covariates = [col for col in df.columns if col not in ["duration", "outcome", "weight"]]
+    norm_std = df[covariates].std()
+
+    fitted = None
+    fit_info = {"step_size": None, "attempts": 0, "iterations": None, "status": "failed"}
+    step_size = DEFAULT_STEP_SIZE
+    while step_size >= MIN_STEP_SIZE:
+        fit_info["attempts"] += 1
+        # CoxPHFitter takes the initial point on the normalized covariates
+        initial_point = None if initial_params is None else (initial_params[covariates] * norm_std).values
+        cph = CoxPHFitter()
+        try:
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always", ConvergenceWarning)
+                cph.fit(
+                    df,
+                    duration_col="duration",
+                    event_col="outcome",
+                    step_size=step_size,
+                    initial_point=initial_point,
+                    # For the case-cohort study we need weights and robust errors:
+                    weights_col="weight",
+                    robust=True
+                )
+        except ConvergenceError as exc:
+            error = exc
+            # The failed attempt has no coefficients, start the next one from zero
+            initial_params = None
+        else:
+            fitted = cph
+            messages = [str(warning.message) for warning in caught if issubclass(warning.category, ConvergenceWarning)]
+            converged = not any(message.startswith(NOT_CONVERGED_WARNING) for message in messages)
+            if not converged:
+                status = "not converged"
+            elif messages:
+                status = "converged with warnings"
+                for message in messages:
+                    logger.warning(f"Cox fit converged with a warning: {message}")
+            else:
+                status = "converged"
+            fit_info.update({
+                "step_size": step_size,
+                # Not exposed by lifelines CoxPHFitter
+                "iterations": getattr(cph, "n_iterations_", None),
+                "status": status
+            })
+            if converged:
+                break
+            initial_params = cph.params_
+
+        logger.info(f"Cox fit did not converge with step size {step_size}")
+        step_size /= 2
+
+    if fitted is None:
+        error.fit_info = fit_info
+        raise error
+    return fitted, fit_info
+
+
+def compute_coxhr(pair, df, lag, is_sex_specific, nindivs, res_writer, initial_params=None):
+    """Fit the Cox model for one lag and write its results.
+
+    Returns the fitted coefficients and the fit_info of fit_coxhr().
+    """
     logger.info(f"Running Cox regression")
     prior, outcome = pair
     # Handle sex-specific endpoints
@@ -526,16 +670,8 @@ def compute_coxhr(pair, df, lag, step_size, is_sex_specific, nindivs, res_writer
         df = df.drop(columns=["female"])
 
     # Fit Cox model
-    cph = CoxPHFitter()
-    cph.fit(
-        df,
-        duration_col="duration",
-        event_col="outcome",
-        step_size=step_size,
-        # For the case-cohort study we need weights and robust errors:
-        weights_col="weight",
-        robust=True
-    )
+    cph, fit_info = fit_coxhr(df, initial_params)
+    step_size = fit_info["step_size"]
 
     # Compute absolute risk
     mean_indiv = pd.DataFrame({
@@ -653,6 +789,8 @@ def compute_coxhr(pair, df, lag, step_size, is_sex_specific, nindivs, res_writer
         bch_values[21.99]
     ])
 
+    return cph.params_, fit_info
+
 
 def bch_at(df, time):
     try:
@@ -8,6 +8,34 @@ We keep only the data if an individual has an endpoint.
 
 Note that this script doesn't do any input validation. It's also why it's quite fast.
 
+With --stream, the input file (plain or gzipped CSV) is read in blocks with
+the Arrow CSV reader. Each block is converted to long format with array
+operations and written as a Parquet row group, so the peak memory depends
+on the block size and not on the number of cases.
+
+With --workers N, the plain CSV input is split into N byte ranges aligned on
+line boundaries. Each range is converted in its own process, as in the
+streaming mode, into a Parquet part of the output directory. A `_metadata`
+file listing the row groups of all the parts is written at the end, so the
+directory reads as a single dataset with the same rows as the other modes.
+
+With --sort-by-endpoint, the output rows are clustered by endpoint and written
+in small row groups with column statistics. Readers filtering on ENDPOINT
+(e.g. with `pyarrow.parquet.read_table(..., filters=...)`) then only read the
+few row groups whose min/max range contains the endpoint. With --stream, the
+blocks are first spilled to temporary files next to the output, one per range
+of endpoints, which are then sorted one at a time, so the memory stays bounded.
+
+With --status-matrix, the output is a directory with the control, case and
+excluded control status of every individual for every endpoint, packed at
+2 bits per cell (see risteys_pipeline/finngen/status_matrix.py). This is the
+affordable alternative to --keep-all for the full FinnGen data.
+
+With --parquet-mirror, the wide file is not transformed but copied to a
+Parquet file with the same columns. Scripts needing only the columns of one
+endpoint (e.g. medication_stats_logit.py) can then read a few column chunks
+instead of parsing the whole CSV.
+
 
 Usage
 -----
@@ -33,9 +61,16 @@ Outputs a Parquet file in long format with all control information discarded.
 """
 
 import argparse
+import gzip
+import io
+import multiprocessing
+import tempfile
 from pathlib import Path
 
+import numpy as np
 import pyarrow
+import pyarrow.compute as compute
+import pyarrow.csv as pyarrow_csv
 import pyarrow.parquet as parquet
 
 
@@ -55,6 +90,43 @@ OUT_HEADER = [
     "APPROX_EVENT_DAY",
     "NEVT"
 ]
+OUT_SCHEMA = pyarrow.schema([
+    ("FINNGENID", pyarrow.string()),
+    ("ENDPOINT", pyarrow.string()),
+    ("CONTROL_CASE_EXCL", pyarrow.int64()),
+    ("AGE", pyarrow.float64()),
+    ("APPROX_EVENT_DAY", pyarrow.string()),
+    ("NEVT", pyarrow.int64()),
+])
+
+# Output code for the excluded controls
+OUT_EXCL_CONTROL = 2
+
+# Default size of the blocks read by the streaming mode
+DEFAULT_BLOCK_SIZE_MB = 64
+
+# Number of rows per row group when the output is sorted by endpoint.
+# Small enough that reading one endpoint only touches a few row groups.
+SORTED_ROW_GROUP_SIZE = 64 * 1024
+# Parquet options of the output sorted by endpoint
+SORTED_WRITE_OPTIONS = {
+    "use_dictionary": ["FINNGENID", "ENDPOINT"],
+    "write_statistics": True,
+}
+
+# Types of the endpoint columns in the Parquet mirror of the wide file,
+# the other columns are kept as strings.
+MIRROR_ENDPOINT_TYPES = {
+    "": pyarrow.int8(),
+    "_NEVT": pyarrow.int64(),
+    "_AGE": pyarrow.float64(),
+    "_YEAR": pyarrow.float64(),
+    "_FU_AGE": pyarrow.float64(),
+    "_APPROX_EVENT_DAY": pyarrow.string(),
+}
+
+# File name of the output parts in sharded mode
+PART_NAME = "part-{:05d}.parquet"
 
 
 def cli_parser():
@@ -77,13 +149,96 @@ def cli_parser():
         required=False,
         action="store_true"
     )
+    parser.add_argument(
+        "-s", "--stream",
+        help="read the input (CSV or gzipped CSV) in blocks and write one Parquet row group per block",
+        required=False,
+        action="store_true"
+    )
+    parser.add_argument(
+        "-b", "--block-size",
+        help=f"size of the blocks read in streaming mode, in MB (default: {DEFAULT_BLOCK_SIZE_MB})",
+        required=False,
+        default=DEFAULT_BLOCK_SIZE_MB,
+        type=int
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        help="convert the input (CSV only) in N processes, the output is then a directory of Parquet parts",
+        required=False,
+        default=1,
+        type=int
+    )
+    parser.add_argument(
+        "-e", "--sort-by-endpoint",
+        help="cluster the output rows by endpoint, so that readers filtering on ENDPOINT can skip row groups",
+        required=False,
+        action="store_true"
+    )
+    parser.add_argument(
+        "-m", "--status-matrix",
+        help="write the control/case/excluded status of all individuals as a packed 2-bit matrix in the output directory, instead of the long format",
+        required=False,
+        action="store_true"
+    )
+    parser.add_argument(
+        "-p", "--parquet-mirror",
+        help="copy the wide file as is to a Parquet file with the same columns, instead of the long format",
+        required=False,
+        action="store_true"
+    )
     args = parser.parse_args()
+
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.workers > 1 and args.input_first_events.suffix == ".gz":
+        parser.error("--workers requires an uncompressed input file, gzip cannot be split")
+    if args.workers > 1 and args.sort_by_endpoint:
+        parser.error("--sort-by-endpoint cannot be used with --workers")
+    if args.workers > 1 and (args.status_matrix or args.parquet_mirror):
+        parser.error("--status-matrix and --parquet-mirror cannot be used with --workers")
     return args
 
 
 def main():
     args = cli_parser()
 
+    if args.parquet_mirror:
+        convert_parquet_mirror(
+            args.input_first_events,
+            args.output,
+            args.block_size * 1024 * 1024
+        )
+        return
+
+    if args.status_matrix:
+        convert_status_matrix(
+            args.input_first_events,
+            args.output,
+            args.block_size * 1024 * 1024
+        )
+        return
+
+    if args.workers > 1:
+        convert_sharded(
+            args.input_first_events,
+            args.output,
+            args.keep_all,
+            args.block_size * 1024 * 1024,
+            args.workers
+        )
+        return
+
+    if args.stream:
+        convert = convert_streaming_sorted if args.sort_by_endpoint else convert_streaming
+        convert(
+            args.input_first_events,
+            args.output,
+            args.keep_all,
+            args.block_size * 1024 * 1024
+        )
+        return
+
     in_file = open(args.input_first_events)
 
     # Read the header to build a lookup table for column -> column index
@@ -95,9 +250,7 @@ def main():
         in_header[col] = idx
 
     # Find endpoint columns
-    endpoints = list(filter(
-        lambda c: c + "_FU_AGE" in in_header and c + "_APPROX_EVENT_DAY" in in_header and c + "_NEVT" in in_header,
-        in_header))
+    endpoints = find_endpoints(in_header)
 
     # Initialize arrays that will be used to make the Parquet output file
     fgid_values = []
@@ -153,7 +306,327 @@ def main():
         ],
         names=OUT_HEADER
     )
-    parquet.write_table(out_table, args.output)
+    if args.sort_by_endpoint:
+        write_endpoint_sorted(out_table, args.output)
+    else:
+        parquet.write_table(out_table, args.output)
+
+
+def find_endpoints(header):
+    """Find the endpoint columns, i.e. the columns having age, day and number of events columns"""
+    columns = set(header)
+    return [
+        col for col in header
+        if col + "_FU_AGE" in columns and col + "_APPROX_EVENT_DAY" in columns and col + "_NEVT" in columns
+    ]
+
+
+def read_header(input_path):
+    """Read the column names of the first-event file (CSV or gzipped CSV)"""
+    opener = gzip.open if Path(input_path).suffix == ".gz" else open
+    with opener(input_path, "rt") as in_file:
+        header = in_file.readline().rstrip("\n").split(",")
+    return header
+
+
+def open_first_events(input_path, header, endpoints, block_size):
+    """Open a streaming reader on the identifier and endpoint columns of the first-event file (path or file object)"""
+    column_types = {header[0]: pyarrow.string()}
+    for endp in endpoints:
+        column_types[endp] = pyarrow.int8()
+        column_types[endp + "_FU_AGE"] = pyarrow.float64()
+        column_types[endp + "_APPROX_EVENT_DAY"] = pyarrow.string()
+        column_types[endp + "_NEVT"] = pyarrow.int64()
+
+    return pyarrow_csv.open_csv(
+        input_path,
+        read_options=pyarrow_csv.ReadOptions(block_size=block_size),
+        convert_options=pyarrow_csv.ConvertOptions(
+            column_types=column_types,
+            include_columns=list(column_types),
+            # Excluded controls are read as null in the endpoint columns,
+            # string columns keep the "NA" value as in the non-streaming mode.
+            null_values=[EXCL_CONTROL],
+            strings_can_be_null=False
+        )
+    )
+
+
+def batch_status(batch, endpoints):
+    """Matrix of control/case/excluded status: one row per individual, one column per endpoint"""
+    status = np.empty((batch.num_rows, len(endpoints)), dtype=np.int8)
+    for idx, endp in enumerate(endpoints):
+        status[:, idx] = compute.fill_null(batch.column(endp), OUT_EXCL_CONTROL).to_numpy()
+
+    unexpected = (status < 0) | (status > OUT_EXCL_CONTROL)
+    if unexpected.any():
+        row, col = np.argwhere(unexpected)[0]
+        raise ValueError(
+            f"Unexpected value `{status[row, col]}` for `{batch.column(0)[row]}` with endpoint `{endpoints[col]}` ."
+        )
+
+    return status
+
+
+def batch_to_long(batch, endpoints, keep_all):
+    """Convert a record batch of the wide first-event file to a long-format table"""
+    n_rows = batch.num_rows
+    status = batch_status(batch, endpoints)
+
+    # Row-major order keeps the output sorted by individual then by endpoint
+    if keep_all:
+        rows, cols = np.nonzero(np.ones_like(status, dtype=bool))
+    else:
+        rows, cols = np.nonzero(status == int(CASE))
+
+    # Event info columns are concatenated endpoint after endpoint
+    flat_index = pyarrow.array(cols.astype(np.int64) * n_rows + rows)
+
+    def take_event_info(suffix):
+        values = pyarrow.concat_arrays([batch.column(endp + suffix) for endp in endpoints])
+        return values.take(flat_index)
+
+    return pyarrow.table(
+        [
+            batch.column(0).take(pyarrow.array(rows)),
+            pyarrow.array(endpoints, pyarrow.string()).take(pyarrow.array(cols)),
+            pyarrow.array(status[rows, cols].astype(np.int64)),
+            take_event_info("_FU_AGE"),
+            take_event_info("_APPROX_EVENT_DAY"),
+            take_event_info("_NEVT"),
+        ],
+        schema=OUT_SCHEMA
+    )
+
+
+def convert_streaming(input_path, output_path, keep_all, block_size):
+    """Convert the wide first-event file block by block, one Parquet row group per block"""
+    header = read_header(input_path)
+    endpoints = find_endpoints(header)
+    reader = open_first_events(input_path, header, endpoints, block_size)
+
+    with parquet.ParquetWriter(output_path, OUT_SCHEMA) as writer:
+        for batch in reader:
+            out_table = batch_to_long(batch, endpoints, keep_all)
+            if out_table.num_rows > 0:
+                writer.write_table(out_table)
+
+
+def count_data_lines(input_path):
+    """Count the lines after the header of the first-event file (CSV or gzipped CSV)"""
+    opener = gzip.open if Path(input_path).suffix == ".gz" else open
+    n_lines = 0
+    last_chunk = b"\n"
+    with opener(input_path, "rb") as in_file:
+        for chunk in iter(lambda: in_file.read(1024 * 1024), b""):
+            n_lines += chunk.count(b"\n")
+            last_chunk = chunk
+    # Last line without a trailing newline
+    if not last_chunk.endswith(b"\n"):
+        n_lines += 1
+    return n_lines - 1
+
+
+def convert_status_matrix(input_path, output_dir, block_size):
+    """Write the control/case/excluded status of all individuals and endpoints as a packed matrix"""
+    # Imported here so that the other conversions run standalone, without the package
+    try:
+        from risteys_pipeline.finngen.status_matrix import StatusMatrixWriter
+    except ImportError:
+        # Standalone run, status_matrix.py is next to this script
+        from status_matrix import StatusMatrixWriter
+
+    header = read_header(input_path)
+    endpoints = find_endpoints(header)
+    writer = StatusMatrixWriter(output_dir, endpoints, count_data_lines(input_path))
+
+    reader = open_first_events(input_path, header, endpoints, block_size)
+    for batch in reader:
+        writer.write(batch.column(0).to_pylist(), batch_status(batch, endpoints))
+    writer.close()
+
+
+def convert_parquet_mirror(input_path, output_path, block_size):
+    """Copy the wide first-event file to Parquet, one row group per block"""
+    header = read_header(input_path)
+
+    column_types = {col: pyarrow.string() for col in header}
+    for endp in find_endpoints(header):
+        for suffix, col_type in MIRROR_ENDPOINT_TYPES.items():
+            if endp + suffix in column_types:
+                column_types[endp + suffix] = col_type
+
+    reader = pyarrow_csv.open_csv(
+        input_path,
+        read_options=pyarrow_csv.ReadOptions(block_size=block_size),
+        convert_options=pyarrow_csv.ConvertOptions(
+            column_types=column_types,
+            # Missing values are read as null like pandas.read_csv() does
+            null_values=[EXCL_CONTROL, ""],
+            strings_can_be_null=True
+        )
+    )
+    schema = pyarrow.schema([(col, column_types[col]) for col in header])
+
+    with parquet.ParquetWriter(output_path, schema) as writer:
+        for batch in reader:
+            writer.write_table(pyarrow.Table.from_batches([batch], schema=schema))
+
+
+def write_endpoint_sorted(table, output_path):
+    """
+    Write the long-format table with rows clustered by endpoint.
+
+    The sort is stable, so the rows of an endpoint keep the individual order.
+    ENDPOINT and FINNGENID are dictionary-encoded and each row group has
+    min/max statistics, so a filter on ENDPOINT skips all the row groups
+    not overlapping the endpoint.
+    """
+    table = table.take(compute.sort_indices(table, sort_keys=[("ENDPOINT", "ascending")]))
+    parquet.write_table(
+        table,
+        output_path,
+        row_group_size=SORTED_ROW_GROUP_SIZE,
+        **SORTED_WRITE_OPTIONS
+    )
+
+
+def convert_streaming_sorted(input_path, output_path, keep_all, block_size):
+    """
+    Convert the wide first-event file block by block, with rows clustered by endpoint.
+
+    Same output as write_endpoint_sorted(), in bounded memory: the rows of
+    each block are spilled to one temporary Parquet file per range of
+    endpoints, with about one block of input per range. The spill files are
+    then sorted one at a time, in endpoint order, and appended to the output.
+    """
+    header = read_header(input_path)
+    endpoints = find_endpoints(header)
+    sorted_endpoints = pyarrow.array(sorted(endpoints), pyarrow.string())
+    n_ranges = min(len(endpoints), max(1, -(-Path(input_path).stat().st_size // block_size)))
+    reader = open_first_events(input_path, header, endpoints, block_size)
+
+    # Spill next to the output, the input may be on a smaller or read-only disk
+    with tempfile.TemporaryDirectory(dir=Path(output_path).parent) as spill_dir:
+        spill_paths = [Path(spill_dir) / PART_NAME.format(idx) for idx in range(n_ranges)]
+        spill_writers = [parquet.ParquetWriter(path, OUT_SCHEMA) for path in spill_paths]
+        for batch in reader:
+            out_table = batch_to_long(batch, endpoints, keep_all)
+            if out_table.num_rows == 0:
+                continue
+            rank = compute.index_in(out_table.column("ENDPOINT"), value_set=sorted_endpoints).to_numpy()
+            ranges = rank * n_ranges // len(endpoints)
+            # Stable, so the rows keep the individual order within each range
+            out_table = out_table.take(pyarrow.array(np.argsort(ranges, kind="stable")))
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(ranges, minlength=n_ranges))])
+            for idx, writer in enumerate(spill_writers):
+                if offsets[idx + 1] > offsets[idx]:
+                    writer.write_table(out_table.slice(offsets[idx], offsets[idx + 1] - offsets[idx]))
+        for writer in spill_writers:
+            writer.close()
+
+        with parquet.ParquetWriter(output_path, OUT_SCHEMA, **SORTED_WRITE_OPTIONS) as writer:
+            for path in spill_paths:
+                table = parquet.read_table(path)
+                table = table.take(compute.sort_indices(table, sort_keys=[("ENDPOINT", "ascending")]))
+                writer.write_table(table, row_group_size=SORTED_ROW_GROUP_SIZE)
+                path.unlink()
+
+
+class ShardFile(io.RawIOBase):
+    """Read-only file object over the header line followed by the byte range [start, stop) of the input file"""
+
+    def __init__(self, input_path, header_line, start, stop):
+        self._file = open(input_path, "rb")
+        self._file.seek(start)
+        self._header_line = header_line
+        self._remaining = stop - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._header_line:
+            size = min(len(buffer), len(self._header_line))
+            buffer[:size] = self._header_line[:size]
+            self._header_line = self._header_line[size:]
+            return size
+
+        size = min(len(buffer), self._remaining)
+        if size == 0:
+            return 0
+        data = self._file.read(size)
+        buffer[:len(data)] = data
+        self._remaining -= len(data)
+        return len(data)
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def shard_ranges(input_path, n_shards):
+    """Split the input file after the header into `n_shards` byte ranges starting on a line"""
+    file_size = Path(input_path).stat().st_size
+
+    with open(input_path, "rb") as in_file:
+        header_line = in_file.readline()
+        bounds = [len(header_line)]
+        for shard in range(1, n_shards):
+            pos = bounds[0] + (file_size - bounds[0]) * shard // n_shards
+            # Move to the start of the line following byte `pos - 1`
+            in_file.seek(max(pos - 1, bounds[-1]))
+            in_file.readline()
+            bounds.append(max(in_file.tell(), bounds[-1]))
+        bounds.append(file_size)
+
+    return header_line, list(zip(bounds[:-1], bounds[1:]))
+
+
+def convert_shard(input_path, header_line, start, stop, output_path, keep_all, block_size):
+    """Convert one byte range of the wide first-event file to a Parquet part"""
+    header = header_line.decode().rstrip("\r\n").split(",")
+    endpoints = find_endpoints(header)
+
+    with io.BufferedReader(ShardFile(input_path, header_line, start, stop)) as in_file:
+        reader = open_first_events(in_file, header, endpoints, block_size)
+        with parquet.ParquetWriter(output_path, OUT_SCHEMA) as writer:
+            for batch in reader:
+                out_table = batch_to_long(batch, endpoints, keep_all)
+                if out_table.num_rows > 0:
+                    writer.write_table(out_table)
+
+    return output_path
+
+
+def convert_sharded(input_path, output_dir, keep_all, block_size, n_workers):
+    """
+    Convert the wide first-event file in `n_workers` processes.
+
+    Each line-aligned byte range is written to its own Parquet part in
+    `output_dir`. Parts are numbered in file order, so reading the directory
+    gives the rows in the same order as the single-process conversion.
+    """
+    header_line, ranges = shard_ranges(input_path, n_workers)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    tasks = [
+        (input_path, header_line, start, stop, output_dir / PART_NAME.format(idx), keep_all, block_size)
+        for idx, (start, stop) in enumerate(ranges)
+    ]
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(n_workers) as pool:
+        part_paths = pool.starmap(convert_shard, tasks)
+
+    # Dataset-level metadata with the row groups of all the parts
+    metadata_collector = []
+    for part_path in part_paths:
+        metadata = parquet.read_metadata(part_path)
+        metadata.set_file_path(part_path.name)
+        metadata_collector.append(metadata)
+    parquet.write_metadata(OUT_SCHEMA, output_dir / "_common_metadata")
+    parquet.write_metadata(OUT_SCHEMA, output_dir / "_metadata", metadata_collector=metadata_collector)
 
 
 if __name__ == "__main__":
@@ -6,23 +6,60 @@ from risteys_pipeline.config import (
     FINREGISTRY_MINIMAL_PHENOTYPE_DATA_PATH,
     FINREGISTRY_ENDPOINT_DEFINITIONS_DATA_PATH,
     FINREGISTRY_LONG_FORMAT_FIRST_EVENTS_DATA_PATH,
+    FINREGISTRY_CACHE_DIR,
 )
 from risteys_pipeline.utils.log import logger
+from risteys_pipeline.utils.cache import load_with_cache
 from risteys_pipeline.utils.utils import to_decimal_year
+from risteys_pipeline.utils.persons import (
+    build_person_dictionary,
+    encode_personid,
+    take_demographics,
+)
 
 SEX_FEMALE_ENDPOINTS = 2.0
 SEX_MALE_ENDPOINTS = 1.0
 SEX_FEMALE_MINIMAL_PHENOTYPE = 1.0
 SEX_MALE_MINIMAL_PHENOTYPE = 0.0
 
+# Input files read by load_data()
+INPUT_PATHS = [
+    FINREGISTRY_ENDPOINT_DEFINITIONS_DATA_PATH,
+    FINREGISTRY_MINIMAL_PHENOTYPE_DATA_PATH,
+    FINREGISTRY_LONG_FORMAT_FIRST_EVENTS_DATA_PATH,
+]
+
 
-def load_data():
+def load_data(cache_dir=FINREGISTRY_CACHE_DIR, first_events_store=False):
     """
     Loads the following datasets using the data paths on config:
     - endpoint definitions
     - minimal phenotype
     - first events
 
+    The datasets are cached as Arrow files in `cache_dir`, and read from there
+    as long as the input files, the config constants and the loading code are
+    unchanged.
+
+    With `first_events_store`, the first events are returned as a
+    FirstEventsStore, which is also kept in the cache.
+
+    Args:
+        cache_dir (Path, optional): cache directory, no caching if None
+        first_events_store (bool, default False): return the first events as a FirstEventsStore
+
+    Returns
+        (endpoint_definitions, minimal_phenotype, first_events) (tuple)
+    """
+    return load_with_cache(
+        load_data_from_source, INPUT_PATHS, cache_dir, first_events_store=first_events_store
+    )
+
+
+def load_data_from_source():
+    """
+    Loads the datasets from the original files, see load_data().
+
     Args:
         None
 
@@ -44,6 +81,7 @@ def load_minimal_phenotype_data(data_path=FINREGISTRY_MINIMAL_PHENOTYPE_DATA_PAT
     - drop redundant columns (date_of_birth, death_date)
     - set `index_person` to boolean
     - add `female` and drop `sex`
+    - encode `personid` as dense integer codes, original IDs are kept in `person`
 
     Args:
         data_path (str, optional): file path of the minimal phenotype csv file
@@ -72,6 +110,7 @@ def load_minimal_phenotype_data(data_path=FINREGISTRY_MINIMAL_PHENOTYPE_DATA_PAT
     df.loc[df["sex"] == SEX_MALE_MINIMAL_PHENOTYPE, "female"] = False
     df = df.drop(columns={"sex"})
     df = df.astype({"personid": "string[pyarrow]"})
+    df = build_person_dictionary(df)
 
     logger.info(f"{df.shape[0]:,} rows in minimal phenotype")
 
@@ -110,9 +149,12 @@ def load_first_events_data(
     Loads and applies the following steps to first events data:
     - rename columns
     - remove endpoints not in endpoints dataset
-    - add demographics from minimal phenotype
+    - encode `personid` with the codes of the minimal phenotype
     - add the event year
 
+    Demographics are not merged onto the events, they can be looked up
+    from the code-indexed minimal phenotype with take_demographics().
+
     Args:
         data_path (str, optional): file path of the long-format first events feather file
 
@@ -126,9 +168,10 @@ def load_first_events_data(
     logger.debug(f"{df.shape[0]:,} rows loaded")
 
     df = df.loc[df["endpoint"].isin(endpoints["endpoint"])].reset_index(drop=True)
-    df = df.merge(minimal_phenotype, how="left", on="personid")
-    df["year"] = df["birth_year"] + df["age"]
-    df = df.astype({"personid": "string[pyarrow]", "endpoint": "category"})
+    df["personid"] = encode_personid(df["personid"], minimal_phenotype)
+    birth_year = take_demographics(minimal_phenotype, df["personid"], ["birth_year"])
+    df["year"] = birth_year["birth_year"].values + df["age"].values
+    df = df.astype({"endpoint": "category"})
 
     logger.info(f"{df.shape[0]:,} rows in first events")
 
@@ -3,7 +3,9 @@
 import pandas as pd
 import numpy as np
 from risteys_pipeline.utils.log import logger
-from risteys_pipeline.config import MIN_SUBJECTS_PERSONAL_DATA
+from risteys_pipeline.utils.shared_frames import get_shared
+from risteys_pipeline.first_events_store import FirstEventsStore
+from risteys_pipeline.config import FOLLOWUP_END, MIN_SUBJECTS_PERSONAL_DATA
 from risteys_pipeline.survival_analysis import (
     MIN_SUBJECTS_SURVIVAL_ANALYSIS,
     add_death_as_competing_event,
@@ -15,11 +17,18 @@ from risteys_pipeline.survival_analysis import (
 
 N_DECIMALS = 4
 
+# Minimum follow-up of a person in the survival dataset, as in build_survival_dataset()
+TIME_EPSILON = 0.01
+
+# Age bins of the full cohort CIF, about a day.
+# A whole number of bins per year keeps the integer output ages on bin edges.
+AGE_BINS_PER_YEAR = 365
+
 
 def cumulative_incidence_function(endpoint, cases, cohort):
     """
     Compute the Cumulative Incidence Function (CIF) for `endpoint`
-    - Johansen-Aalen estimator
+    - weighted Aalen-Johansen estimator, see risteys_pipeline.aalen_johansen
     - age as timescale
     - death as a competing event
     - stratified by sex
@@ -91,38 +100,258 @@ def cumulative_incidence_function(endpoint, cases, cohort):
     return CIF
 
 
+class CohortRiskSet:
+    """
+    Risk set of the full cohort on the age timescale, by sex.
+
+    Ages are binned by about a day. The number of persons at risk and the number
+    of deaths in each age bin are computed once for the cohort. The CIF of
+    an endpoint then only corrects them for the cases of the endpoint,
+    who leave the risk set at their event instead of at death or at the
+    end of the follow-up. This costs O(cases + age bins) per endpoint.
+
+    A person is at risk in the age bins from their start age to their stop
+    age, both included. Death is the competing event, as in
+    add_death_as_competing_event().
+
+    Attributes:
+        cohort (DataFrame): cohort dataset, persons with enough follow-up
+        start_bin (ndarray): age bin of the start of each person
+        stop_bin (ndarray): age bin of the stop of each person
+        died (ndarray): True if the person died during the follow-up
+        sex (ndarray): 1 for females, 0 for males
+        n_bins (int): number of age bins
+        at_risk (ndarray): (2, n_bins) number of persons at risk by sex and age bin
+        deaths (ndarray): (2, n_bins) number of deaths by sex and age bin
+    """
+
+    def __init__(self, cohort):
+        """
+        Args:
+            cohort (DataFrame): cohort dataset, output of get_cohort()
+        """
+        logger.debug("Building the full cohort risk set")
+        cohort = cohort.loc[cohort["stop"].values - cohort["start"].values > TIME_EPSILON]
+        self.cohort = cohort
+
+        birth_year = cohort["birth_year"].values
+        self.start_bin = age_bin(cohort["start"].values - birth_year)
+        self.stop_bin = age_bin(cohort["stop"].values - birth_year)
+        self.died = cohort["stop"].values < FOLLOWUP_END
+        self.sex = cohort["female"].values.astype(bool).astype(np.int64)
+        self.n_bins = int(self.stop_bin.max()) + 1 if cohort.shape[0] > 0 else 1
+
+        self.at_risk = self.interval_counts(self.sex, self.start_bin, self.stop_bin)
+        self.deaths = self.bin_counts(self.sex[self.died], self.stop_bin[self.died])
+
+    def bin_counts(self, sex, bins):
+        """Count the persons by sex and age bin"""
+        counts = np.bincount(sex * self.n_bins + bins, minlength=2 * self.n_bins)
+        return counts.reshape(2, self.n_bins)
+
+    def interval_counts(self, sex, start_bins, stop_bins):
+        """Count the persons whose [start_bin, stop_bin] interval covers each age bin, by sex"""
+        n = self.n_bins + 1
+        diff = np.bincount(sex * n + start_bins, minlength=2 * n)
+        diff -= np.bincount(sex * n + stop_bins + 1, minlength=2 * n)
+        return np.cumsum(diff.reshape(2, n), axis=1)[:, :-1]
+
+    def cumulative_incidence(self, cases):
+        """
+        Compute the CIF of an endpoint in each age bin, by sex.
+
+        Args:
+            cases (DataFrame): cases of the endpoint, output of get_cases()
+
+        Returns:
+            (CIF, case_sex, case_ages, n_competing) (tuple): (2, n_bins) CIF
+                by sex and age bin, the sex and age at event of the cases
+                kept in the survival dataset, and the number of competing
+                deaths by sex
+        """
+        rows = self.cohort.index.get_indexer(cases.index)
+        cases = cases.loc[rows >= 0]
+        rows = rows[rows >= 0]
+        sex = self.sex[rows]
+
+        # Cases leave the risk set at their event and are not counted as deaths
+        at_risk = self.at_risk - self.interval_counts(sex, self.start_bin[rows], self.stop_bin[rows])
+        deaths = self.deaths - self.bin_counts(sex[self.died[rows]], self.stop_bin[rows][self.died[rows]])
+
+        # Cases with enough follow-up before their event
+        kept = cases["stop"].values - cases["start"].values > TIME_EPSILON
+        rows = rows[kept]
+        sex = sex[kept]
+        case_ages = cases["stop"].values[kept] - cases["birth_year"].values[kept]
+        case_bins = age_bin(case_ages)
+        at_risk = at_risk + self.interval_counts(sex, self.start_bin[rows], case_bins)
+        events = self.bin_counts(sex, case_bins)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            hazard = np.where(at_risk > 0, events / at_risk, 0.0)
+            all_hazard = np.where(at_risk > 0, (events + deaths) / at_risk, 0.0)
+        survival = np.cumprod(1 - all_hazard, axis=1)
+        lagged_survival = np.concatenate([np.ones((2, 1)), survival[:, :-1]], axis=1)
+        CIF = np.cumsum(lagged_survival * hazard, axis=1)
+
+        return CIF, sex, case_ages, deaths.sum(axis=1)
+
+
+def age_bin(age):
+    """Age bin of ages in years"""
+    return np.maximum(np.floor(age * AGE_BINS_PER_YEAR), 0).astype(np.int64)
+
+
+def cumulative_incidence_full_cohort(endpoint, cases, risk_set):
+    """
+    Compute the Cumulative Incidence Function (CIF) for `endpoint` on the full cohort.
+
+    Same estimator and output as cumulative_incidence_function(), but with
+    all the cases and the full cohort instead of sampled cases and controls,
+    and ages binned by AGE_BINS_PER_YEAR.
+
+    Args:
+        endpoint (str): name of the endpoint
+        cases (DataFrame): cases dataset (persons with endpoint)
+        risk_set (CohortRiskSet): risk set of the full cohort
+
+    Returns:
+        CIF (DataFrame): cumulative incidence function dataset, see cumulative_incidence_function()
+    """
+    logger.debug(f"{endpoint}")
+
+    CIF_bins, case_sex, case_ages, n_competing = risk_set.cumulative_incidence(cases)
+
+    # Same requirement as check_min_subjects() for each outcome present
+    min_persons = max(MIN_SUBJECTS_PERSONAL_DATA, MIN_SUBJECTS_SURVIVAL_ANALYSIS)
+    CIF = []
+    for sex in [1, 0]:
+        in_sex = case_sex == sex
+        if in_sex.sum() <= min_persons or 0 < n_competing[sex] <= min_persons:
+            continue
+
+        # Get ages with enough data
+        ages, counts = np.unique(np.round(case_ages[in_sex]), return_counts=True)
+        ages = ages[counts >= MIN_SUBJECTS_PERSONAL_DATA]
+        if len(ages) == 0:
+            continue
+
+        # CIF at an integer age is the CIF at the end of the bin before it
+        bins = np.minimum(age_bin(ages) - 1, risk_set.n_bins - 1)
+        cumulinc = np.where(bins >= 0, CIF_bins[sex, np.maximum(bins, 0)], 0.0)
+        CIF.append(pd.DataFrame({
+            "age": ages,
+            "sex": {1: "female", 0: "male"}[sex],
+            "cumulinc": cumulinc.round(N_DECIMALS),
+        }))
+
+    if CIF:
+        CIF = pd.concat(CIF, axis=0, ignore_index=True)
+        CIF["endpoint"] = endpoint
+
+    return CIF
+
+
+def cumulative_incidence_all_endpoints(endpoints, first_events, cohort):
+    """
+    Compute the CIF of all the endpoints in a single pass over the full cohort.
+
+    Args:
+        endpoints (list): names of the endpoints
+        first_events (FirstEventsStore): first events dataset
+        cohort (DataFrame): cohort dataset, output of get_cohort()
+
+    Yields:
+        (endpoint, CIF) (tuple): endpoint and the output of cumulative_incidence_full_cohort()
+    """
+    risk_set = CohortRiskSet(cohort)
+    for endpoint in endpoints:
+        cases = get_cases(endpoint, first_events, risk_set.cohort)
+        yield endpoint, cumulative_incidence_full_cohort(endpoint, cases, risk_set)
+
+
+def cumulative_incidence_task(endpoint):
+    """
+    Pool task computing the CIF for `endpoint` from the shared cohort and first events.
+
+    Args:
+        endpoint (str): name of the endpoint
+
+    Returns:
+        CIF (DataFrame): output of cumulative_incidence_function()
+    """
+    cohort = get_shared("cohort")
+    first_events = FirstEventsStore(get_shared("first_events"), get_shared("first_events_offsets"))
+    cases = get_cases(endpoint, first_events, cohort)
+
+    return cumulative_incidence_function(endpoint, cases, cohort)
+
+
 if __name__ == "__main__":
-    from risteys_pipeline.finregistry.load_data import load_data
+    import sys
+    from risteys_pipeline.finregistry.load_data import load_data, INPUT_PATHS
     from risteys_pipeline.survival_analysis import get_cohort
-    from risteys_pipeline.utils.write_data import get_output_filepath
+    from risteys_pipeline.utils.manifest import Stage
+    from risteys_pipeline.utils.shared_frames import SharedFrames, init_shared_frames
+    from risteys_pipeline.utils.pool import imap_bounded
+    from risteys_pipeline.utils.write_data import append_csv, get_output_filepath
     from multiprocessing import get_context
     from tqdm import tqdm
 
     N_PROCESSES = 20
+    MAX_IN_FLIGHT = 2 * N_PROCESSES
+
+    # Usage: python run_cumulative_incidence.py [--full-cohort]
+    # --full-cohort: CIF of all the endpoints on the full cohort, in a single process,
+    # instead of sampled cases and controls for each endpoint
+    full_cohort = "--full-cohort" in sys.argv
+    stage_name = "cumulative_incidence_full_cohort" if full_cohort else "cumulative_incidence"
+
+    stage = Stage(
+        stage_name,
+        INPUT_PATHS,
+        ["FOLLOWUP_START", "FOLLOWUP_END", "MIN_SUBJECTS_PERSONAL_DATA", "MIN_SUBJECTS_SURVIVAL_ANALYSIS"],
+        [cumulative_incidence_function],
+        params={"full_cohort": full_cohort},
+    )
+    if stage.is_up_to_date():
+        sys.exit()
 
-    endpoint_definitions, minimal_phenotype, first_events = load_data()
+    endpoint_definitions, minimal_phenotype, first_events = load_data(first_events_store=True)
     n_endpoints = endpoint_definitions.shape[0]
 
     cohort = get_cohort(minimal_phenotype)
 
+    # Results are appended to the output file as the endpoints finish
+    output_file = get_output_filepath(stage_name, "csv")
+
+    if full_cohort:
+        with tqdm(total=n_endpoints, desc="Computing CIF") as pbar, open(output_file, "w") as f:
+            for endpoint, CIF in cumulative_incidence_all_endpoints(
+                endpoint_definitions["endpoint"], first_events, cohort
+            ):
+                if len(CIF) > 0:
+                    append_csv(CIF, f)
+                pbar.update()
+
+        stage.record([output_file])
+        sys.exit()
+
     logger.info("Start multiprocessing")
 
-    with get_context("spawn").Pool(processes=N_PROCESSES) as pool, tqdm(
+    with SharedFrames(
+        {"cohort": cohort, "first_events": first_events.events},
+        {"first_events_offsets": first_events.offsets},
+    ) as shared, get_context("spawn").Pool(
+        processes=N_PROCESSES, initializer=init_shared_frames, initargs=(shared.path,)
+    ) as pool, tqdm(
         total=n_endpoints, desc="Computing CIF"
-    ) as pbar:
-        result = [
-            pool.apply_async(
-                cumulative_incidence_function,
-                args=(endpoint, get_cases(endpoint, first_events, cohort), cohort),
-                callback=lambda _: pbar.update(),
-            )
-            for endpoint in endpoint_definitions["endpoint"]
-        ]
-        result = [r.get() for r in result]
-
-    result = [x for x in result if len(x) > 0]
-    result = pd.concat(result, axis=0, ignore_index=True)
-
-    logger.info("Writing output to file")
-    output_file = get_output_filepath("cumulative_incidence", "csv")
-    result.to_csv(output_file, index=False)
+    ) as pbar, open(output_file, "w") as f:
+        for endpoint, CIF in imap_bounded(
+            pool, cumulative_incidence_task, endpoint_definitions["endpoint"], MAX_IN_FLIGHT
+        ):
+            if len(CIF) > 0:
+                append_csv(CIF, f)
+            pbar.update()
+
+    stage.record([output_file])
@@ -2,53 +2,129 @@
 
 import numpy as np
 import pandas as pd
+from risteys_pipeline.count_cube import CountCube
 from risteys_pipeline.utils.log import logger
+from risteys_pipeline.utils.persons import take_demographics
 from risteys_pipeline.config import MIN_SUBJECTS_PERSONAL_DATA
 
+# Sexes of the distributions, in output order
+DISTRIBUTION_SEXES = ["all", "female", "male"]
+
 
 def green_distribution(dist):
     """
     Aggregate bins to have no individual-level data based on `MIN_SUBJECTS_PERSONAL_DATA`.
     Values 0 < x < MIN_PERSONAL_DATA are considered individual-level data.
 
+    Single-endpoint version of green_distribution_ends().
+
     Input:
         dist (DataFrame): distribution to be aggregated
 
     Returns:
         res (DataFrame): distribution with no individual-level data
     """
+    intervals = [interval for (endpoint, interval) in dist.index]
+    counts = np.asarray(dist.values, dtype=np.int64)[np.newaxis, :]
+    _, start, stop, count = green_bins(counts, green_distribution_ends(counts))
 
-    res = []
+    return [
+        {"left": intervals[left].left, "right": intervals[right].right, "count": n}
+        for left, right, n in zip(start, stop, count)
+    ]
+
+
+def green_distribution_ends(counts):
+    """
+    Aggregate bins to have no individual-level data, for all endpoints at once.
+
+    Bins are merged from left to right until the merged bin is empty or has
+    at least `MIN_SUBJECTS_PERSONAL_DATA` persons. If the last merged bin is
+    individual-level data, it is merged leftwards with the previous bins until
+    the count reaches `MIN_SUBJECTS_PERSONAL_DATA`.
+    Endpoints with less than `MIN_SUBJECTS_PERSONAL_DATA` persons get no bins.
+
+    Args:
+        counts (ndarray): (n_endpoints, n_bins) counts
+
+    Returns:
+        ends (ndarray): (n_endpoints, n_bins) True where an aggregated bin ends
+    """
+    n_endpoints, n_bins = counts.shape
+    ends = np.zeros(counts.shape, dtype=bool)
+
+    # Aggregate individual-level data up, one bin at a time for all the endpoints
+    acc_count = np.zeros(n_endpoints, dtype=np.int64)
+    for col in range(n_bins):
+        acc_count += counts[:, col]
+        ends[:, col] = (acc_count == 0) | (acc_count >= MIN_SUBJECTS_PERSONAL_DATA)
+        acc_count[ends[:, col]] = 0
+
+    # Trailing individual-level data: the bins ending before the last bin are
+    # merged with it as long as the count after them is individual-level data.
+    trailing = acc_count > 0
+    count_after = np.zeros(counts.shape, dtype=np.int64)
+    count_after[:, :-1] = np.cumsum(counts[:, :0:-1], axis=1)[:, ::-1]
+    ends[trailing] &= count_after[trailing] >= MIN_SUBJECTS_PERSONAL_DATA
+    ends[trailing, -1] = True
+
+    # Count too low to produce non individual-level data
+    ends[counts.sum(axis=1) < MIN_SUBJECTS_PERSONAL_DATA] = False
+
+    return ends
+
+
+def green_bins(counts, ends):
+    """
+    Get the aggregated bins from the bin ends of green_distribution_ends().
+
+    Args:
+        counts (ndarray): (n_endpoints, n_bins) counts
+        ends (ndarray): (n_endpoints, n_bins) aggregated bin ends
+
+    Returns:
+        (row, start, stop, count) (tuple): arrays with the endpoint row, the
+            first and last original bin and the count of each aggregated bin,
+            ordered by endpoint and bin
+    """
+    row, stop = np.nonzero(ends)
+    first_of_row = np.ones(row.shape[0], dtype=bool)
+    first_of_row[1:] = row[1:] != row[:-1]
+    prev_stop = np.concatenate([[-1], stop[:-1]])
+    start = np.where(first_of_row, 0, prev_stop + 1)
+
+    cum_counts = np.cumsum(counts, axis=1)
+    count = cum_counts[row, stop] - np.where(first_of_row, 0, cum_counts[row, prev_stop])
+
+    return row, start, stop, count
+
+
+def green_distribution_frame(endpoints, counts, brackets, sex):
+    """
+    Aggregate the bins of all endpoints and reshape them to a dataframe.
 
-    # Early return if the count is too low to produce non individual-level data
-    if dist.sum() >= MIN_SUBJECTS_PERSONAL_DATA:
-
-        # Initialize rolling bin lower bound and accumulated count
-        interval_left = None
-        acc_count = 0
-
-        # Aggregate individual-level data up and update the interval endpoints
-        for (endpoint, interval), count in dist.items():
-            acc_count += count
-            interval_left = interval.left if interval_left is None else interval_left
-            if (acc_count == 0) | (acc_count >= MIN_SUBJECTS_PERSONAL_DATA):
-                res.append(
-                    {"left": interval_left, "right": interval.right, "count": acc_count}
-                )
-                acc_count = 0
-                interval_left = None
-
-        # If the last count was personal-level data, it was discarded in the previous loop. Fixed here.
-        # The value is accumulated from right to left until it is added to a large enough bin
-        if (acc_count != 0) & (acc_count < MIN_SUBJECTS_PERSONAL_DATA):
-            res[-1]["count"] += acc_count
-            res[-1]["right"] = interval.right
-            while (res[-1]["count"] != 0) & (res[-1]["count"] < 5):
-                last = res.pop()
-                res[-1]["count"] += last["count"]
-                res[-1]["right"] = last["right"]
-
-    return res
+    Args:
+        endpoints (Index): endpoint of each row of `counts`
+        counts (ndarray): (n_endpoints, n_bins) counts
+        brackets (list): bin edges
+        sex (str): sex of the distribution, "all", "female" or "male"
+
+    Returns:
+        res (DataFrame): distribution with columns endpoint, sex, left, right, count
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    row, start, stop, count = green_bins(counts, green_distribution_ends(counts))
+    brackets = np.asarray(brackets, dtype=float)
+
+    return pd.DataFrame(
+        {
+            "endpoint": np.asarray(endpoints, dtype=object)[row],
+            "sex": sex,
+            "left": brackets[start],
+            "right": brackets[stop + 1],
+            "count": count,
+        }
+    )
 
 
 def compute_distribution(first_events, column):
@@ -56,7 +132,8 @@ def compute_distribution(first_events, column):
     Compute distribution of values in the given column (age/year) for all endpoints.
     Bins are aggregated so that each bar contains at least `MIN_SUBJECTS_PERSONAL_DATA` persons.
     
-    No sex-specific distributions are computed as they are currently not used.
+    Only the distribution for all is computed, see compute_distributions()
+    for the sex-specific distributions.
 
     Args:
         first_events (DataFrame): first events dataset
@@ -68,7 +145,89 @@ def compute_distribution(first_events, column):
 
     logger.info(f"Computing distribution for {column}")
 
-    # Add brackets
+    brackets = get_brackets(column, first_events["year"].max())
+
+    # Compute distribution
+    counts = (
+        first_events[["endpoint", column]]
+        .assign(bin=pd.cut(first_events[column], brackets, right=False))
+        .groupby(["endpoint", "bin"])
+        .size()
+        .unstack("bin")
+    )
+
+    return green_distribution_frame(counts.index, counts.values, brackets, "all")
+
+
+def compute_distributions(first_events, minimal_phenotype):
+    """
+    Compute the age and year distributions of all endpoints for all, females and males in a single scan.
+
+    The values are converted to integer bin codes and counted with one
+    bincount per column over (endpoint, sex, bin) codes, so the sex-specific
+    distributions come from the same counts as the distributions for all.
+    Bins are aggregated as in compute_distribution().
+
+    Args:
+        first_events (DataFrame): first events dataset
+        minimal_phenotype (DataFrame): code-indexed minimal phenotype dataset
+
+    Returns:
+        (dist_age, dist_year) (tuple): distributions with the sexes in DISTRIBUTION_SEXES
+    """
+    logger.info("Computing age and year distributions")
+
+    endpoint = first_events["endpoint"]
+    if isinstance(endpoint.dtype, pd.CategoricalDtype):
+        endpoint_codes = endpoint.cat.codes.values.astype(np.int64)
+        endpoints = endpoint.cat.categories
+    else:
+        endpoint_codes, endpoints = pd.factorize(endpoint, sort=True)
+
+    # 0: female, 1: male, 2: unknown
+    female = take_demographics(minimal_phenotype, first_events["personid"], ["female"])["female"].values
+    sex = np.full(female.shape[0], 2, dtype=np.int64)
+    sex[female == True] = 0
+    sex[female == False] = 1
+
+    max_year = first_events["year"].max()
+    res = []
+    for column in ["age", "year"]:
+        brackets = get_brackets(column, max_year)
+        n_bins = len(brackets) - 1
+
+        # Bin [left, right) of each value, values outside the brackets are not counted
+        values = first_events[column].values
+        bins = np.searchsorted(brackets, values, side="right") - 1
+        valid = (bins >= 0) & (bins < n_bins) & ~np.isnan(values)
+
+        key = (endpoint_codes[valid] * 3 + sex[valid]) * n_bins + bins[valid]
+        counts = np.bincount(key, minlength=len(endpoints) * 3 * n_bins).reshape(len(endpoints), 3, n_bins)
+        counts_by_sex = {
+            "all": counts.sum(axis=1),
+            "female": counts[:, 0],
+            "male": counts[:, 1],
+        }
+
+        res.append(pd.concat(
+            [green_distribution_frame(endpoints, counts_by_sex[sex_name], brackets, sex_name) for sex_name in DISTRIBUTION_SEXES],
+            ignore_index=True,
+        ))
+
+    return tuple(res)
+
+
+def get_brackets(column, max_year):
+    """
+    Get the bin edges of the age or year distribution.
+
+    Args:
+        column (str): "age" or "year"
+        max_year (float): latest event year
+
+    Returns:
+        brackets (list): bin edges
+    """
     if column == "age":
         min_age = 0
         max_age = 100
@@ -76,39 +235,72 @@ def compute_distribution(first_events, column):
         brackets = list(range(min_age, max_age, by_age)) + [np.inf]
     elif column == "year":
         min_year = 1970
-        max_year = round(first_events["year"].max())
+        max_year = round(max_year)
         by_year = 5
         brackets = [np.NINF] + list(range(min_year, max_year, by_year)) + [max_year]
+    else:
+        raise ValueError("Column must be 'age' or 'year'")
 
-    # Compute distribution
-    dist = (
-        first_events[["endpoint", column]]
-        .assign(bin=pd.cut(first_events[column], brackets, right=False))
-        .groupby(["endpoint", "bin"])
-        .size()
-        .sort_index()
-        .groupby("endpoint")
-        .apply(lambda x: green_distribution(x))
-    )
+    return brackets
 
-    # Reshape dataframe
-    res = []
-    for endpoint, bins in dist.items():
-        for bin in bins:
-            res.append([endpoint, "all", bin["left"], bin["right"], bin["count"]])
-    res = pd.DataFrame(res, columns=["endpoint", "sex", "left", "right", "count"])
 
-    return res
+def compute_distribution_from_cube(cube, column, sex="all"):
+    """
+    Compute the distribution of age or year for all endpoints from a count cube.
+
+    Same output as compute_distribution(), without reading the first events.
+
+    Args:
+        cube (CountCube): count cube of the first events
+        column (str): column used for the distributions; "age" or "year"
+        sex (str, default "all"): "all", "female" or "male"
+
+    Returns:
+        res (DataFrame): distribution of values
+    """
+    logger.info(f"Computing distribution for {column} and sex {sex} from the count cube")
+
+    brackets = get_brackets(column, cube.max_year)
+    counts = cube.marginal(["endpoint", column], sexes=None if sex == "all" else [sex])
+    bins = cube.age_bins if column == "age" else cube.year_bins
+    counts = bins.aggregate(counts, brackets)
+
+    return green_distribution_frame(cube.endpoints, counts, brackets, sex)
 
 
 if __name__ == "__main__":
-    from risteys_pipeline.finregistry.load_data import load_data
+    import sys
+    from risteys_pipeline.finregistry.load_data import load_data, INPUT_PATHS
+    from risteys_pipeline.utils.manifest import Stage
     from risteys_pipeline.utils.write_data import get_output_filepath
 
+    stage = Stage(
+        "distributions",
+        INPUT_PATHS,
+        ["MIN_SUBJECTS_PERSONAL_DATA"],
+        [compute_distribution],
+    )
+    if stage.is_up_to_date():
+        sys.exit()
+
     endpoint_definitions, minimal_phenotype, first_events = load_data()
 
-    dist_age = compute_distribution(first_events, "age")
-    dist_year = compute_distribution(first_events, "year")
+    # Single pass over the first events, the distributions are derived from the cube
+    cube = CountCube.from_first_events(first_events, minimal_phenotype)
+    dist_age, dist_year = [
+        pd.concat(
+            [compute_distribution_from_cube(cube, column, sex) for sex in DISTRIBUTION_SEXES],
+            ignore_index=True,
+        )
+        for column in ["age", "year"]
+    ]
+
+    path_cube = get_output_filepath("count_cube", "npz")
+    path_age = get_output_filepath("distribution_age", "csv")
+    path_year = get_output_filepath("distribution_year", "csv")
+
+    cube.save(path_cube)
+    dist_age.to_csv(path_age, index=False)
+    dist_year.to_csv(path_year, index=False)
 
-    dist_age.to_csv(get_output_filepath("distribution_age", "csv"), index=False)
-    dist_year.to_csv(get_output_filepath("distribution_year", "csv"), index=False)
+    stage.record([path_cube, path_age, path_year])
@@ -1,12 +1,220 @@
 """Functions for computing key figures"""
 
+from functools import reduce
+from multiprocessing import get_context
 import numpy as np
 import pandas as pd
+import pyarrow.parquet as parquet
 from risteys_pipeline.utils.log import logger
+from risteys_pipeline.utils.persons import encode_personid, take_demographics
+from risteys_pipeline.utils.quantile_sketch import HistogramSketch
 from risteys_pipeline.config import MIN_SUBJECTS_PERSONAL_DATA
 
 N_DECIMALS = 4
 
+# Age bins of the out-of-core mode: the medians are within
+# AGE_SKETCH_RESOLUTION / 2 years of the exact medians
+AGE_SKETCH_RESOLUTION = 0.01
+AGE_SKETCH_LOWER = 0.0
+AGE_SKETCH_UPPER = 130.0
+
+# Person ID, endpoint and age columns of the long-format first events file
+FIRST_EVENTS_COLUMNS = ("FINREGISTRYID", "ENDPOINT", "AGE")
+
+# Sex codes used for grouping, in the order of SEXES
+SEXES = ["female", "male", "unknown"]
+SEX_FEMALE, SEX_MALE, SEX_UNKNOWN = range(len(SEXES))
+
+
+def get_sex_codes(female):
+    """Encode the `female` column (True, False, missing) as SEX_FEMALE, SEX_MALE, SEX_UNKNOWN"""
+    female = np.asarray(female)
+    codes = np.full(female.shape[0], SEX_UNKNOWN, dtype=np.int8)
+    codes[female == True] = SEX_FEMALE
+    codes[female == False] = SEX_MALE
+    return codes
+
+
+def grouped_medians(group, values, n_groups, subsets):
+    """
+    Compute the median of `values` by group, for several subsets of rows.
+
+    Missing values are ignored. The rows are sorted once by group and value,
+    each subset keeps this order so its medians are read at the middle
+    positions of each group.
+
+    Args:
+        group (ndarray): group number of each row, in 0..n_groups-1
+        values (ndarray): values of each row
+        n_groups (int): number of groups
+        subsets (list): boolean masks of the rows to include, None for all rows
+
+    Returns:
+        medians (list): one array of n_groups medians per subset, NaN for empty groups
+    """
+    valid = ~np.isnan(values)
+    group = group[valid]
+    values = values[valid]
+    # Sort by value, then stable sort by group: the stable sort of small
+    # integers is a radix sort, faster than np.lexsort on both keys
+    order = np.argsort(values)
+    group_dtype = np.min_scalar_type(max(n_groups - 1, 0))
+    order = order[np.argsort(group[order].astype(group_dtype), kind="stable")]
+    group = group[order]
+    values = values[order]
+
+    medians = []
+    for subset in subsets:
+        if subset is None:
+            group_sub, values_sub = group, values
+        else:
+            keep = subset[valid][order]
+            group_sub, values_sub = group[keep], values[keep]
+        counts = np.bincount(group_sub, minlength=n_groups)
+        starts = np.cumsum(counts) - counts
+        res = np.full(n_groups, np.nan)
+        has_values = counts > 0
+        lower = starts[has_values] + (counts[has_values] - 1) // 2
+        upper = starts[has_values] + counts[has_values] // 2
+        res[has_values] = (values_sub[lower] + values_sub[upper]) / 2
+        medians.append(res)
+
+    return medians
+
+
+def key_figures_table(endpoints, nindivs, median_age, n_total, all_endpoints):
+    """
+    Build the key figures table from the counts and medians by endpoint and sex.
+
+    Args:
+        endpoints (Index): endpoint names, categorical for categorical endpoints
+        nindivs (ndarray): (n_endpoints, 3) number of individuals by endpoint and sex
+        median_age (ndarray): (n_endpoints, 3) median age by endpoint and sex
+        n_total (ndarray): number of individuals by sex
+        all_endpoints (bool): keep the endpoints without events (categorical endpoints)
+
+    Returns:
+        kf (DataFrame): key figures dataframe, see compute_key_figures()
+    """
+    # Same rows as a groupby on endpoint and sex
+    observed_sexes = nindivs.sum(axis=0) > 0
+    included = np.zeros_like(nindivs, dtype=bool)
+    if all_endpoints:
+        included[:, observed_sexes] = True
+    else:
+        included = nindivs > 0
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        prevalence = nindivs / n_total
+
+        # Weighted means across sexes, weighted by the number of individuals
+        n_endpoint = np.where(included, nindivs, 0).sum(axis=1)
+        has_events = nindivs > 0
+        median_age_all = np.where(has_events, median_age * nindivs, 0).sum(axis=1) / n_endpoint
+        prevalence_all = np.where(has_events, prevalence * nindivs, 0).sum(axis=1) / n_endpoint
+
+    endpoint_idx, sex_idx = np.nonzero(included)
+    kf = pd.DataFrame({
+        "endpoint": endpoints[endpoint_idx],
+        "sex": np.array(SEXES)[sex_idx],
+        "nindivs_": nindivs[endpoint_idx, sex_idx],
+        "median_age_": median_age[endpoint_idx, sex_idx],
+        "prevalence_": prevalence[endpoint_idx, sex_idx],
+    })
+
+    endpoint_rows = np.flatnonzero(included.any(axis=1))
+    kf_all = pd.DataFrame({
+        "endpoint": endpoints[endpoint_rows],
+        "sex": "all",
+        "nindivs_": n_endpoint[endpoint_rows],
+        "median_age_": median_age_all[endpoint_rows],
+        "prevalence_": prevalence_all[endpoint_rows],
+    })
+
+    # Drop rows with sex=unknown
+    kf = kf.loc[kf["sex"] != "unknown"].reset_index(drop=True)
+
+    # Combine the two datasets
+    kf = pd.concat([kf, kf_all])
+
+    # Remove personal data
+    cols = ["nindivs_", "median_age_", "prevalence_"]
+    kf.loc[kf["nindivs_"] < MIN_SUBJECTS_PERSONAL_DATA, cols,] = np.nan
+
+    # Round floats
+    kf["median_age_"] = kf["median_age_"].round(N_DECIMALS)
+    kf["prevalence_"] = kf["prevalence_"].round(N_DECIMALS)
+
+    # Pivot and flatten hierarchical columns
+    kf = kf.pivot(index="endpoint", columns="sex").reset_index()
+    kf.columns = ["".join(col).strip() for col in kf.columns.values]
+
+    return kf
+
+
+def count_by_sex(minimal_phenotype):
+    """Total number of individuals by sex, for everyone and for index persons"""
+    sex = get_sex_codes(minimal_phenotype["female"].values)
+    index_person = (minimal_phenotype["index_person"] == True).values
+    return [
+        np.bincount(sex, minlength=len(SEXES)),
+        np.bincount(sex[index_person], minlength=len(SEXES)),
+    ]
+
+
+def compute_key_figures_all_and_index(first_events, minimal_phenotype):
+    """
+    Compute the key figures for everyone and for index persons only, in a single pass.
+
+    The first events are grouped once by endpoint and sex: the numbers of
+    individuals are counted with bincount and the medians are read from a
+    single sort of the ages, see grouped_medians().
+    The input frames are not copied.
+
+    Args:
+        first_events (DataFrame): first events dataframe
+        minimal_phenotype(DataFrame): code-indexed minimal phenotype dataframe
+
+    Returns:
+        (kf_all, kf_index_persons) (tuple): key figures dataframes, see compute_key_figures()
+    """
+    logger.info("Computing key figures for everyone and for index persons")
+
+    endpoint = first_events["endpoint"]
+    all_endpoints = isinstance(endpoint.dtype, pd.CategoricalDtype)
+    if all_endpoints:
+        endpoint_codes = endpoint.cat.codes.values.astype(np.int64)
+        # Keep the category order in the output, as a groupby on the categories does
+        endpoints = pd.CategoricalIndex(endpoint.cat.categories, dtype=endpoint.dtype)
+    else:
+        endpoint_codes, endpoints = pd.factorize(endpoint)
+    n_groups = len(endpoints) * len(SEXES)
+
+    # Look up sex and index person status by person code
+    demographics = take_demographics(minimal_phenotype, first_events["personid"], ["female", "index_person"])
+    group = endpoint_codes * len(SEXES) + get_sex_codes(demographics["female"].values)
+    is_index = (demographics["index_person"] == True).values
+
+    nindivs = [
+        np.bincount(group, minlength=n_groups),
+        np.bincount(group[is_index], minlength=n_groups),
+    ]
+    median_age = grouped_medians(group, first_events["age"].values.astype(float), n_groups, [None, is_index])
+
+    n_total = count_by_sex(minimal_phenotype)
+
+    return tuple(
+        key_figures_table(
+            endpoints,
+            nindivs[variant].reshape(-1, len(SEXES)),
+            median_age[variant].reshape(-1, len(SEXES)),
+            n_total[variant],
+            all_endpoints,
+        )
+        for variant in range(2)
+    )
+
+
 def compute_key_figures(first_events, minimal_phenotype, index_persons=False):
     """
     Compute the following key figures for each endpoint:
@@ -16,10 +224,11 @@ def compute_key_figures(first_events, minimal_phenotype, index_persons=False):
 
     The numbers are calculated for males, females, and all.
     Floats are rounded to N_DECIMALS digits.
+    The figures for all are means of the figures by sex, weighted by the number of individuals.
 
     Args:
         first_events (DataFrame): first events dataframe
-        minimal_phenotype(DataFrame): minimal phenotype dataframe
+        minimal_phenotype(DataFrame): code-indexed minimal phenotype dataframe
         index_persons (bool): compute key figures for index persons only (True) or everyone (False)
 
     Returns:
@@ -29,91 +238,180 @@ def compute_key_figures(first_events, minimal_phenotype, index_persons=False):
         median_age_male, median_age_all,
         prevalence_female, prevalence_male, prevalence_all
     """
-    logger.info(
-        "Computing key figures" + (" for index persons" if index_persons else "")
-    )
+    kf_all, kf_index_persons = compute_key_figures_all_and_index(first_events, minimal_phenotype)
+    return kf_index_persons if index_persons else kf_all
 
-    mp = minimal_phenotype.copy()
-    fe = first_events.copy()
-
-    # Only include index_persons if specified
-    if index_persons:
-        mp = mp.loc[mp["index_person"] == True].reset_index(drop=True)
-        fe = fe.loc[fe["index_person"] == True].reset_index(drop=True)
-
-    # Calculate the total number of individuals
-    n_total = {
-        "female": sum(mp["female"] == True),
-        "male": sum(mp["female"] == False),
-        "unknown": sum(mp["female"].isnull()),
-    }
-
-    # Calculate key figures by endpoint and sex
-    kf = (
-        fe.assign(
-            sex=fe["female"].replace({True: "female", False: "male", np.nan: "unknown"})
-        )
-        .groupby(["endpoint", "sex"])
-        .agg({"personid": "count", "age": "median"})
-        .rename(columns={"personid": "nindivs_", "age": "median_age_"})
-        .fillna({"nindivs_": 0})
-        .reset_index()
-    )
-    kf["prevalence_"] = kf["nindivs_"] / kf["sex"].replace(n_total)
-    kf["n_endpoint"] = kf.groupby("endpoint")["nindivs_"].transform("sum")
-    kf["w"] = kf["nindivs_"] / kf["n_endpoint"]
-
-    # Calculate key figures by endpoint for all individuals
-    kf_all = (
-        kf.groupby("endpoint")
-        .agg(
-            {
-                "nindivs_": "sum",
-                "median_age_": lambda x: np.average(x, weights=kf.loc[x.index, "w"]),
-                "prevalence_": lambda x: np.average(x, weights=kf.loc[x.index, "w"]),
-            }
+
+def sketch_first_events(path, row_groups, minimal_phenotype, endpoints, columns, resolution):
+    """
+    Sketch the ages at first event of some row groups of a Parquet file.
+
+    The sketch groups are (endpoint, sex, index person) combinations,
+    numbered (endpoint * len(SEXES) + sex) * 2 + index_person.
+
+    Args:
+        path (str): long-format first events Parquet file
+        row_groups (list): row groups to read
+        minimal_phenotype (DataFrame): code-indexed minimal phenotype dataframe
+        endpoints (Index): endpoints to include, events of other endpoints are skipped
+        columns (tuple): person ID, endpoint and age columns
+        resolution (float): bin width of the ages
+
+    Returns:
+        sketch (HistogramSketch): counts and age sketch by group
+    """
+    person_col, endpoint_col, age_col = columns
+    sketch = HistogramSketch(resolution, AGE_SKETCH_LOWER, AGE_SKETCH_UPPER)
+    parquet_file = parquet.ParquetFile(path)
+
+    for row_group in row_groups:
+        df = parquet_file.read_row_group(row_group, columns=list(columns)).to_pandas()
+        endpoint_codes = endpoints.get_indexer(df[endpoint_col])
+        known = endpoint_codes >= 0
+        personid = encode_personid(df[person_col].values[known], minimal_phenotype)
+        demographics = take_demographics(minimal_phenotype, personid, ["female", "index_person"])
+        sex = get_sex_codes(demographics["female"].values)
+        is_index = (demographics["index_person"] == True).values
+        group = (endpoint_codes[known] * len(SEXES) + sex) * 2 + is_index
+        sketch.update(group, df[age_col].values[known])
+
+    return sketch
+
+
+def key_figures_from_sketch(sketch, endpoints, minimal_phenotype):
+    """
+    Compute the key figures for everyone and for index persons from a merged sketch.
+
+    Args:
+        sketch (HistogramSketch): sketch from sketch_first_events()
+        endpoints (Index): endpoints used to build the sketch
+        minimal_phenotype (DataFrame): code-indexed minimal phenotype dataframe
+
+    Returns:
+        (kf_all, kf_index_persons) (tuple): key figures dataframes, see compute_key_figures()
+    """
+    n_groups = len(endpoints) * len(SEXES)
+    group = np.arange(n_groups * 2)
+    variants = [
+        sketch.map_groups(group // 2),
+        sketch.map_groups(np.where(group % 2 == 1, group // 2, -1)),
+    ]
+    n_total = count_by_sex(minimal_phenotype)
+
+    return tuple(
+        key_figures_table(
+            endpoints,
+            variant.group_counts(n_groups).reshape(-1, len(SEXES)),
+            variant.quantile(0.5, n_groups).reshape(-1, len(SEXES)),
+            n_total[idx],
+            all_endpoints=False,
         )
-        .reset_index()
-        .assign(sex="all")
+        for idx, variant in enumerate(variants)
     )
 
-    # Drop rows with sex=unknown
-    kf = kf.loc[kf["sex"] != "unknown"].reset_index(drop=True)
 
-    # Combine the two datasets
-    kf = pd.concat([kf, kf_all])
+def compute_key_figures_out_of_core(
+    path,
+    minimal_phenotype,
+    endpoints,
+    columns=FIRST_EVENTS_COLUMNS,
+    n_processes=1,
+    resolution=AGE_SKETCH_RESOLUTION,
+):
+    """
+    Compute the key figures for everyone and for index persons without loading the first events.
 
-    # Drop redundant columns
-    kf = kf.drop(columns=["w", "n_endpoint"])
+    The row groups of the long-format first events file are split between
+    `n_processes` processes. Each process keeps only a sketch of the ages by
+    endpoint, sex and index person status, and the sketches are merged.
+    The numbers of individuals and prevalences are exact, the median ages
+    are within `resolution / 2` years of the exact medians.
 
-    # Remove personal data
-    cols = ["nindivs_", "median_age_", "prevalence_"]
-    kf.loc[kf["nindivs_"] < MIN_SUBJECTS_PERSONAL_DATA, cols,] = np.nan
+    Args:
+        path (str): long-format first events Parquet file
+        minimal_phenotype (DataFrame): code-indexed minimal phenotype dataframe
+        endpoints (list): endpoints to include
+        columns (tuple, optional): person ID, endpoint and age columns of the file
+        n_processes (int, optional): number of processes
+        resolution (float, optional): bin width of the ages, in years
 
-    # Round floats
-    kf["median_age_"] = kf["median_age_"].round(N_DECIMALS)
-    kf["prevalence_"] = kf["prevalence_"].round(N_DECIMALS)
+    Returns:
+        (kf_all, kf_index_persons) (tuple): key figures dataframes, see compute_key_figures()
+    """
+    logger.info("Computing key figures out of core")
 
-    # Pivot and flatten hierarchical columns
-    kf = kf.pivot(index="endpoint", columns="sex").reset_index()
-    kf.columns = ["".join(col).strip() for col in kf.columns.values]
+    endpoints = pd.Index(endpoints).unique().sort_values()
+    n_row_groups = parquet.ParquetFile(path).num_row_groups
+    chunks = [
+        (path, chunk.tolist(), minimal_phenotype, endpoints, columns, resolution)
+        for chunk in np.array_split(np.arange(n_row_groups), n_processes)
+    ]
 
-    return kf
+    if n_processes == 1:
+        sketches = [sketch_first_events(*chunk) for chunk in chunks]
+    else:
+        with get_context("spawn").Pool(processes=n_processes) as pool:
+            sketches = pool.starmap(sketch_first_events, chunks)
+    sketch = reduce(HistogramSketch.merge, sketches)
+
+    return key_figures_from_sketch(sketch, endpoints, minimal_phenotype)
 
 
 if __name__ == "__main__":
-    from risteys_pipeline.finregistry.load_data import load_data
+    import sys
+    from risteys_pipeline.finregistry.load_data import load_data, INPUT_PATHS
+    from risteys_pipeline.utils.manifest import Stage
     from risteys_pipeline.utils.write_data import get_output_filepath
 
-    endpoint_definitions, minimal_phenotype, first_events = load_data()
+    # Usage: python run_key_figures.py [--out-of-core <long-format first events Parquet file>]
+    # --out-of-core: approximate medians from mergeable age sketches, reading the
+    # first events from the Parquet file in chunks instead of loading them in memory
+    out_of_core = "--out-of-core" in sys.argv
+    if out_of_core:
+        stage_name = "key_figures_out_of_core"
+        first_events_path = sys.argv[sys.argv.index("--out-of-core") + 1]
+        input_paths = INPUT_PATHS + [first_events_path]
+    else:
+        stage_name = "key_figures"
+        input_paths = INPUT_PATHS
 
-    kf_all = compute_key_figures(first_events, minimal_phenotype, index_persons=False)
-    kf_index_persons = compute_key_figures(
-        first_events, minimal_phenotype, index_persons=True
+    stage = Stage(
+        stage_name,
+        input_paths,
+        ["MIN_SUBJECTS_PERSONAL_DATA"],
+        [compute_key_figures_all_and_index],
+        params={"out_of_core": out_of_core},
     )
+    if stage.is_up_to_date():
+        sys.exit()
 
-    path_all = get_output_filepath("key_figures_all", "csv")
-    path_index = get_output_filepath("key_figures_index", "csv")
+    if out_of_core:
+        from risteys_pipeline.finregistry.load_data import (
+            load_endpoint_definitions_data,
+            load_minimal_phenotype_data,
+        )
+
+        N_PROCESSES = 20
+
+        endpoint_definitions = load_endpoint_definitions_data()
+        minimal_phenotype = load_minimal_phenotype_data()
+        kf_all, kf_index_persons = compute_key_figures_out_of_core(
+            first_events_path,
+            minimal_phenotype,
+            endpoint_definitions["endpoint"],
+            n_processes=N_PROCESSES,
+        )
+    else:
+        endpoint_definitions, minimal_phenotype, first_events = load_data()
+        kf_all, kf_index_persons = compute_key_figures_all_and_index(
+            first_events, minimal_phenotype
+        )
+
+    # Separate files for each mode, so that they don't overwrite each other
+    path_all = get_output_filepath(f"{stage_name}_all", "csv")
+    path_index = get_output_filepath(f"{stage_name}_index", "csv")
 
     kf_all.to_csv(path_all, index=False)
     kf_index_persons.to_csv(path_index, index=False)
+
+    stage.record([path_all, path_index])
@@ -4,6 +4,8 @@ import pandas as pd
 import numpy as np
 
 from risteys_pipeline.utils.log import logger
+from risteys_pipeline.utils.shared_frames import get_shared
+from risteys_pipeline.first_events_store import FirstEventsStore
 from risteys_pipeline.config import (
     MIN_SUBJECTS_PERSONAL_DATA,
     MIN_SUBJECTS_SURVIVAL_ANALYSIS,
@@ -130,11 +132,13 @@ def mortality_analysis(endpoint, cases, exposed, cohort):
             cases_ = cases.loc[cases["female"] == sex]
             cohort_ = cohort.loc[cohort["female"] == sex]
 
-            df_survival = build_survival_dataset(cases_, cohort_, exposed)
+            df_survival, n_persons = build_survival_dataset(
+                cases_, cohort_, exposed, return_counts=True
+            )
             df_survival = set_timescale(df_survival, "age")
             df_survival = df_survival.drop(columns=["female"])
 
-            model = survival_analysis(df_survival, "cox")
+            model = survival_analysis(df_survival, "cox", n_persons)
 
             if model is not None:
 
@@ -208,18 +212,50 @@ def mortality_analysis(endpoint, cases, exposed, cohort):
     return (params, cumulative_baseline_hazard, counts)
 
 
+def mortality_task(endpoint):
+    """
+    Pool task running the mortality analysis for `endpoint` from the shared
+    cohort, first events and mortality cases.
+
+    Args:
+        endpoint (str): name of the endpoint
+
+    Returns:
+        (params, cumulative_baseline_hazard, counts) (tuple): output of mortality_analysis()
+    """
+    cohort = get_shared("cohort")
+    first_events = FirstEventsStore(get_shared("first_events"), get_shared("first_events_offsets"))
+    mortality_cases = get_shared("mortality_cases")
+    exposed = get_exposed(endpoint, first_events, cohort, mortality_cases)
+
+    return mortality_analysis(endpoint, mortality_cases, exposed, cohort)
+
+
 if __name__ == "__main__":
     import pandas as pd
-    from risteys_pipeline.finregistry.load_data import load_data
+    import sys
+    from risteys_pipeline.finregistry.load_data import load_data, INPUT_PATHS
     from risteys_pipeline.survival_analysis import get_cohort
-    from risteys_pipeline.utils.write_data import get_output_filepath
+    from risteys_pipeline.utils.manifest import Stage
+    from risteys_pipeline.utils.shared_frames import SharedFrames, init_shared_frames
+    from risteys_pipeline.utils.pool import imap_bounded
+    from risteys_pipeline.utils.write_data import append_csv, get_output_filepath
     from multiprocessing import get_context
-    from functools import partial
     from tqdm import tqdm
 
     N_PROCESSES = 20
+    MAX_IN_FLIGHT = 2 * N_PROCESSES
+
+    stage = Stage(
+        "mortality",
+        INPUT_PATHS,
+        ["FOLLOWUP_START", "FOLLOWUP_END", "MIN_SUBJECTS_PERSONAL_DATA", "MIN_SUBJECTS_SURVIVAL_ANALYSIS"],
+        [mortality_analysis],
+    )
+    if stage.is_up_to_date():
+        sys.exit()
 
-    endpoint_definitions, minimal_phenotype, first_events = load_data()
+    endpoint_definitions, minimal_phenotype, first_events = load_data(first_events_store=True)
     # All results will be discarded if the output files are not writable, so
     # we open them before running the analyses.
     logger.info("Checking that output files are writable")
@@ -231,38 +267,32 @@ if __name__ == "__main__":
 
     cohort = get_cohort(minimal_phenotype)
     mortality_cases = get_cases("death", first_events, cohort)
-    get_exposed_ = partial(
-        get_exposed, first_events=first_events, cohort=cohort, cases=mortality_cases
-    )
 
     logger.info("Start multiprocessing")
 
-    with get_context("spawn").Pool(processes=N_PROCESSES) as pool, tqdm(
+    # Results are appended to the output files as the endpoints finish
+    with SharedFrames(
+        {"cohort": cohort, "first_events": first_events.events, "mortality_cases": mortality_cases},
+        {"first_events_offsets": first_events.offsets},
+    ) as shared, get_context("spawn").Pool(
+        processes=N_PROCESSES, initializer=init_shared_frames, initargs=(shared.path,)
+    ) as pool, tqdm(
         total=n_endpoints, desc="Mortality"
     ) as pbar:
-        result = [
-            pool.apply_async(
-                mortality_analysis,
-                args=(endpoint, mortality_cases, get_exposed_(endpoint), cohort,),
-                callback=lambda _: pbar.update(),
-            )
-            for endpoint in endpoint_definitions["endpoint"]
-        ]
-        result = [r.get() for r in result]
-
-    params = [x[0] for x in result if len(x[0]) > 0]
-    bch = [x[1] for x in result if len(x[1]) > 0]
-    counts = [x[2] for x in result if len(x[2]) > 0]
-
-    params = pd.concat(params, axis=0, ignore_index=True)
-    bch = pd.concat(bch, axis=0, ignore_index=True)
-    counts = pd.concat(counts, axis=0, ignore_index=True)
-
-    logger.info("Writing output to file")
-    params.to_csv(params_output_file, index=False)
-    bch.to_csv(bch_output_file, index=False)
-    counts.to_csv(counts_output_file, index=False)
+        for endpoint, (params, bch, counts) in imap_bounded(
+            pool, mortality_task, endpoint_definitions["endpoint"], MAX_IN_FLIGHT
+        ):
+            for df, output_file in [
+                (params, params_output_file),
+                (bch, bch_output_file),
+                (counts, counts_output_file),
+            ]:
+                if len(df) > 0:
+                    append_csv(df, output_file)
+            pbar.update()
 
     params_output_file.close()
     bch_output_file.close()
     counts_output_file.close()
+
+    stage.record([params_output_file.name, bch_output_file.name, counts_output_file.name])
@@ -1,9 +1,10 @@
 import numpy as np
 import pandas as pd
 
-from lifelines import CoxPHFitter, AalenJohansenFitter
 from lifelines.utils import ConvergenceError
 
+from risteys_pipeline.aalen_johansen import AalenJohansen
+from risteys_pipeline.cox import WeightedCoxPH
 from risteys_pipeline.utils.log import logger
 from risteys_pipeline.config import (
     FOLLOWUP_START,
@@ -12,6 +13,7 @@ from risteys_pipeline.config import (
     MIN_SUBJECTS_SURVIVAL_ANALYSIS,
 )
 from risteys_pipeline.sample import sample_cases, sample_controls
+from risteys_pipeline.first_events_store import FirstEventsStore
 
 DAYS_IN_YEAR = 365.25
 OUTCOME_COMPETING_EVENT = 2
@@ -68,10 +70,11 @@ def get_cases(outcome, first_events, cohort):
 
     Args:
         outcome (str): outcome endpoint
-        first_events (DataFrame): first events dataset 
+        first_events (DataFrame or FirstEventsStore): first events dataset,
+            a FirstEventsStore only reads the rows of `outcome`
         cohort (DataFrame): cohort dataset
 
-    Returns: 
+    Returns:
         cases (DataFrame): dataset with all persons with `endpoint`
     """
     if (outcome == "death") | (outcome == "DEATH"):
@@ -79,11 +82,14 @@ def get_cases(outcome, first_events, cohort):
         # Note: should be re-implemented if censoring can occur for different reasons than death, e.g. immigration
         cases = cohort.loc[cohort["stop"] < FOLLOWUP_END].copy()
     else:
+        if isinstance(first_events, FirstEventsStore):
+            events = first_events.get(outcome)
+        else:
+            events = first_events.loc[first_events["endpoint"].values == outcome]
         cases = (
-            first_events.loc[
-                (first_events["endpoint"].values == outcome)
-                & (first_events["year"].values > FOLLOWUP_START)
-                & (first_events["year"].values < FOLLOWUP_END)
+            events.loc[
+                (events["year"].values > FOLLOWUP_START)
+                & (events["year"].values < FOLLOWUP_END)
             ]
             .filter(["personid", "year"])
             .set_index("personid")
@@ -107,7 +113,7 @@ def get_exposed(exposure, first_events, cohort, cases, buffer=30):
 
     Args:
         exposure (str): exposure endpoint
-        first_events (DataFrame): first events dataset
+        first_events (DataFrame or FirstEventsStore): first events dataset
         cohort (DataFrame): cohort dataset
         cases (DataFrame): cases dataset
         buffer (int): number of days required between exposure and outcome
@@ -126,6 +132,86 @@ def get_exposed(exposure, first_events, cohort, cases, buffer=30):
     return exposed[["exposure_year", "exposure"]]
 
 
+def split_episodes(df_survival, exposures, min_duration=0.0):
+    """
+    Split the follow-up of each person into episodes of constant exposure.
+
+    Builds the counting-process dataset in one pass over NumPy arrays.
+    A person exposed at time `t` during the follow-up has two episodes per
+    exposure, start -> t unexposed and t -> stop exposed, and persons with
+    several exposures have one episode between each of their exposure
+    times. The outcome is kept on the last episode only. Persons exposed
+    before their start are exposed during the whole follow-up.
+
+    Args:
+        df_survival (DataFrame): survival dataset with one row per person and
+            the columns `personid`, `start`, `stop` and `outcome`
+        exposures (dict): name of the exposure column -> exposed dataset
+            indexed by personid, with an `exposure_year` column, see get_exposed()
+        min_duration (float, default 0): episodes must be longer than this
+
+    Returns:
+        (df_survival, counts) (tuple): dataset with one row per episode and
+            one 0/1 column per exposure, and the number of persons by outcome
+            and exposures, see check_min_subjects()
+    """
+    names = list(exposures)
+    personid = df_survival["personid"].values
+    start = df_survival["start"].values
+    stop = df_survival["stop"].values
+    n_persons = df_survival.shape[0]
+
+    # Exposure times, +inf if not exposed
+    exposure_times = np.full((n_persons, len(names)), np.inf)
+    for k, name in enumerate(names):
+        exposed = exposures[name]
+        rows = exposed.index.get_indexer(personid)
+        is_exposed = rows >= 0
+        exposure_times[is_exposed, k] = exposed["exposure_year"].values[rows[is_exposed]]
+
+    # Episode boundaries: start, exposure times during the follow-up, stop
+    inner = (exposure_times > start[:, np.newaxis]) & (exposure_times < stop[:, np.newaxis])
+    n_cuts = inner.sum(axis=1)
+    boundaries = np.concatenate(
+        [
+            start[:, np.newaxis],
+            np.sort(np.where(inner, exposure_times, np.inf), axis=1),
+            np.full((n_persons, 1), np.inf),
+        ],
+        axis=1,
+    )
+    boundaries[np.arange(n_persons), n_cuts + 1] = stop
+
+    # One row per episode
+    n_episodes = n_cuts + 1
+    rows = np.repeat(np.arange(n_persons), n_episodes)
+    episode = np.arange(rows.shape[0]) - np.repeat(np.cumsum(n_episodes) - n_episodes, n_episodes)
+    episode_start = boundaries[rows, episode]
+    episode_stop = boundaries[rows, episode + 1]
+    last = episode == n_cuts[rows]
+
+    keep = episode_stop - episode_start > min_duration
+    rows = rows[keep]
+    episode_start = episode_start[keep]
+
+    df_episodes = df_survival.take(rows).reset_index(drop=True)
+    df_episodes["start"] = episode_start
+    df_episodes["stop"] = episode_stop[keep]
+    df_episodes["outcome"] = np.where(last[keep], df_episodes["outcome"].values, 0)
+    exposure_values = (exposure_times[rows] <= episode_start[:, np.newaxis]).astype(np.int64)
+    for k, name in enumerate(names):
+        df_episodes[name] = exposure_values[:, k]
+
+    # Episodes of a person have distinct exposures, so counting the episodes counts the persons
+    cells = pd.MultiIndex.from_arrays(
+        [df_episodes["outcome"].values] + [exposure_values[:, k] for k in range(len(names))],
+        names=["outcome"] + names,
+    )
+    counts = pd.Series(1, index=cells).groupby(level=list(range(len(names) + 1))).size()
+
+    return df_episodes, counts
+
+
 def add_exposure(exposed, df_survival):
     """
     Add exposure as a time-varying covariate to the `df_survival` dataset.
@@ -139,28 +225,7 @@ def add_exposure(exposed, df_survival):
         df_survival (DataFrame): dataset for survival analysis with `exposure` column
     """
     logger.debug("Adding exposure")
-
-    df_survival = df_survival.merge(exposed.reset_index(), how="left", on="personid")
-    df_survival = df_survival.fillna({"exposure": 0})
-
-    exposed_rows = df_survival["exposure"] == 1
-
-    # Second part of exposure (exposure -> stop)
-    temp = df_survival[exposed_rows].reset_index(drop=True)
-    temp["exposure"] = 1
-    temp["start"] = temp["exposure_year"]
-
-    # First part of exposure (start -> exposure)
-    df_survival.loc[exposed_rows, "exposure"] = 0
-    df_survival.loc[exposed_rows, "outcome"] = 0
-    df_survival.loc[exposed_rows, "stop"] = df_survival.loc[
-        exposed_rows, "exposure_year"
-    ]
-
-    # Combine the two parts (start -> exposure -> stop)
-    df_survival = pd.concat([df_survival, temp], axis=0, ignore_index=True)
-
-    df_survival = df_survival.drop(columns=["exposure_year"])
+    df_survival, _ = split_episodes(df_survival, {"exposure": exposed})
 
     return df_survival
 
@@ -196,7 +261,12 @@ def add_death_as_competing_event(df_survival):
 
 
 def build_survival_dataset(
-    cases, cohort, exposed=None, n_cases=N_CASES, controls_per_case=CONTROLS_PER_CASE
+    cases,
+    cohort,
+    exposed=None,
+    n_cases=N_CASES,
+    controls_per_case=CONTROLS_PER_CASE,
+    return_counts=False,
 ):
     """
     Build survival dataset.
@@ -208,9 +278,12 @@ def build_survival_dataset(
         cases (DataFrame): cases dataset
         cohort (DataFrame): cohort dataset, possibly filtered to a specific sex
         exposed (DataFrame, default None): exposure dataset
+        return_counts (bool, default False): also return the number of persons
+            by outcome and exposure, to be passed to survival_analysis()
 
     Returns:
         df_survival (DataFrame): survival dataset
+        counts (Series): number of persons by outcome and exposure, if `return_counts`
     """
     logger.debug("Building the survival dataset")
 
@@ -220,17 +293,16 @@ def build_survival_dataset(
 
     df_survival = pd.concat([cases_sample, controls_sample], ignore_index=True)
 
-    if exposed is not None:
-        df_survival = add_exposure(exposed, df_survival)
-
+    exposures = {"exposure": exposed} if exposed is not None else {}
     time_epsilon = 0.01
-    df_survival = df_survival.loc[df_survival.stop - df_survival.start > time_epsilon, :]
-    df_survival = df_survival.reset_index(drop=True)
+    df_survival, counts = split_episodes(df_survival, exposures, min_duration=time_epsilon)
 
+    if return_counts:
+        return df_survival, counts
     return df_survival
 
 
-def check_min_subjects(df):
+def check_min_subjects(df, counts=None):
     """
     Check that the requirement for the minimum number of subjects is met.
 
@@ -245,13 +317,21 @@ def check_min_subjects(df):
 
     Args:
         df (DataFrame): dataset with the following columns: `personid`, `outcome`, `exposure` (optional)
+        counts (Series, optional): number of persons by outcome and exposures,
+            from build_survival_dataset(), to skip counting them in `df`
 
     Returns: 
         check (bool): True if there's enough subjects, otherwise False
     """
     min_persons = max(MIN_SUBJECTS_PERSONAL_DATA, MIN_SUBJECTS_SURVIVAL_ANALYSIS)
 
-    if "exposure" in df.columns:
+    if counts is not None:
+        # All the combinations of the observed values, as in a crosstab
+        cells = pd.MultiIndex.from_product(
+            [level.unique() for level in counts.index.remove_unused_levels().levels]
+        )
+        tbl = counts.reindex(cells, fill_value=0)
+    elif "exposure" in df.columns:
         tbl = pd.crosstab(
             df["outcome"],
             df["exposure"],
@@ -300,7 +380,7 @@ def set_timescale(df_survival, timescale="age"):
     return df_survival
 
 
-def survival_analysis(df_survival, model_type="cox"):
+def survival_analysis(df_survival, model_type="cox", counts=None):
     """
     Fit a survival model to the data and return the model object.
     
@@ -313,6 +393,7 @@ def survival_analysis(df_survival, model_type="cox"):
     Args:
         df_survival (DataFrame): survival dataset
         model_type (str, default "cox"): model to fit, "cox" for Cox PH model or "aalen-johansen" for Aalen-Johansen estimator
+        counts (Series, optional): number of persons by outcome and exposures, see check_min_subjects()
 
     Returns: 
         model (object): fitted survival model or None
@@ -320,14 +401,14 @@ def survival_analysis(df_survival, model_type="cox"):
 
     model = None
 
-    if (df_survival is not None) & (check_min_subjects(df_survival)):
+    if (df_survival is not None) & (check_min_subjects(df_survival, counts)):
 
         df_survival = df_survival.drop(columns="personid")
         entry_col = "start" if "start" in df_survival.columns else None
 
         if model_type == "cox":
             logger.debug("Fitting the Cox PH model")
-            model = CoxPHFitter()
+            model = WeightedCoxPH()
             try:
                 model.fit(
                     df_survival,
@@ -342,17 +423,13 @@ def survival_analysis(df_survival, model_type="cox"):
 
         elif model_type == "aalen-johansen":
             logger.debug("Fitting the Aalen-Johansen model")
-            model = AalenJohansenFitter(calculate_variance=False)
-            try:
-                model.fit(
-                    durations=df_survival["stop"],
-                    event_observed=df_survival["outcome"],
-                    event_of_interest=1,
-                    entry=df_survival["start"] if entry_col is not None else None,
-                    weights=df_survival["weight"],
-                )
-            except ConvergenceError:
-                model = None
+            model = AalenJohansen().fit(
+                durations=df_survival["stop"],
+                event_observed=df_survival["outcome"],
+                event_of_interest=1,
+                entry=df_survival["start"] if entry_col is not None else None,
+                weights=df_survival["weight"],
+            )
 
         else:
             raise ValueError("Model must be 'cox' or 'aalen-johansen'")
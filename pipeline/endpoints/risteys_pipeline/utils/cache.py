@@ -0,0 +1,147 @@
+"""Arrow cache for the datasets returned by load_data()"""
+
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+import pyarrow as pa
+import pyarrow.feather as feather
+from risteys_pipeline import config
+from risteys_pipeline.first_events_store import FirstEventsStore
+from risteys_pipeline.utils.log import logger
+from risteys_pipeline.utils.manifest import hash_code
+
+# Bump when the loading steps change in a way that invalidates existing caches
+CACHE_VERSION = 2
+
+CACHED_DATASETS = ["endpoint_definitions", "minimal_phenotype", "first_events"]
+
+
+def config_constants():
+    """Get the constants defined in config.py as strings"""
+    return {
+        name: str(getattr(config, name)) for name in dir(config) if name.isupper()
+    }
+
+
+def file_fingerprint(path):
+    """
+    Fingerprint of a file based on its path, size and modification time.
+
+    The file content is not hashed as the input files are several GB.
+
+    Args:
+        path (str): file path
+
+    Returns:
+        fingerprint (dict): resolved path, size and modification time of the file
+    """
+    path = Path(path).resolve()
+    stat = path.stat()
+    return {"path": str(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def cache_key(load_func, input_paths):
+    """
+    Compute the cache key from the loading function, the input files and the config constants.
+
+    The loading function is identified by its name and by the source code of
+    its module and the package modules it imports, see hash_code().
+
+    Args:
+        load_func (function): function loading the datasets
+        input_paths (list): input file paths of `load_func`
+
+    Returns:
+        key (str): hexadecimal digest identifying the cached datasets
+    """
+    key = {
+        "version": CACHE_VERSION,
+        "loader": f"{load_func.__module__}.{load_func.__qualname__}",
+        "code": hash_code([load_func]),
+        "inputs": [file_fingerprint(path) for path in input_paths],
+        "config": config_constants(),
+    }
+    key = json.dumps(key, sort_keys=True).encode()
+    return hashlib.sha256(key).hexdigest()[:16]
+
+
+def read_cached_dataset(path):
+    """
+    Read a cached dataset as a DataFrame.
+
+    The file is memory-mapped, so no parsing is done, but the conversion to
+    pandas copies the columns into memory.
+    """
+    source = pa.memory_map(str(path))
+    table = pa.ipc.open_file(source).read_all()
+    return table.to_pandas()
+
+
+def load_with_cache(load_func, input_paths, cache_dir, *args, first_events_store=False):
+    """
+    Load the datasets with `load_func`, using an Arrow IPC cache in `cache_dir`.
+
+    The datasets (endpoint definitions, minimal phenotype, first events) are
+    written to `<cache_dir>/<key>/` as uncompressed Arrow IPC files, so later
+    runs read them back without parsing the input files again. The data is
+    still copied into memory as DataFrames, see read_cached_dataset().
+    The key changes if an input file, a config constant, the source code of
+    `load_func` or CACHE_VERSION changes.
+
+    With `first_events_store`, the first events are returned as a
+    FirstEventsStore. The store is saved in the same cache directory, under
+    a name depending on the FirstEventsStore source code, and later runs
+    read it instead of the first events, so it is only built once.
+
+    Args:
+        load_func (function): function returning the tuple
+            (endpoint_definitions, minimal_phenotype, first_events)
+        input_paths (list): input file paths read by `load_func`
+        cache_dir (Path): cache directory, no caching if None
+        *args: arguments passed to `load_func`
+        first_events_store (bool, default False): return the first events as a FirstEventsStore
+
+    Returns:
+        (endpoint_definitions, minimal_phenotype, first_events) (tuple)
+    """
+    if cache_dir is None:
+        datasets = load_func(*args)
+        if first_events_store:
+            datasets = (*datasets[:2], FirstEventsStore.from_first_events(datasets[2]))
+        return datasets
+
+    cache_path = Path(cache_dir) / cache_key(load_func, input_paths)
+    dataset_paths = [cache_path / f"{name}.arrow" for name in CACHED_DATASETS]
+    store_path = cache_path / f"first_events_store_{hash_code([FirstEventsStore])[:16]}.arrow"
+
+    if all(path.is_file() for path in dataset_paths):
+        logger.info(f"Loading datasets from cache {cache_path}")
+        if first_events_store and store_path.is_file():
+            # The first events are only needed to build the store
+            datasets = tuple(read_cached_dataset(path) for path in dataset_paths[:2])
+            return (*datasets, FirstEventsStore.load(store_path))
+        datasets = tuple(read_cached_dataset(path) for path in dataset_paths)
+    else:
+        datasets = load_func(*args)
+
+        logger.info(f"Writing datasets to cache {cache_path}")
+        tmp_path = cache_path.with_suffix(".tmp")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+        for name, df in zip(CACHED_DATASETS, datasets):
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            feather.write_feather(table, tmp_path / f"{name}.arrow", compression="uncompressed")
+        # Only expose a complete cache
+        shutil.rmtree(cache_path, ignore_errors=True)
+        tmp_path.rename(cache_path)
+
+    if first_events_store:
+        store = FirstEventsStore.from_first_events(datasets[2])
+        tmp_path = store_path.with_suffix(".tmp")
+        store.save(tmp_path)
+        os.replace(tmp_path, store_path)
+        datasets = (*datasets[:2], store)
+
+    return datasets
@@ -0,0 +1,195 @@
+"""Manifest of the pipeline stages, to skip the stages with up-to-date outputs"""
+
+import ast
+import hashlib
+import inspect
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+from risteys_pipeline import config
+from risteys_pipeline.config import FINREGISTRY_OUTPUT_DIR
+from risteys_pipeline.utils.log import logger
+
+MANIFEST_FILENAME = "manifest.json"
+PACKAGE_NAME = "risteys_pipeline"
+PACKAGE_DIR = Path(__file__).resolve().parents[1]
+HASH_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def hash_file(path):
+    """Compute the SHA-256 digest of the content of a file"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def imported_files(path):
+    """
+    Get the source files of the risteys_pipeline modules imported in a source file.
+
+    Imports anywhere in the file are included, also inside functions. The
+    files are found in the package directory without importing the modules.
+
+    Args:
+        path (Path): source file to parse
+
+    Returns:
+        paths (list): source files of the imported modules and of their parent packages
+    """
+    names = []
+    for node in ast.walk(ast.parse(Path(path).read_text())):
+        if isinstance(node, ast.Import):
+            names += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0:
+            # Imported names can be submodules, e.g. `from risteys_pipeline.utils import log`
+            names += [node.module] + [f"{node.module}.{alias.name}" for alias in node.names]
+
+    paths = []
+    for name in names:
+        package, *parts = name.split(".")
+        if package != PACKAGE_NAME:
+            continue
+        for i in range(len(parts) + 1):
+            module_path = PACKAGE_DIR.joinpath(*parts[:i])
+            candidates = [module_path / "__init__.py", module_path.with_suffix(".py")]
+            # Names that are not modules, e.g. functions, have no file
+            paths += [candidate for candidate in candidates if candidate.is_file()]
+    return paths
+
+
+def hash_code(objects):
+    """
+    Compute the SHA-256 digest of the source code used by `objects`.
+
+    The sources are those of the modules defining `objects` and of all the
+    risteys_pipeline modules they import, recursively, so that editing any
+    dependency of a stage changes its digest.
+
+    Args:
+        objects (list): modules, or functions and classes of the modules to hash
+
+    Returns:
+        digest (str): hexadecimal digest
+    """
+    paths = set()
+    to_visit = [Path(inspect.getsourcefile(obj)).resolve() for obj in objects]
+    while to_visit:
+        path = to_visit.pop()
+        if path not in paths:
+            paths.add(path)
+            to_visit += [imported.resolve() for imported in imported_files(path)]
+
+    digest = hashlib.sha256()
+    for path in sorted(paths):
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def read_manifest(manifest_path):
+    """Read the manifest, empty if it doesn't exist yet"""
+    manifest_path = Path(manifest_path)
+    if not manifest_path.is_file():
+        return {"files": {}, "stages": {}}
+    return json.loads(manifest_path.read_text())
+
+
+def write_manifest(manifest, manifest_path):
+    """Write the manifest, replacing the previous one only once fully written"""
+    manifest_path = Path(manifest_path)
+    tmp_path = manifest_path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+    os.replace(tmp_path, manifest_path)
+
+
+class Stage:
+    """
+    Pipeline stage recorded in the manifest.
+
+    The stage key is computed from the content of the input files, the
+    given config constants, the run parameters and the source code of the
+    stage and of the package modules it imports. A stage is up to date if the manifest has
+    the same key and all its outputs still exist.
+
+    Input files are hashed only when their size or modification time differs
+    from the manifest, so checking a stage doesn't read GBs of data each time.
+
+    Attributes:
+        name (str): name of the stage, e.g. "key_figures"
+        key (str): hexadecimal digest of the stage inputs
+    """
+
+    def __init__(self, name, input_paths, config_names, code, params=None, output_dir=FINREGISTRY_OUTPUT_DIR):
+        """
+        Args:
+            name (str): name of the stage
+            input_paths (list): input files of the stage
+            config_names (list): names of the config constants used by the stage
+            code (list): modules, functions or classes of the stage, their module sources and
+                the risteys_pipeline modules these import are part of the stage, see hash_code()
+            params (dict, optional): run parameters of the stage, e.g. its mode
+            output_dir (Path, optional): directory of the manifest
+        """
+        self.name = name
+        self.manifest_path = Path(output_dir) / MANIFEST_FILENAME
+        manifest = read_manifest(self.manifest_path)
+
+        self.inputs = {}
+        self._files = {}
+        for path in input_paths:
+            path = str(Path(path).resolve())
+            stat = os.stat(path)
+            known = manifest["files"].get(path)
+            if known is not None and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+                sha256 = known["sha256"]
+            else:
+                logger.info(f"Hashing input file {path}")
+                sha256 = hash_file(path)
+            self._files[path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256}
+            self.inputs[path] = sha256
+
+        self.config = {name: str(getattr(config, name)) for name in config_names}
+        self.params = {name: str(value) for name, value in (params or {}).items()}
+        self.code_version = hash_code(code)
+
+        key = {"inputs": self.inputs, "config": self.config, "params": self.params, "code": self.code_version}
+        key = json.dumps(key, sort_keys=True).encode()
+        self.key = hashlib.sha256(key).hexdigest()
+
+    def is_up_to_date(self):
+        """Check if the stage already ran with the same key and its outputs still exist"""
+        recorded = read_manifest(self.manifest_path)["stages"].get(self.name)
+        up_to_date = (
+            recorded is not None
+            and recorded["key"] == self.key
+            and all(Path(path).is_file() for path in recorded["outputs"])
+        )
+        if up_to_date:
+            logger.info(f"Skipping stage {self.name}, outputs are up to date: {recorded['outputs']}")
+        return up_to_date
+
+    def record(self, output_paths):
+        """
+        Record a successful run of the stage in the manifest.
+
+        Args:
+            output_paths (list): output files written by the stage
+
+        Returns:
+            None
+        """
+        manifest = read_manifest(self.manifest_path)
+        manifest["files"].update(self._files)
+        manifest["stages"][self.name] = {
+            "key": self.key,
+            "inputs": self.inputs,
+            "config": self.config,
+            "params": self.params,
+            "code_version": self.code_version,
+            "outputs": [str(path) for path in output_paths],
+            "completed": datetime.now().isoformat(timespec="seconds"),
+        }
+        write_manifest(manifest, self.manifest_path)
+        logger.info(f"Recorded stage {self.name} in {self.manifest_path}")
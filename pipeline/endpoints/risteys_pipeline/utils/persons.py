@@ -0,0 +1,69 @@
+"""Dictionary encoding of person IDs"""
+
+import numpy as np
+import pandas as pd
+
+PERSON_CODE_DTYPE = np.int32
+UNKNOWN_PERSON = -1
+
+
+def build_person_dictionary(minimal_phenotype):
+    """
+    Encode the person IDs of the minimal phenotype as dense integer codes.
+
+    The `personid` column is replaced by the codes 0..n-1 so that row i holds
+    the demographics of person i. The original ID is kept in the `person` column.
+
+    Args:
+        minimal_phenotype (DataFrame): minimal phenotype dataset with unique `personid`
+
+    Returns:
+        minimal_phenotype (DataFrame): code-indexed minimal phenotype dataset
+    """
+    df = minimal_phenotype.reset_index(drop=True)
+    df = df.rename(columns={"personid": "person"})
+    df.insert(0, "personid", np.arange(df.shape[0], dtype=PERSON_CODE_DTYPE))
+
+    return df
+
+
+def encode_personid(ids, minimal_phenotype):
+    """
+    Map person IDs to the codes of the code-indexed minimal phenotype.
+
+    Args:
+        ids (Series): original person IDs
+        minimal_phenotype (DataFrame): output of build_person_dictionary()
+
+    Returns:
+        codes (ndarray): person codes, UNKNOWN_PERSON for IDs not in the minimal phenotype
+    """
+    codes = pd.Index(minimal_phenotype["person"]).get_indexer(ids)
+
+    return codes.astype(PERSON_CODE_DTYPE)
+
+
+def take_demographics(minimal_phenotype, personid, columns):
+    """
+    Look up demographics by person code, without merging on person IDs.
+
+    Args:
+        minimal_phenotype (DataFrame): output of build_person_dictionary()
+        personid (array): person codes
+        columns (list): columns of the minimal phenotype to look up
+
+    Returns:
+        res (DataFrame): `columns` for each code, missing values for UNKNOWN_PERSON
+    """
+    personid = np.asarray(personid)
+    has_unknown = (personid == UNKNOWN_PERSON).any()
+
+    res = {}
+    for col in columns:
+        values = minimal_phenotype[col].values
+        if has_unknown:
+            # The appended missing value is picked by the code -1
+            values = np.append(values, np.nan)
+        res[col] = values[personid]
+
+    return pd.DataFrame(res)
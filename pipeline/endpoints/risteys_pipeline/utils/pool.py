@@ -0,0 +1,52 @@
+"""Helpers for running tasks in process pools"""
+
+import queue
+
+
+def imap_bounded(pool, func, items, max_in_flight):
+    """
+    Apply `func` to each item in the pool, with a bounded number of tasks in flight.
+
+    Tasks are submitted lazily: a new task is submitted only when a result
+    has been consumed, so at most `max_in_flight` results are pending or
+    waiting in memory at any time. Results are yielded in completion order.
+
+    Args:
+        pool (Pool): multiprocessing pool
+        func (function): picklable function of one argument
+        items (iterable): arguments of the tasks
+        max_in_flight (int): maximum number of submitted but not yet consumed tasks
+
+    Yields:
+        (item, result) (tuple): argument and result of a finished task
+
+    Raises:
+        Exception: the exception of a failed task, when its result is consumed
+    """
+    done = queue.Queue()
+
+    def submit(item):
+        pool.apply_async(
+            func,
+            (item,),
+            callback=lambda result: done.put((item, result, None)),
+            error_callback=lambda error: done.put((item, None, error)),
+        )
+
+    def next_result():
+        item, result, error = done.get()
+        if error is not None:
+            raise error
+        return item, result
+
+    n_in_flight = 0
+    for item in items:
+        if n_in_flight >= max_in_flight:
+            yield next_result()
+            n_in_flight -= 1
+        submit(item)
+        n_in_flight += 1
+
+    while n_in_flight > 0:
+        yield next_result()
+        n_in_flight -= 1
@@ -0,0 +1,142 @@
+"""Mergeable quantile sketch for grouped values with a bounded range, e.g. ages"""
+
+import numpy as np
+
+
+class HistogramSketch:
+    """
+    Sparse histogram of values by group, with fixed-width bins.
+
+    Values are counted in bins of width `resolution` between `lower` and
+    `upper`, values outside the range go to the first or last bin.
+    Quantiles are computed from the bin centers, so their absolute error
+    is at most `resolution / 2` for values within the range.
+
+    Sketches with the same bins are merged by adding the counts, so partial
+    sketches can be built in parallel and merged in any order.
+    Missing values are counted in a separate bin: they count in the number
+    of values of a group but not in its quantiles.
+
+    Attributes:
+        resolution (float): bin width, twice the error bound of the quantiles
+        lower (float): lower bound of the first bin
+        n_bins (int): number of bins, excluding the missing values bin
+        keys (ndarray): sorted keys group * (n_bins + 1) + bin with at least one value
+        counts (ndarray): number of values for each key
+    """
+
+    def __init__(self, resolution, lower, upper):
+        self.resolution = resolution
+        self.lower = lower
+        self.n_bins = int(np.ceil((upper - lower) / resolution))
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+
+    def _empty_like(self):
+        sketch = HistogramSketch.__new__(HistogramSketch)
+        sketch.resolution = self.resolution
+        sketch.lower = self.lower
+        sketch.n_bins = self.n_bins
+        return sketch
+
+    def _set(self, keys, counts):
+        """Set the keys and counts, summing the counts of duplicated keys"""
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        self.counts = np.bincount(inverse, weights=counts, minlength=self.keys.shape[0]).astype(np.int64)
+        return self
+
+    def update(self, group, values):
+        """
+        Add values to the sketch.
+
+        Args:
+            group (ndarray): non-negative group number of each value
+            values (ndarray): values, missing values as NaN
+
+        Returns:
+            None
+        """
+        values = np.asarray(values, dtype=float)
+        bins = np.floor((values - self.lower) / self.resolution)
+        bins = np.clip(bins, 0, self.n_bins - 1)
+        bins = np.where(np.isnan(values), self.n_bins, bins).astype(np.int64)
+        keys = np.asarray(group, dtype=np.int64) * (self.n_bins + 1) + bins
+
+        self._set(
+            np.concatenate([self.keys, keys]),
+            np.concatenate([self.counts, np.ones(keys.shape[0], dtype=np.int64)]),
+        )
+
+    def merge(self, other):
+        """
+        Merge two sketches with the same bins.
+
+        Args:
+            other (HistogramSketch): sketch to merge
+
+        Returns:
+            sketch (HistogramSketch): new sketch with the values of both sketches
+        """
+        if (other.resolution, other.lower, other.n_bins) != (self.resolution, self.lower, self.n_bins):
+            raise ValueError("Cannot merge sketches with different bins")
+
+        return self._empty_like()._set(
+            np.concatenate([self.keys, other.keys]),
+            np.concatenate([self.counts, other.counts]),
+        )
+
+    def map_groups(self, new_group):
+        """
+        Relabel the groups, summing the groups mapped to the same new group.
+
+        Args:
+            new_group (ndarray): new group number for each group, -1 to drop the group
+
+        Returns:
+            sketch (HistogramSketch): sketch with the new groups
+        """
+        group, bins = np.divmod(self.keys, self.n_bins + 1)
+        group = np.asarray(new_group)[group]
+        keep = group >= 0
+        return self._empty_like()._set(
+            group[keep] * (self.n_bins + 1) + bins[keep],
+            self.counts[keep],
+        )
+
+    def group_counts(self, n_groups):
+        """Number of values of each group, including the missing values"""
+        group = self.keys // (self.n_bins + 1)
+        return np.bincount(group, weights=self.counts, minlength=n_groups).astype(np.int64)
+
+    def quantile(self, q, n_groups):
+        """
+        Compute a quantile of each group, with linear interpolation between
+        the two closest ranks as pandas does.
+
+        Args:
+            q (float): quantile, between 0 and 1
+            n_groups (int): number of groups
+
+        Returns:
+            res (ndarray): quantile of each group, NaN for groups without values
+        """
+        group, bins = np.divmod(self.keys, self.n_bins + 1)
+        not_missing = bins < self.n_bins
+        group = group[not_missing]
+        counts = self.counts[not_missing]
+        centers = self.lower + (bins[not_missing] + 0.5) * self.resolution
+
+        cum_counts = np.cumsum(counts)
+        n_values = np.bincount(group, weights=counts, minlength=n_groups).astype(np.int64)
+        n_before = np.cumsum(n_values) - n_values
+
+        res = np.full(n_groups, np.nan)
+        has_values = n_values > 0
+        rank = q * (n_values[has_values] - 1)
+        rank_lower = np.floor(rank)
+        # Value at a 0-based rank within a group: first bin whose cumulative count exceeds it
+        value_lower = centers[np.searchsorted(cum_counts, n_before[has_values] + rank_lower, side="right")]
+        value_upper = centers[np.searchsorted(cum_counts, n_before[has_values] + np.ceil(rank), side="right")]
+        res[has_values] = value_lower + (rank - rank_lower) * (value_upper - value_lower)
+
+        return res
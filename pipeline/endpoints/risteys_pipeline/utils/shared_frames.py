@@ -0,0 +1,180 @@
+"""
+Share DataFrames with the workers of a `spawn` process pool without copies.
+
+Large read-only inputs, e.g. the cohort and the first events, are written
+once to memory-mapped NumPy files in shared memory (/dev/shm when available).
+The pool initializer attaches them in each worker, so the tasks only carry
+endpoint names instead of pickling the frames in every task.
+
+Usage:
+    with SharedFrames({"cohort": cohort}) as shared:
+        with get_context("spawn").Pool(N_PROCESSES, initializer=init_shared_frames, initargs=(shared.path,)) as pool:
+            pool.map(task, endpoints)
+
+    def task(endpoint):
+        cohort = get_shared("cohort")
+        ...
+"""
+
+import os
+import pickle
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from risteys_pipeline.utils.log import logger
+
+SHARED_MEMORY_DIR = "/dev/shm"
+METADATA_FILENAME = "metadata.pkl"
+
+# Frames and objects attached by init_shared_frames() in the current process
+_SHARED = {}
+
+
+def share_values(values, filepath):
+    """
+    Write the values of a column or an index to the shared directory.
+
+    Numeric and boolean values are written as .npy files, categorical
+    values as .npy codes with their categories, and object columns of
+    booleans without missing values as boolean .npy files.
+    Other values are kept in the metadata and copied by each worker.
+
+    Args:
+        values (array-like): values of a column or an index
+        filepath (Path): .npy file path of the values
+
+    Returns:
+        spec (tuple): how to attach the values, see attach_values()
+    """
+    if isinstance(values, pd.Categorical):
+        np.save(filepath, values.codes)
+        return ("categorical", filepath.name, values.dtype)
+
+    if isinstance(values, np.ndarray):
+        if values.dtype == object and pd.api.types.infer_dtype(values, skipna=False) == "boolean":
+            values = values.astype(bool)
+        if values.dtype.kind in "biuf":
+            np.save(filepath, values)
+            return ("array", filepath.name, None)
+
+    return ("values", None, values)
+
+
+def attach_values(spec, directory):
+    """
+    Attach values written by share_values().
+
+    Args:
+        spec (tuple): output of share_values()
+        directory (Path): shared directory
+
+    Returns:
+        values (array-like): memory-mapped values, read-only
+    """
+    kind, filename, extra = spec
+    if kind == "categorical":
+        codes = np.load(directory / filename, mmap_mode="r")
+        return pd.Categorical.from_codes(codes, dtype=extra)
+    if kind == "array":
+        return np.load(directory / filename, mmap_mode="r")
+    return extra
+
+
+class SharedFrames:
+    """
+    DataFrames and small objects published to a shared directory.
+
+    Use as a context manager, the directory is removed on exit. Workers
+    that attached the frames keep their memory maps until they exit.
+
+    Attributes:
+        path (Path): shared directory, passed to init_shared_frames()
+    """
+
+    def __init__(self, frames, objects=None):
+        """
+        Publish the frames and objects.
+
+        Args:
+            frames (dict): name -> DataFrame
+            objects (dict, optional): name -> picklable object, copied by each worker
+        """
+        base_dir = SHARED_MEMORY_DIR if os.access(SHARED_MEMORY_DIR, os.W_OK) else None
+        self.path = Path(tempfile.mkdtemp(prefix="risteys_shared_", dir=base_dir))
+        logger.info(f"Publishing shared frames {list(frames)} to {self.path}")
+
+        metadata = {"frames": {}, "objects": objects or {}}
+        for name, frame in frames.items():
+            columns = [
+                (column, share_values(frame[column].values, self.path / f"{name}.{i}.npy"))
+                for i, column in enumerate(frame.columns)
+            ]
+            if isinstance(frame.index, pd.RangeIndex):
+                index = ("range", None, frame.index)
+            else:
+                index = share_values(frame.index.values, self.path / f"{name}.index.npy")
+            metadata["frames"][name] = {"columns": columns, "index": index, "index_name": frame.index.name}
+
+        with open(self.path / METADATA_FILENAME, "wb") as f:
+            pickle.dump(metadata, f)
+
+    def close(self):
+        """Remove the shared directory"""
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def attach_shared_frames(path):
+    """
+    Attach the frames and objects of a shared directory.
+
+    Args:
+        path (Path): shared directory, `SharedFrames.path`
+
+    Returns:
+        shared (dict): name -> DataFrame or object
+    """
+    path = Path(path)
+    with open(path / METADATA_FILENAME, "rb") as f:
+        metadata = pickle.load(f)
+
+    shared = dict(metadata["objects"])
+    for name, frame in metadata["frames"].items():
+        kind, _, extra = frame["index"]
+        if kind == "range":
+            index = extra
+        else:
+            index = pd.Index(attach_values(frame["index"], path), copy=False, name=frame["index_name"])
+        shared[name] = pd.DataFrame(
+            {column: attach_values(spec, path) for column, spec in frame["columns"]},
+            index=index,
+            copy=False,
+        )
+
+    return shared
+
+
+def init_shared_frames(path):
+    """
+    Pool initializer attaching the shared frames in the worker.
+
+    Args:
+        path (Path): shared directory, `SharedFrames.path`
+
+    Returns:
+        None
+    """
+    _SHARED.clear()
+    _SHARED.update(attach_shared_frames(path))
+
+
+def get_shared(name):
+    """Get a frame or an object attached by init_shared_frames()"""
+    return _SHARED[name]
@@ -1,10 +1,10 @@
 """Helper functions for writing data to files"""
 
+import io
 import json
 import numpy as np
 import pandas as pd
 from datetime import datetime
-from collections import defaultdict
 from risteys_pipeline.utils.log import logger
 from risteys_pipeline.config import FINREGISTRY_OUTPUT_DIR
 
@@ -57,19 +57,90 @@ def distribution_to_dict(dist):
     Returns:
         res (dict): Distribution in dictionary format
     """
+    return dict(iter_distribution(dist))
 
-    res = defaultdict(dict)
-    dist = dist.replace({np.nan: None, np.NINF: None, np.PINF: None})
 
-    for (endpoint, df) in dist.groupby("endpoint"):
+def iter_distribution(dist):
+    """
+    Iterate over the distributions of each endpoint, in endpoint order.
+
+    The rows are sorted once by endpoint and left bin edge, then each
+    endpoint is built from slices of the column arrays.
+
+    Args:
+        dist (DataFrame): distributions, see distribution_to_dict()
+
+    Yields:
+        (endpoint, endpoint_dist) (tuple): endpoint and its distributions by sex
+    """
+    endpoint_codes, endpoints = pd.factorize(dist["endpoint"], sort=True)
+    left = dist["left"].to_numpy(dtype=float)
+    right = dist["right"].to_numpy(dtype=float)
+    count = dist["count"].to_numpy()
+    sex = dist["sex"].to_numpy()
+
+    # Missing and infinite left edges first, as null in the output
+    order = np.lexsort((np.where(np.isfinite(left), left, -np.inf), endpoint_codes))
+    starts = np.flatnonzero(np.diff(endpoint_codes[order], prepend=-1))
+    stops = np.append(starts[1:], order.shape[0])
+
+    for start, stop in zip(starts, stops):
+        rows = order[start:stop]
         endpoint_dist = {"all": [], "female": [], "male": []}
-        df = df.sort_values("left", na_position="first")
-        for _, row in df.iterrows():
-            bin = [[row["left"], row["right"]], row["count"]]
-            endpoint_dist[row["sex"]].append(bin)
-        res[endpoint] = endpoint_dist
+        for row_left, row_right, row_count, row_sex in zip(
+            to_json_values(left[rows]), to_json_values(right[rows]), count[rows].tolist(), sex[rows]
+        ):
+            endpoint_dist[row_sex].append([[row_left, row_right], row_count])
+        yield endpoints[endpoint_codes[rows[0]]], endpoint_dist
+
+
+def to_json_values(values):
+    """Convert an array to a list of Python values, missing and infinite values as None"""
+    values = np.asarray(values)
+    if values.dtype.kind == "f":
+        return [value if np.isfinite(value) else None for value in values.tolist()]
+    return [None if pd.isna(value) else value for value in values.tolist()]
 
-    return res
+
+def write_summary_stats_json(key_figures, dist_age, dist_year, file):
+    """
+    Write summary stats in JSON format, one endpoint at a time.
+
+    The output is the same document as summary_stats_to_json(), without
+    building it in memory.
+
+    Args:
+        key_figures (DataFrame): key figures dataset, output of compute_key_figures()
+        dist_age (DataFrame): age distributions dataset, output of compute_distributions()
+        dist_year (DataFrame): year distributions dataset, output of compute_distributions()
+        file (file object): text file to write to
+
+    Returns:
+        None
+    """
+    def write_object(items):
+        file.write("{")
+        for i, (key, value) in enumerate(items):
+            if i > 0:
+                file.write(", ")
+            file.write(json.dumps(str(key)))
+            file.write(": ")
+            file.write(json.dumps(value))
+        file.write("}")
+
+    columns = [column for column in key_figures.columns if column != "endpoint"]
+    stats = zip(
+        key_figures["endpoint"].tolist(),
+        *[to_json_values(key_figures[column].to_numpy()) for column in columns],
+    )
+
+    file.write('{"stats": ')
+    write_object((endpoint, dict(zip(columns, values))) for endpoint, *values in stats)
+    file.write(', "distrib_age": ')
+    write_object(iter_distribution(dist_age))
+    file.write(', "distrib_year": ')
+    write_object(iter_distribution(dist_year))
+    file.write("}")
 
 
 def summary_stats_to_json(key_figures, dist_age, dist_year):
@@ -84,12 +155,42 @@ def summary_stats_to_json(key_figures, dist_age, dist_year):
     Returns: 
         res (str): summary stats in JSON format
     """
-    key_figures = key_figures.set_index("endpoint").to_json(orient="index")
-    dist_age = json.dumps(distribution_to_dict(dist_age))
-    dist_year = json.dumps(distribution_to_dict(dist_year))
-    res = f'{{"stats": {key_figures}, "distrib_age": {dist_age}, "distrib_year": {dist_year}}}'
+    res = io.StringIO()
+    write_summary_stats_json(key_figures, dist_age, dist_year, res)
+
+    return res.getvalue()
+
 
-    return res
+def write_summary_stats_to_file(key_figures, dist_age, dist_year, filepath):
+    """
+    Write summary stats to a JSON file, see write_summary_stats_json()
+
+    Args:
+        key_figures (DataFrame): key figures dataset, output of compute_key_figures()
+        dist_age (DataFrame): age distributions dataset, output of compute_distributions()
+        dist_year (DataFrame): year distributions dataset, output of compute_distributions()
+        filepath (str): where to write the data
+
+    Returns:
+        None
+    """
+    logger.info(f"Writing to file {filepath}")
+    with open(filepath, "w") as f:
+        write_summary_stats_json(key_figures, dist_age, dist_year, f)
+
+
+def append_csv(df, file):
+    """
+    Append rows to an open CSV file, writing the header if the file is empty.
+
+    Args:
+        df (DataFrame): rows to append
+        file (file object): text file opened for writing
+
+    Returns:
+        None
+    """
+    df.to_csv(file, index=False, header=file.tell() == 0)
 
 
 def write_json_to_file(json_string, filepath):
@@ -4,8 +4,9 @@ import pandas as pd
 
 from risteys_pipeline import config
 from risteys_pipeline.finngen.load_data import load_data
+from risteys_pipeline.first_events_store import FirstEventsStore
 from risteys_pipeline.run_cumulative_incidence import cumulative_incidence_function
-from risteys_pipeline.run_distributions import compute_distribution
+from risteys_pipeline.run_distributions import compute_distributions
 from risteys_pipeline.run_key_figures import compute_key_figures
 from risteys_pipeline.survival_analysis import (
     get_cases,
@@ -29,7 +30,8 @@ def pipeline():
         config.FINNGEN_MINIMAL_PHENOTYPE,
         config.FINNGEN_COVARIATES,
         config.FINNGEN_LONG_FORMAT_FIRST_EVENTS,
-        config.FINNGEN_DETAILED_LONGITUDINAL
+        config.FINNGEN_DETAILED_LONGITUDINAL,
+        config.FINNGEN_CACHE_DIRECTORY
     )
 
     # --- 3. Pipeline
@@ -43,8 +45,7 @@ def pipeline():
     ), index=False)
 
     # Run age and year distributions
-    dist_age = compute_distribution(df_first_events, "age")
-    dist_year = compute_distribution(df_first_events, "year")
+    dist_age, dist_year = compute_distributions(df_first_events, df_minimal_phenotype)
 
     dist_age.to_csv(get_output_filepath(
         "distribution_age",
@@ -61,8 +62,9 @@ def pipeline():
     logger.info("Running cumulative incidence on ALL endpoints")
     ci_endpoints = df_definitions.loc[:, "endpoint"]
     cohort = get_cohort(df_minimal_phenotype)
+    first_events_store = FirstEventsStore.from_first_events(df_first_events)
     for endpoint in ci_endpoints:
-        cases = get_cases(endpoint, df_first_events, cohort)
+        cases = get_cases(endpoint, first_events_store, cohort)
         cif = cumulative_incidence_function(endpoint, cases, cohort)
 
         if isinstance(cif, pd.DataFrame):  # if there were enough cases to compute the CIF
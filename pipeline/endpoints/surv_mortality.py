@@ -3,6 +3,8 @@ Mortality statistics.
 
 This script compute statistics on mortality.
 It is done using survival analysis with the Cox PH method.
+The Cox PH fitter is set by the COX_FITTER environment variable,
+"lifelines" (default) or "native" to use risteys_pipeline.cox.WeightedCoxPH.
 
 References
 ----------
@@ -12,16 +14,29 @@ References
   https://plana-ripoll.github.io/NB-COMO/
 """
 from csv import writer as csv_writer
+from os import getenv
 from pathlib import Path
 from sys import argv
 from time import time as now
 
 import numpy as np
 import pandas as pd
-from lifelines import CoxPHFitter
 from lifelines.utils import ConvergenceError
 from lifelines.utils import interpolate_at_times
 
+# Cox PH fitter, chosen explicitly so that the outputs do not depend on
+# which packages are installed:
+# - "lifelines": lifelines CoxPHFitter, Efron ties, runs in the dsub image
+# - "native": risteys_pipeline.cox.WeightedCoxPH, Breslow ties, requires
+#   the risteys_pipeline package
+COX_FITTER = getenv("COX_FITTER", "lifelines")
+if COX_FITTER == "native":
+    from risteys_pipeline.cox import WeightedCoxPH as CoxPHFitter
+elif COX_FITTER == "lifelines":
+    from lifelines import CoxPHFitter
+else:
+    raise ValueError(f"Unknown COX_FITTER {COX_FITTER!r}, expected 'lifelines' or 'native'")
+
 from log import logger
 
 
@@ -73,6 +88,8 @@ def main(path_definitions, path_long_format_fevents, path_info, output_path, tim
     timings_writer = csv_writer(timings_file)
     timings_writer.writerow(["endpoint", "lags_computed", "time_seconds"])
 
+    logger.info(f"Fitting the Cox models with the {COX_FITTER} fitter")
+
     for _, endpoint in endpoints.iterrows():
         time_start = now()
         lags_computed = 0
@@ -120,13 +137,17 @@ def load_data(path_definitions, path_long_format_fevents, path_info):
     # Get endpoint list
     endpoints = pd.read_csv(path_definitions, usecols=["NAME", "SEX", "CORE_ENDPOINTS"])
 
-    # Get first events
-    df_events = pd.read_parquet(path_long_format_fevents)
-
     # Keep only core endpoints
     endpoints = endpoints.loc[endpoints.CORE_ENDPOINTS == "yes", :]
     select_endpoints = set(endpoints.NAME).union(["DEATH"])  # we need the DEATH endpoint to compute mortality
-    df_events = df_events.loc[df_events.ENDPOINT.isin(select_endpoints), :]
+
+    # Get first events of the selected endpoints.
+    # The filter is pushed down to the Parquet reader, so row groups without
+    # these endpoints are skipped when the file is sorted by endpoint.
+    df_events = pd.read_parquet(
+        path_long_format_fevents,
+        filters=[("ENDPOINT", "in", select_endpoints)]
+    )
 
     # Get sex and approximate birth date of each indiv
     df_info = pd.read_csv(path_info, usecols=["FINNGENID", "BL_YEAR", "BL_AGE", "SEX"])
@@ -135,6 +156,10 @@ def load_data(path_definitions, path_long_format_fevents, path_info):
     df_info["BIRTH_TYEAR"] = df_info.BL_YEAR - df_info.BL_AGE
     df_info = df_info.drop(columns=["SEX", "BL_YEAR", "BL_AGE"])
 
+    # Encode FINNGENIDs as dense integer codes, so the set operations
+    # and merges on FINNGENID work on integers instead of strings.
+    df_info, df_events = encode_finngenid(df_info, df_events)
+
     # Set age at start and end of study for each indiv
     df_info["START_AGE"] = df_info.apply(
         lambda r: max(STUDY_STARTS - r.BIRTH_TYEAR, 0.0),
@@ -160,7 +185,7 @@ def load_data(path_definitions, path_long_format_fevents, path_info):
     df_events = df_events.loc[~ df_events.FINNGENID.isin(died_before_study), :]
     df_info = df_info.loc[~ df_info.FINNGENID.isin(died_before_study), :]
 
-    born_after_study = set((df_info.BIRTH_TYEAR > STUDY_ENDS).index)
+    born_after_study = set(df_info.loc[df_info.BIRTH_TYEAR > STUDY_ENDS, "FINNGENID"])
     df_events = df_events.loc[~ df_events.FINNGENID.isin(born_after_study), :]
     df_info = df_info.loc[~ df_info.FINNGENID.isin(born_after_study), :]
 
@@ -168,6 +193,18 @@ def load_data(path_definitions, path_long_format_fevents, path_info):
     return endpoints, df_events, df_info
 
 
+def encode_finngenid(df_info, df_events):
+    """Replace FINNGENID by an integer code shared by df_info and df_events"""
+    persons = pd.Index(pd.unique(np.concatenate([
+        df_info.FINNGENID.values,
+        df_events.FINNGENID.values
+    ])))
+    df_info = df_info.assign(FINNGENID=persons.get_indexer(df_info.FINNGENID).astype(np.int32))
+    df_events = df_events.assign(FINNGENID=persons.get_indexer(df_events.FINNGENID).astype(np.int32))
+
+    return df_info, df_events
+
+
 def init_csv(res_file):
     res_writer = csv_writer(res_file)
     res_writer.writerow([
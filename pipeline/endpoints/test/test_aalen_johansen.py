@@ -0,0 +1,31 @@
+import numpy as np
+from lifelines import AalenJohansenFitter
+from risteys_pipeline.aalen_johansen import AalenJohansen
+
+
+def test_aalen_johansen_matches_lifelines():
+    rng = np.random.default_rng(0)
+    n = 1000
+    # Untied times: lifelines jitters tied event times
+    durations = rng.uniform(0, 80, n)
+    events = rng.choice([0, 1, 2], n, p=[0.5, 0.3, 0.2])
+    weights = np.where(events == 1, 1.0, rng.choice([1.0, 3.0], n))
+    entry = durations * rng.uniform(0, 0.9, n)
+    ages = np.arange(1, 81)
+
+    for entry_ in [None, entry]:
+        ref = AalenJohansenFitter(calculate_variance=False).fit(
+            durations, events, 1, entry=entry_, weights=weights
+        )
+        res = AalenJohansen().fit(durations, events, 1, entry=entry_, weights=weights)
+        assert np.allclose(res.predict(ages).values, ref.predict(ages).values, atol=1e-12)
+
+
+def test_aalen_johansen_ties():
+    # Two subjects at risk at t=1, one event of interest and one competing event:
+    # CIF jumps by 1/2 at t=1, then the remaining subject has no event
+    res = AalenJohansen().fit([1, 1, 2], [1, 2, 0], 1, entry=[0, 0, 0.5])
+    assert np.allclose(res.predict([0.5, 1, 3]).values, [0, 1 / 3, 1 / 3])
+    # Left truncation: the third subject enters after t=1
+    res = AalenJohansen().fit([1, 1, 2], [1, 2, 0], 1, entry=[0, 0, 1.5])
+    assert np.allclose(res.predict([1, 3]).values, [0.5, 0.5])
@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+from risteys_pipeline.count_cube import CountCube
+from risteys_pipeline.run_distributions import (
+    DISTRIBUTION_SEXES,
+    compute_distribution,
+    compute_distribution_from_cube,
+    compute_distributions,
+)
+from risteys_pipeline.utils.persons import build_person_dictionary
+
+
+def make_data(n_persons=300, n_events=3000):
+    rng = np.random.default_rng(0)
+    minimal_phenotype = build_person_dictionary(
+        pd.DataFrame(
+            {
+                "personid": [f"P{i}" for i in range(n_persons)],
+                "female": rng.choice([True, False, np.nan], size=n_persons).astype(object),
+                "index_person": rng.choice([True, False], size=n_persons),
+            }
+        )
+    )
+    first_events = pd.DataFrame(
+        {
+            "personid": rng.integers(0, n_persons, n_events).astype(np.int32),
+            "endpoint": pd.Categorical(rng.choice(["A", "B", "C"], size=n_events)),
+            "age": rng.uniform(0, 100, n_events),
+            "year": rng.uniform(1960, 2020, n_events),
+        }
+    )
+    return first_events, minimal_phenotype
+
+
+def test_cube_distributions(tmp_path):
+    first_events, minimal_phenotype = make_data()
+    path = tmp_path / "cube.npz"
+    CountCube.from_first_events(first_events, minimal_phenotype).save(path)
+    cube = CountCube.load(path)
+
+    for column in ["age", "year"]:
+        expected = compute_distribution(first_events, column)
+        res = compute_distribution_from_cube(cube, column)
+        assert res.equals(expected)
+
+
+def test_cube_marginal():
+    first_events, minimal_phenotype = make_data()
+    cube = CountCube.from_first_events(first_events, minimal_phenotype)
+
+    res = cube.marginal(["endpoint"], index_persons=True, sexes=["female"])
+    persons = minimal_phenotype.loc[first_events["personid"]]
+    selected = first_events.loc[
+        (persons["index_person"] == True).values & (persons["female"] == True).values
+    ]
+    expected = selected.groupby("endpoint").size().values
+    assert (res == expected).all()
+
+
+def test_distributions_by_sex():
+    first_events, minimal_phenotype = make_data()
+    cube = CountCube.from_first_events(first_events, minimal_phenotype)
+
+    dist_age, dist_year = compute_distributions(first_events, minimal_phenotype)
+    for column, res in [("age", dist_age), ("year", dist_year)]:
+        expected = pd.concat(
+            [compute_distribution_from_cube(cube, column, sex) for sex in DISTRIBUTION_SEXES],
+            ignore_index=True,
+        )
+        assert res.equals(expected)
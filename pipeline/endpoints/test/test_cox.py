@@ -0,0 +1,121 @@
+import warnings
+import numpy as np
+import pandas as pd
+import pytest
+from lifelines import CoxPHFitter, CoxTimeVaryingFitter
+from lifelines.exceptions import ConvergenceWarning
+from risteys_pipeline.cox import WeightedCoxPH
+# Simulated times are untied: lifelines breaks ties with Efron's method, WeightedCoxPH with Breslow's
+from scripts.benchmark_cox import simulate_case_cohort
+
+
+def test_weighted_cox_matches_lifelines():
+    df = simulate_case_cohort(500, 0, entry=False)
+    kwargs = dict(duration_col="duration", event_col="outcome", weights_col="weight", robust=True)
+    ref = CoxPHFitter().fit(df, **kwargs)
+    res = WeightedCoxPH().fit(df, **kwargs)
+
+    assert np.allclose(res.params_, ref.params_, atol=1e-4)
+    assert np.allclose(res.standard_errors_, ref.standard_errors_, rtol=1e-4)
+    assert np.allclose(res.summary["p"], ref.summary["p"], rtol=1e-3)
+    assert np.isclose(res.log_likelihood_, ref.log_likelihood_)
+    times = [1.0, 5.0, 10.0]
+    assert np.allclose(
+        res.predict_cumulative_hazard(df.iloc[:3], times=times),
+        ref.predict_cumulative_hazard(df.iloc[:3], times=times),
+        atol=1e-5,
+    )
+
+
+def test_weighted_cox_entry_risk_sets():
+    # Persons are at risk only after their entry time, as in a counting process fit
+    df = simulate_case_cohort(300, 1, entry=True).assign(weight=1.0)
+    res = WeightedCoxPH().fit(
+        df, duration_col="duration", event_col="outcome", weights_col="weight", entry_col="start"
+    )
+    ref = CoxTimeVaryingFitter().fit(
+        df.reset_index().drop(columns="weight"),
+        id_col="index", event_col="outcome", start_col="start", stop_col="duration",
+    )
+
+    assert np.allclose(res.params_, ref.params_, atol=1e-6)
+    assert np.allclose(res.standard_errors_, ref.standard_errors_, rtol=1e-5)
+    bch = ref.baseline_cumulative_hazard_["baseline hazard"]
+    assert np.allclose(
+        res.baseline_cumulative_hazard_.loc[bch.index, "baseline cumulative hazard"], bch, atol=1e-6
+    )
+
+
+def test_weighted_cox_initial_point():
+    # As in lifelines, the initial point is on the normalized covariates
+    df = simulate_case_cohort(300, 2, entry=False)
+    kwargs = dict(duration_col="duration", event_col="outcome", weights_col="weight")
+    res = WeightedCoxPH().fit(df, **kwargs)
+    warm = WeightedCoxPH().fit(df, initial_point=(res.params_ * res._norm_std).values, **kwargs)
+
+    assert warm.n_iterations_ < res.n_iterations_
+    assert np.allclose(warm.params_, res.params_, atol=1e-6)
+
+
+def test_weighted_cox_stalled():
+    # The log-likelihood decreases along every Newton step: the fit must keep
+    # the initial coefficients and warn instead of reporting convergence
+    class Stalled(WeightedCoxPH):
+        @staticmethod
+        def _derivatives(*args):
+            ll, *rest = WeightedCoxPH._derivatives(*args)
+            return (-ll, *rest)
+
+    df = simulate_case_cohort(300, 3, entry=False)
+    with pytest.warns(ConvergenceWarning):
+        res = Stalled().fit(df, duration_col="duration", event_col="outcome", weights_col="weight")
+
+    assert res.n_iterations_ == 1
+    assert np.allclose(res.params_, 0)
+
+
+def test_weighted_cox_robust_variance_entry():
+    # Infinitesimal jackknife: the robust variance is the sum over subjects of
+    # (w_i * d params / d w_i)^2, computed here by refitting with perturbed weights
+    df = simulate_case_cohort(60, 4, entry=True)
+    kwargs = dict(duration_col="duration", event_col="outcome", weights_col="weight", entry_col="start")
+    # Iterate to machine precision, so that the finite differences are exact,
+    # Newton-Raphson gets there in a few steps
+    tight = dict(precision=1e-30, r_precision=0.0, max_steps=10)
+    res = WeightedCoxPH().fit(df, robust=True, **kwargs, **tight)
+
+    eps = 1e-4
+    delta_betas = []
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", ConvergenceWarning)
+        for i in range(df.shape[0]):
+            params = []
+            for sign in [1, -1]:
+                df_ = df.copy()
+                df_.loc[i, "weight"] += sign * eps
+                fit = WeightedCoxPH().fit(df_, initial_point=(res.params_ * res._norm_std).values, **kwargs, **tight)
+                params.append(fit.params_.values)
+            delta_betas.append(df.loc[i, "weight"] * (params[0] - params[1]) / (2 * eps))
+    delta_betas = np.array(delta_betas)
+
+    assert np.allclose(res.variance_matrix_.values, delta_betas.T @ delta_betas, rtol=1e-5)
+
+
+def test_weighted_cox_baseline_hazard_entry():
+    # Weighted Breslow estimator over the subjects with entry < t <= duration
+    df = simulate_case_cohort(60, 5, entry=True)
+    res = WeightedCoxPH().fit(
+        df, duration_col="duration", event_col="outcome", weights_col="weight", entry_col="start"
+    )
+
+    covariates = df[res.params_.index].values - res._norm_mean.values
+    risk = df["weight"].values * np.exp(covariates @ res.params_.values)
+    times = np.sort(df.loc[df["outcome"] == 1, "duration"].values)
+    expected = np.cumsum([
+        df.loc[(df["duration"] == t) & (df["outcome"] == 1), "weight"].sum()
+        / risk[((df["start"] < t) & (df["duration"] >= t)).values].sum()
+        for t in times
+    ])
+
+    bch = res.baseline_cumulative_hazard_.loc[times, "baseline cumulative hazard"]
+    assert np.allclose(bch.values, expected, atol=1e-12)
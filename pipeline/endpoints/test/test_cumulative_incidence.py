@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+from risteys_pipeline.aalen_johansen import AalenJohansen
+from risteys_pipeline.run_cumulative_incidence import CohortRiskSet, cumulative_incidence_full_cohort
+
+
+def test_full_cohort_cumulative_incidence():
+    rng = np.random.default_rng(1)
+    n = 4000
+    birth_year = rng.uniform(1920, 2010, n)
+    cohort = pd.DataFrame({
+        "start": np.maximum(birth_year, 1998.0),
+        "stop": np.minimum(birth_year + rng.uniform(60, 110, n), 2023.32),
+        "outcome": 0,
+        "birth_year": birth_year,
+        "female": rng.random(n) < 0.5,
+    }, index=pd.Index(np.arange(n), name="personid"))
+    cases = cohort.sample(800, random_state=0)
+    cases = cases.assign(stop=cases["start"] + (cases["stop"] - cases["start"]) * rng.random(800), outcome=1)
+
+    res = cumulative_incidence_full_cohort("E", cases, CohortRiskSet(cohort))
+
+    # Exact estimator on the same full cohort dataset
+    for sex, label in [(True, "female"), (False, "male")]:
+        df = pd.concat([cases, cohort.drop(cases.index)])
+        df = df.loc[(df["female"] == sex) & (df["stop"] - df["start"] > 0.01)]
+        outcome = np.where((df["outcome"] == 0) & (df["stop"] < 2023.32), 2, df["outcome"])
+        exact = AalenJohansen().fit(
+            df["stop"] - df["birth_year"], outcome, 1, entry=df["start"] - df["birth_year"]
+        )
+        res_sex = res.loc[res["sex"] == label]
+        assert len(res_sex) > 0
+        assert np.allclose(res_sex["cumulinc"], exact.predict(res_sex["age"]).values, atol=1e-3)
@@ -0,0 +1,40 @@
+import gzip
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from risteys_pipeline.export_artifacts import INDEX_FILENAME, write_endpoint_artifacts
+
+
+def test_write_endpoint_artifacts(tmp_path):
+    results = {
+        "stats": pd.DataFrame({"endpoint": ["A", "B"], "nindivs_all": [10.0, np.nan]}),
+        "distrib_age": pd.DataFrame(
+            {"endpoint": ["A"], "sex": ["all"], "left": [0.0], "right": [np.inf], "count": [10]}
+        ),
+        "cumulative_incidence": pd.DataFrame(
+            {"endpoint": ["C", "A", "A"], "age": [1.0, 2.0, 1.0], "sex": ["male", "male", "female"], "cumulinc": [0.1, 0.2, 0.3]}
+        ),
+    }
+    index = write_endpoint_artifacts(results, tmp_path)
+
+    assert list(index["endpoints"]) == ["A", "B", "C"]
+    assert json.loads((tmp_path / INDEX_FILENAME).read_text()) == index
+
+    data = gzip.decompress((tmp_path / "A.json.gz").read_bytes())
+    assert len(data) == index["endpoints"]["A"]["json"]
+    assert json.loads(data) == {
+        "endpoint": "A",
+        "stats": {"nindivs_all": 10.0},
+        "distrib_age": {"all": [[[0.0, None], 10]], "female": [], "male": []},
+        "cumulative_incidence": [
+            {"age": 2.0, "sex": "male", "cumulinc": 0.2},
+            {"age": 1.0, "sex": "female", "cumulinc": 0.3},
+        ],
+    }
+
+    data = pa.Codec("zstd").decompress((tmp_path / "C.json.zst").read_bytes(), decompressed_size=index["endpoints"]["C"]["json"], asbytes=True)
+    artifact = json.loads(data)
+    assert artifact["stats"] is None
+    assert artifact["distrib_age"] == {"all": [], "female": [], "male": []}
+    assert artifact["cumulative_incidence"] == [{"age": 1.0, "sex": "male", "cumulinc": 0.1}]
@@ -0,0 +1,49 @@
+import pandas as pd
+from risteys_pipeline.first_events_store import FirstEventsStore
+from risteys_pipeline.utils.cache import load_with_cache
+
+
+def make_first_events():
+    return pd.DataFrame(
+        {
+            "personid": ["p1", "p2", "p3", "p1", "p4", "p2"],
+            "endpoint": pd.Categorical(["B", "A", "B", "A", "B", "C"]),
+            "age": [10.0, 20.0, 30.0, 40.0, 50.0, 60.0],
+            "year": [2000.0, 2001.0, 2002.0, 2003.0, 2004.0, 2005.0],
+        }
+    )
+
+
+def test_store_get_matches_mask():
+    first_events = make_first_events()
+    store = FirstEventsStore.from_first_events(first_events)
+    for endpoint in ["A", "B", "C"]:
+        expected = first_events.loc[first_events["endpoint"] == endpoint]
+        res = store.get(endpoint)
+        assert res["personid"].tolist() == expected["personid"].tolist()
+        assert res["age"].tolist() == expected["age"].tolist()
+    assert store.get("D").shape[0] == 0
+
+
+def test_store_save_load(tmp_path):
+    store = FirstEventsStore.from_first_events(make_first_events())
+    path = tmp_path / "first_events_store.feather"
+    store.save(path)
+    loaded = FirstEventsStore.load(path)
+    assert loaded.offsets == store.offsets
+    assert loaded.get("B")["personid"].tolist() == ["p1", "p3", "p4"]
+
+
+def test_store_kept_in_load_cache(tmp_path):
+    calls = []
+
+    def load_func():
+        calls.append(1)
+        return pd.DataFrame({"endpoint": ["A"]}), pd.DataFrame({"personid": ["p1"]}), make_first_events()
+
+    first = load_with_cache(load_func, [], tmp_path, first_events_store=True)
+    second = load_with_cache(load_func, [], tmp_path, first_events_store=True)
+    assert len(calls) == 1
+    assert isinstance(second[2], FirstEventsStore)
+    assert second[2].offsets == first[2].offsets
+    assert second[2].get("B")["personid"].tolist() == ["p1", "p3", "p4"]
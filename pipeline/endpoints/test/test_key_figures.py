@@ -0,0 +1,18 @@
+import numpy as np
+import pandas as pd
+from risteys_pipeline.run_key_figures import grouped_medians
+
+
+def test_grouped_medians():
+    rng = np.random.default_rng(0)
+    group = rng.integers(0, 5, 200)
+    values = rng.uniform(0, 100, 200)
+    values[::17] = np.nan
+    subset = rng.random(200) < 0.5
+
+    res_all, res_subset = grouped_medians(group, values, 6, [None, subset])
+
+    expected_all = pd.Series(values).groupby(group).median().reindex(range(6))
+    expected_subset = pd.Series(values[subset]).groupby(group[subset]).median().reindex(range(6))
+    assert np.allclose(res_all, expected_all, equal_nan=True)
+    assert np.allclose(res_subset, expected_subset, equal_nan=True)
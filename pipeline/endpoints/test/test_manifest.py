@@ -0,0 +1,56 @@
+from risteys_pipeline.utils.manifest import PACKAGE_DIR, Stage, hash_file, imported_files
+
+
+def make_stage(input_path, output_dir):
+    return Stage("test", [input_path], ["FOLLOWUP_START"], [hash_file], output_dir=output_dir)
+
+
+def test_stage_skip(tmp_path):
+    input_path = tmp_path / "input.csv"
+    output_path = tmp_path / "output.csv"
+    input_path.write_text("a,b\n1,2\n")
+
+    stage = make_stage(input_path, tmp_path)
+    assert not stage.is_up_to_date()
+    output_path.write_text("result\n")
+    stage.record([output_path])
+    assert make_stage(input_path, tmp_path).is_up_to_date()
+
+    # Changed input content
+    input_path.write_text("a,b\n1,23\n")
+    assert not make_stage(input_path, tmp_path).is_up_to_date()
+
+
+def test_stage_missing_output(tmp_path):
+    input_path = tmp_path / "input.csv"
+    input_path.write_text("a,b\n1,2\n")
+
+    stage = make_stage(input_path, tmp_path)
+    stage.record([tmp_path / "output.csv"])
+    assert not make_stage(input_path, tmp_path).is_up_to_date()
+
+
+def test_imported_files(tmp_path):
+    source = tmp_path / "stage.py"
+    source.write_text(
+        "import numpy as np\n"
+        "from risteys_pipeline.utils import persons\n"
+        "def main():\n"
+        "    from risteys_pipeline.cox import WeightedCoxPH\n"
+    )
+    names = {path.relative_to(PACKAGE_DIR).as_posix() for path in imported_files(source)}
+    assert names == {"__init__.py", "utils/persons.py", "cox.py"}
+
+
+def test_stage_params(tmp_path):
+    input_path = tmp_path / "input.csv"
+    output_path = tmp_path / "output.csv"
+    input_path.write_text("a,b\n1,2\n")
+    output_path.write_text("result\n")
+
+    def stage(mode):
+        return Stage("test", [input_path], [], [hash_file], params={"mode": mode}, output_dir=tmp_path)
+
+    stage("exact").record([output_path])
+    assert stage("exact").is_up_to_date()
+    assert not stage("approximate").is_up_to_date()
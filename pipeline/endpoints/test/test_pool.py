@@ -0,0 +1,23 @@
+import math
+import pytest
+from multiprocessing import get_context
+from risteys_pipeline.utils.pool import imap_bounded
+
+
+def test_imap_bounded():
+    pulled = []
+
+    def items():
+        for i in range(20):
+            pulled.append(i)
+            yield i
+
+    with get_context("spawn").Pool(2) as pool:
+        res = imap_bounded(pool, math.sqrt, items(), max_in_flight=3)
+        first = next(res)
+        # The fourth task is submitted only after the first result is consumed
+        assert len(pulled) == 4
+        assert sorted([first] + list(res)) == [(i, math.sqrt(i)) for i in range(20)]
+
+        with pytest.raises(ValueError):
+            list(imap_bounded(pool, math.sqrt, [1, -1, 4], max_in_flight=2))
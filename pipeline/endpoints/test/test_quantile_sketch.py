@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+from risteys_pipeline.utils.quantile_sketch import HistogramSketch
+
+
+def test_sketch_median_error_bound():
+    rng = np.random.default_rng(0)
+    group = rng.integers(0, 4, 1000)
+    values = rng.uniform(0, 100, 1000)
+    values[::50] = np.nan
+
+    sketch = HistogramSketch(0.1, 0.0, 100.0)
+    sketch.update(group, values)
+
+    expected = pd.Series(values).groupby(group).median().reindex(range(5))
+    res = sketch.quantile(0.5, 5)
+    assert np.isnan(res[4])
+    assert np.nanmax(np.abs(res - expected.values)) <= 0.05 + 1e-9
+    assert (sketch.group_counts(5) == np.bincount(group, minlength=5)).all()
+
+
+def test_sketch_merge():
+    rng = np.random.default_rng(1)
+    group = rng.integers(0, 3, 500)
+    values = rng.uniform(0, 100, 500)
+
+    full = HistogramSketch(0.5, 0.0, 100.0)
+    full.update(group, values)
+    part1 = HistogramSketch(0.5, 0.0, 100.0)
+    part1.update(group[:200], values[:200])
+    part2 = HistogramSketch(0.5, 0.0, 100.0)
+    part2.update(group[200:], values[200:])
+    merged = part1.merge(part2)
+
+    assert (merged.keys == full.keys).all()
+    assert (merged.counts == full.counts).all()
@@ -0,0 +1,26 @@
+import numpy as np
+import pandas as pd
+from risteys_pipeline.utils.shared_frames import SharedFrames, attach_shared_frames
+
+
+def test_shared_frames_round_trip():
+    cohort = pd.DataFrame(
+        {
+            "start": [1998.0, 2000.5, np.nan],
+            "outcome": [0, 1, 0],
+            "female": np.array([True, False, True], dtype=object),
+            "sex": np.array([True, np.nan, False], dtype=object),
+        },
+        index=pd.Index(np.array([3, 1, 2], dtype=np.int32), name="personid"),
+    )
+    events = pd.DataFrame({"endpoint": pd.Categorical(["B", "A", "B"]), "name": ["x", "y", "z"]})
+
+    with SharedFrames({"cohort": cohort, "events": events}, {"offsets": {"A": (0, 1)}}) as shared:
+        res = attach_shared_frames(shared.path)
+
+    assert res["offsets"] == {"A": (0, 1)}
+    # Object booleans without missing values are shared as booleans
+    pd.testing.assert_frame_equal(res["cohort"], cohort.astype({"female": bool}))
+    pd.testing.assert_frame_equal(res["events"], events)
+    assert isinstance(res["cohort"]["start"].values, np.memmap)
+    assert not res["cohort"]["start"].values.flags.writeable
@@ -0,0 +1,23 @@
+import numpy as np
+from risteys_pipeline.finngen.status_matrix import StatusMatrix, StatusMatrixWriter
+
+
+def test_status_matrix_roundtrip(tmp_path):
+    rng = np.random.default_rng(0)
+    n_persons = 11  # not a multiple of 4 nor of the block size
+    endpoints = ["A", "B", "C"]
+    persons = [f"FG{i}" for i in range(n_persons)]
+    status = rng.integers(0, 3, size=(n_persons, len(endpoints))).astype(np.int8)
+
+    writer = StatusMatrixWriter(tmp_path, endpoints, n_persons)
+    for start in range(0, n_persons, 3):
+        writer.write(persons[start:start + 3], status[start:start + 3])
+    writer.close()
+
+    matrix = StatusMatrix(tmp_path)
+    assert matrix.persons == persons
+    assert matrix.endpoints == endpoints
+    for idx, endp in enumerate(endpoints):
+        assert (matrix.endpoint(endp) == status[:, idx]).all()
+    for idx, person in enumerate(persons):
+        assert (matrix.person(person) == status[idx]).all()
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+from risteys_pipeline.survival_analysis import check_min_subjects, split_episodes
+
+
+def make_data(n, seed):
+    rng = np.random.default_rng(seed)
+    start = rng.uniform(0, 10, n)
+    df_survival = pd.DataFrame(
+        {
+            "personid": np.arange(n),
+            "start": start,
+            "stop": start + rng.uniform(0.5, 20, n),
+            "outcome": rng.integers(0, 2, n),
+            "weight": rng.choice([1.0, 2.5], n),
+        }
+    )
+    exposed = df_survival.sample(n // 3, random_state=seed).set_index("personid")
+    exposed["exposure_year"] = exposed["start"] + rng.uniform(0.1, 0.9) * (exposed["stop"] - exposed["start"])
+    exposed["exposure"] = 1
+    return df_survival, exposed[["exposure_year", "exposure"]]
+
+
+def test_split_episodes_one_exposure():
+    df_survival, exposed = make_data(300, 0)
+    res, counts = split_episodes(df_survival, {"exposure": exposed}, min_duration=0.01)
+
+    # Reference: an unexposed episode up to the exposure, then an exposed one
+    ref = df_survival.merge(exposed.reset_index(), how="left", on="personid")
+    ref = ref.fillna({"exposure": 0})
+    is_exposed = ref["exposure"] == 1
+    second = ref[is_exposed].assign(start=ref.loc[is_exposed, "exposure_year"])
+    first = ref[is_exposed].assign(stop=ref.loc[is_exposed, "exposure_year"], outcome=0, exposure=0)
+    ref = pd.concat([ref[~is_exposed], first, second]).drop(columns=["exposure_year"])
+
+    sort_cols = ["personid", "start"]
+    res = res.sort_values(sort_cols).reset_index(drop=True)
+    ref = ref.sort_values(sort_cols).reset_index(drop=True)
+    pd.testing.assert_frame_equal(res, ref[res.columns], check_dtype=False)
+
+    tbl = pd.crosstab(ref["outcome"], ref["exposure"], values=ref["personid"], aggfunc="nunique")
+    assert (counts.unstack() == tbl).all().all()
+    assert check_min_subjects(res, counts) == check_min_subjects(res)
+
+
+def test_split_episodes_two_exposures():
+    df_survival = pd.DataFrame(
+        {"personid": [1, 2, 3], "start": [0.0, 0.0, 5.0], "stop": [10.0, 10.0, 10.0], "outcome": [1, 0, 1]}
+    )
+    exposed_a = pd.DataFrame({"exposure_year": [6.0, 2.0]}, index=pd.Index([1, 3], name="personid"))
+    exposed_b = pd.DataFrame({"exposure_year": [3.0, 4.0]}, index=pd.Index([1, 2], name="personid"))
+    res, counts = split_episodes(df_survival, {"a": exposed_a, "b": exposed_b})
+
+    assert res["personid"].tolist() == [1, 1, 1, 2, 2, 3]
+    assert res["start"].tolist() == [0, 3, 6, 0, 4, 5]
+    assert res["stop"].tolist() == [3, 6, 10, 4, 10, 10]
+    assert res["outcome"].tolist() == [0, 0, 1, 0, 0, 1]
+    # Person 3 was exposed to `a` before the start
+    assert res["a"].tolist() == [0, 0, 1, 0, 0, 1]
+    assert res["b"].tolist() == [0, 1, 1, 0, 1, 0]
+    assert counts.to_dict() == {(0, 0, 0): 2, (0, 0, 1): 2, (1, 1, 0): 1, (1, 1, 1): 1}
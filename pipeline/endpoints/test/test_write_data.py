@@ -0,0 +1,35 @@
+import json
+import numpy as np
+import pandas as pd
+from risteys_pipeline.utils.write_data import distribution_to_dict, summary_stats_to_json
+
+
+def test_distribution_to_dict():
+    dist = pd.DataFrame(
+        {
+            "endpoint": ["B", "A", "A", "A", "A"],
+            "sex": ["all", "male", "all", "all", "female"],
+            "left": [0.0, 10.0, 10.0, np.NINF, 0.0],
+            "right": [np.inf, np.inf, 20.0, 10.0, 10.0],
+            "count": [5, 7, 8, 9, 6],
+        }
+    )
+    res = distribution_to_dict(dist)
+    expected = {
+        "A": {
+            "all": [[[None, 10.0], 9], [[10.0, 20.0], 8]],
+            "female": [[[0.0, 10.0], 6]],
+            "male": [[[10.0, None], 7]],
+        },
+        "B": {"all": [[[0.0, None], 5]], "female": [], "male": []},
+    }
+    assert list(res) == ["A", "B"]
+    assert res == expected
+
+
+def test_summary_stats_to_json():
+    key_figures = pd.DataFrame({"endpoint": ["A", "B"], "nindivs_all": [10.0, np.nan]})
+    dist = pd.DataFrame({"endpoint": ["A"], "sex": ["all"], "left": [0.0], "right": [10.0], "count": [10]})
+    res = json.loads(summary_stats_to_json(key_figures, dist, dist))
+    assert res["stats"] == {"A": {"nindivs_all": 10.0}, "B": {"nindivs_all": None}}
+    assert res["distrib_age"] == res["distrib_year"] == distribution_to_dict(dist)
@@ -13,6 +13,8 @@ from risteys_pipeline.finregistry.load_data import (
     load_related_endpoints_data,
 )
 from risteys_pipeline.survival_analysis import *
+from risteys_pipeline.first_events_store import FirstEventsStore
+from risteys_pipeline.utils.shared_frames import get_shared
 
 DAYS_IN_YEAR = 365.25
 DAYS_BETWEEN_ENDPOINTS = 180
@@ -36,7 +38,7 @@ def filter_first_events(first_events, priority, cohort):
     """
     first_events = first_events.loc[first_events["endpoint"].isin(priority["endpoint"])]
     first_events = first_events.loc[
-        (first_events["personid"].values.isin(cohort.index))
+        (first_events["personid"].isin(cohort.index))
         & (first_events["year"] >= FOLLOWUP_START)
         & (first_events["year"] <= FOLLOWUP_END)
     ]
@@ -46,7 +48,7 @@ def filter_first_events(first_events, priority, cohort):
         endpoint_counts > MIN_SUBJECTS_SURVIVAL_ANALYSIS * 2
     ]
     first_events = first_events.loc[
-        first_events["endpoint"].values.isin(endpoint_counts.index)
+        first_events["endpoint"].isin(endpoint_counts.index)
     ]
     first_events = first_events.reset_index(drop=True)
 
@@ -60,7 +62,7 @@ def get_counts(endpoint, first_events, cohort, related_endpoints):
 
     Args:
         endpoint (str): name of the endpoint
-        first_events (DataFrame): first events dataset
+        first_events (FirstEventsStore): first events dataset partitioned by endpoint
         cohort (DataFrame): cohort dataset
         related_endpoints (DataFrame): related endpoints dataset
 
@@ -68,7 +70,8 @@ def get_counts(endpoint, first_events, cohort, related_endpoints):
         DataFrame: counts for endpoints
     """
     cases = get_cases(endpoint, first_events, cohort)
-    temp = first_events.loc[first_events["personid"].values.isin(cases.index)]
+    temp = first_events.events
+    temp = temp.loc[temp["personid"].isin(cases.index)]
     temp = temp.reset_index(drop=True)
     temp = temp.merge(cases["stop"], how="left", right_index=True, left_on="personid")
     temp = temp.loc[
@@ -101,7 +104,7 @@ def run_survival_analysis(endpoint1, endpoint2, first_events, cohort):
     Args:
         endpoint1 (str): name of the first endpoint ("exposure endpoint")
         endpoint2 (str): name of the second endpoint ("outcome endpoint")
-        first_events (DataFrame): first events dataset
+        first_events (FirstEventsStore): first events dataset partitioned by endpoint
         cohort (DataFrame): cohort dataset
 
     Returns:
@@ -122,17 +125,21 @@ def run_survival_analysis(endpoint1, endpoint2, first_events, cohort):
 
         if len(sexes) == 2:
             logger.debug(f"{endpoint1}-{endpoint2}: Data of both sexes")
-            df_survival = build_survival_dataset(cases, cohort, exposed)
+            df_survival, n_persons = build_survival_dataset(
+                cases, cohort, exposed, return_counts=True
+            )
         else:
             logger.debug(
                 f"{endpoint1}-{endpoint2}: Data of one sex (female={sexes[0]})"
             )
             cohort_ = cohort.loc[cohort["female"] == sexes[0]]
-            df_survival = build_survival_dataset(cases, cohort_, exposed)
+            df_survival, n_persons = build_survival_dataset(
+                cases, cohort_, exposed, return_counts=True
+            )
             df_survival = df_survival.drop(columns=["female"])
 
         df_survival = set_timescale(df_survival, "age")
-        model = survival_analysis(df_survival, "cox")
+        model = survival_analysis(df_survival, "cox", n_persons)
 
         if model is not None:
             logger.debug("Formatting the output")
@@ -174,7 +181,7 @@ def survival_analysis_loop(endpoint, first_events, cohort, related_endpoints):
 
     Args:
         endpoint (str): name of the first endpoint ("exposure endpoint")
-        first_events (DataFrame): first events dataset
+        first_events (FirstEventsStore): first events dataset partitioned by endpoint
         cohort (DataFrame): cohort dataset
         related_endpoints (DataFrame): related endpoints dataset
 
@@ -195,14 +202,48 @@ def survival_analysis_loop(endpoint, first_events, cohort, related_endpoints):
     return res
 
 
+def survival_analysis_task(endpoint):
+    """
+    Pool task running survival_analysis_loop() for `endpoint` from the shared
+    first events, cohort and related endpoints.
+
+    Args:
+        endpoint (str): name of the first endpoint ("exposure endpoint")
+
+    Returns:
+        params (DataFrame): results dataset
+    """
+    first_events = FirstEventsStore(get_shared("first_events"), get_shared("first_events_offsets"))
+    cohort = get_shared("cohort")
+    related_endpoints = get_shared("related_endpoints")
+
+    return survival_analysis_loop(endpoint, first_events, cohort, related_endpoints)
+
+
 if __name__ == "__main__":
+    import sys
     from multiprocessing import get_context
     from tqdm import tqdm
+    from risteys_pipeline.finregistry.load_data import INPUT_PATHS
+    from risteys_pipeline.utils.manifest import Stage
+    from risteys_pipeline.utils.shared_frames import SharedFrames, init_shared_frames
+    from risteys_pipeline.utils.pool import imap_bounded
+    from risteys_pipeline.utils.write_data import append_csv
 
     N_PROCESSES = 20
+    MAX_IN_FLIGHT = 2 * N_PROCESSES
 
     logger.setLevel(logging.DEBUG)
 
+    stage = Stage(
+        "survival_priority_endpoints",
+        INPUT_PATHS,
+        ["FOLLOWUP_START", "FOLLOWUP_END", "MIN_SUBJECTS_PERSONAL_DATA", "MIN_SUBJECTS_SURVIVAL_ANALYSIS"],
+        [survival_analysis_loop],
+    )
+    if stage.is_up_to_date():
+        sys.exit()
+
     endpoints, minimal_phenotype, first_events = load_data()
     priority = load_priority_endpoints_data()
     related_endpoints = load_related_endpoints_data()
@@ -210,25 +251,25 @@ if __name__ == "__main__":
 
     cohort = get_cohort(minimal_phenotype)
     first_events = filter_first_events(first_events, priority, cohort)
+    first_events = FirstEventsStore.from_first_events(first_events)
 
     logger.info("Start multiprocessing")
-    with get_context("spawn").Pool(processes=N_PROCESSES) as pool, tqdm(
-        total=n_endpoints
-    ) as pbar:
-        result = [
-            pool.apply_async(
-                survival_analysis_loop,
-                args=(endpoint, first_events, cohort, related_endpoints),
-                callback=lambda _: pbar.update(),
-            )
-            for endpoint in priority["endpoint"]
-        ]
-        result = [r.get() for r in result]
 
-    logger.info("Combining the results")
-    params = [x for x in result if len(x) > 0]
-    params = pd.concat(params, axis=0, ignore_index=True)
-
-    logger.info("Writing output to file")
+    # Results are appended to the output file as the endpoints finish
     output_path = get_output_filepath("surv_priority_endpoints", "csv")
-    params.to_csv(output_path, index=False)
+    with SharedFrames(
+        {"first_events": first_events.events, "cohort": cohort},
+        {"first_events_offsets": first_events.offsets, "related_endpoints": related_endpoints},
+    ) as shared, get_context("spawn").Pool(
+        processes=N_PROCESSES, initializer=init_shared_frames, initargs=(shared.path,)
+    ) as pool, tqdm(
+        total=n_endpoints
+    ) as pbar, open(output_path, "w") as f:
+        for endpoint, params in imap_bounded(
+            pool, survival_analysis_task, priority["endpoint"], MAX_IN_FLIGHT
+        ):
+            if len(params) > 0:
+                append_csv(params, f)
+            pbar.update()
+
+    stage.record([output_path])